@@ -12,23 +12,88 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import hashlib
 import os
 import re
+import threading
+import time
 
 import six
 
 from ironic_python_agent.common import metrics
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
-from ironic_python_agent import netutils
 from ironic_python_agent import utils
 
 from oslo_log import log
 
+from onmetal_ironic_hardware_manager import executor
+from onmetal_ironic_hardware_manager import gauges
+from onmetal_ironic_hardware_manager import inventory
+from onmetal_ironic_hardware_manager import journal
+from onmetal_ironic_hardware_manager import lldp
+from onmetal_ironic_hardware_manager import smart
+from onmetal_ironic_hardware_manager import snapshot
+from onmetal_ironic_hardware_manager import wipe
 
+
+# The BIOS version flash_bios.sh installs. Quanta BIOSes report versions
+# such as 'S2S_3A14' in DMI, so a BIOS whose version ends with this is
+# already current.
+BIOS_VERSION = 'A14'
 # Directory that all BIOS utilities are located in
-BIOS_DIR = '/mnt/bios/quanta_A14'
+BIOS_DIR = '/mnt/bios/quanta_' + BIOS_VERSION
+DMI_BIOS_VERSION_PATH = '/sys/class/dmi/id/bios_version'
+# Clean steps whose reboot boots newly flashed firmware, which the steps
+# after them must run on. Their reboot is never merged into a later step's.
+FIRMWARE_REBOOT_STEPS = frozenset(['upgrade_bios'])
+# BIOS settings profiles, in the order their clean steps run: the script in
+# BIOS_DIR that writes each one, and a file in BIOS_DIR listing the
+# 'name = value' settings it writes. A profile is only written when the
+# settings printed by BIOS_SETTINGS_READ_SCRIPT don't already match it.
+BIOS_SETTINGS_PROFILES = collections.OrderedDict([
+    ('decom', ('write_bios_settings_decom.sh', 'bios_settings_decom.txt')),
+    ('customer', ('write_bios_settings_customer.sh',
+                  'bios_settings_customer.txt')),
+])
+BIOS_SETTINGS_READ_SCRIPT = 'read_bios_settings.sh'
+# Records the BIOS flash and settings steps each node finished, and so the
+# settings profile the BIOS was last left with, so a retried cleaning doesn't
+# redo them before the hardware can show they were done. It is kept in an
+# EFI variable, which survives both reboots and erase_devices, unlike the
+# agent's RAM backed filesystem. On machines that don't boot with EFI, point
+# it at a file on storage that survives both. Entries older than
+# JOURNAL_MAX_AGE seconds are ignored. Set to None to always run the steps.
+JOURNAL_PATH = os.path.join(
+    journal.EFIVARS_DIR,
+    'OnMetalCleanJournal-3f79fe27-529d-4d96-b5a2-7fcd3bc18131')
+JOURNAL_MAX_AGE = 24 * 60 * 60
+# Changes every time the machine boots
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+# Machines whose DMI system vendor starts with one of these are OnMetal
+# hardware. Anything else is left to the generic hardware manager.
+ONMETAL_SYS_VENDORS = ('Quanta',)
+MEMINFO_PATH = '/proc/meminfo'
+# Memory each flavor is registered with in Ironic, in MiB
+FLAVOR_MEMORY_MB = collections.OrderedDict([
+    ('onmetal-compute1', 1024 * 32),
+    ('onmetal-io1', 1024 * 128),
+    ('onmetal-memory1', 1024 * 512),
+])
+# The kernel keeps some memory for itself, so MemTotal is a little less
+# than what is installed. A machine is taken to be the smallest flavor it
+# has at least this fraction of the memory of.
+FLAVOR_MEMORY_FRACTION = 0.9
 LSI_MODEL = 'NWD-BLP4-1600'
+# (vendor, device) PCI IDs of the controllers on WarpDrive cards, as listed
+# by the PCI ID repository (pci-ids.ucw.cz) and matched by the Linux mpt2sas
+# driver (MPI2_MFGPAGE_DEVID_* in mpi2_cnfg.h). 0x007e is the first
+# generation WarpDrive SSS6200. Nytro WarpDrive cards such as the
+# NWD-BLP4-1600 are built on the SAS2308 (0x0087), which plain SAS HBAs
+# report too, so the count is only a hint; ddoemcli -listall is what finds
+# the cards.
+NYTRO_PCI_IDS = frozenset([(0x1000, 0x007e), (0x1000, 0x0087)])
 SATADOM_MODEL = '32G MLC SATADOM'
 # Directory that all the LSI utilities/firmware are located in
 LSI_FIRMWARE_VERSION = '12.22.00.00'
@@ -36,11 +101,377 @@ LSI_FIRMWARE_PREFLASH = 'NWD-BLP4-1600_ConcatSigned.fw'
 LSI_FIRMWARE_PACKAGE = 'NWD-BLP4-1600_12.22.00.00.bin'
 LSI_WARPDRIVE_DIR = os.path.join('/mnt/LSI', LSI_FIRMWARE_VERSION)
 DDOEMCLI = os.path.join(LSI_WARPDRIVE_DIR, 'ddoemcli')
+# Cards older than this don't have the flasher LSI_FIRMWARE_PACKAGE needs,
+# so LSI_FIRMWARE_PREFLASH is flashed first.
+LSI_FIRMWARE_PREFLASH_VERSION = LSI_FIRMWARE_VERSION
+# Maximum number of block devices erased at the same time during
+# erase_devices, whether WarpDrive cards or not. Set to 1 to erase devices
+# one at a time.
+ERASE_CONCURRENCY = 8
+# Seconds a WarpDrive format may go without printing anything before a
+# warning is logged, and again every time it stays quiet that much longer.
+LSI_FORMAT_STALL_TIMEOUT = 900
+# Warnings in a row after which a quiet WarpDrive format is killed and the
+# card reported as stalled. Set to None to wait for it forever.
+LSI_FORMAT_STALL_WARNINGS = 4
+# Maximum number of WarpDrive cards flashed at the same time during
+# update_warpdrive_firmware.
+LSI_FLASH_CONCURRENCY = 4
+# Maximum number of block devices get_disk_metrics reads SMART data from at
+# the same time, and the seconds a single device may take before it is
+# reported as failed and skipped.
+DISK_METRICS_CONCURRENCY = 4
+DISK_METRICS_TIMEOUT = 120
+# Most calls of each vendor command that may run at once, across every clean
+# step, so steps running their own work concurrently don't pile onto the
+# same hardware. A WarpDrive format holds its ddoemcli slot until it is
+# done. Commands not listed are unlimited.
+COMMAND_LIMITS = {
+    'ddoemcli': 4,
+    'smartctl': 8,
+}
+# Seconds a call of a command may run for before it is killed. Flashes and
+# formats must not be interrupted, so ddoemcli only has a timeout for its
+# queries, of LSI_QUERY_TIMEOUT.
+COMMAND_TIMEOUTS = {
+    'smartctl': 60,
+}
+LSI_QUERY_TIMEOUT = 120
+# Prefix of the histogram of vendor command durations sent by
+# get_disk_metrics.
+COMMAND_DURATIONS_PREFIX = 'command_durations'
+# Whether to start listing block devices and LSI cards and reading the BIOS
+# version in the background as soon as the agent picks this manager, so the
+# first clean steps don't wait for them.
+PREFETCH_ON_LOAD = True
+# A (host, port) tuple to send SMART gauges to directly as batched statsd
+# packets of at most STATSD_PACKET_SIZE bytes. When None, gauges are sent
+# through the metrics logger.
+STATSD_ADDRESS = None
+STATSD_PACKET_SIZE = gauges.DEFAULT_PACKET_SIZE
+# Ways of reading SMART attributes from non-WarpDrive devices, tried in
+# order: 'json' needs smartctl 7.0 or later, 'text' parses the table printed
+# by older versions. Add 'ata_ioctl' to read the attributes straight from
+# ATA devices without running smartctl at all.
+SMART_BACKENDS = ('json', 'text')
+# File holding the SMART gauges last sent for each disk, so get_disk_metrics
+# only sends the ones that changed. Every gauge for a disk is sent again at
+# least every SMART_FULL_REFRESH_INTERVAL seconds. It must be on storage
+# that survives reboots and erase_devices, such as a partition on a device
+# the agent doesn't erase, which the agent's own RAM backed filesystem is
+# not. Unset by default, so every gauge is sent every time.
+SMART_SNAPSHOT_PATH = None
+SMART_FULL_REFRESH_INTERVAL = 24 * 60 * 60
+# Counters that also get a '<metric>.PER_HOUR' gauge with their rate of
+# change, matched against the end of the metric name.
+SMART_COUNTERS = (
+    '-Power_On_Hours.RAW_VALUE',
+    '-Power_Cycle_Count.RAW_VALUE',
+    '-Total_LBAs_Written.RAW_VALUE',
+    '-Total_LBAs_Read.RAW_VALUE',
+    '.Power-OnHours',
+    '.DevicePowerCycleCount',
+    '.GigabytesErased',
+    '.TotalWritesFromHost',
+    '.TotalReadsToHost',
+)
 
 LOG = log.getLogger()
 
 LLDP_PORT_TYPE = 2
 LLDP_CHASSIS_TYPE = 5
+# Keys of node['extra'] describing an interface and the switch port it is
+# cabled to, such as 'hardware/interfaces/0/switch_port_id'
+NODE_INTERFACE_KEY_RE = re.compile(r'^hardware/interfaces/(\d+)/(\w+)$')
+# Port number in a port ID such as 'Ethernet1/5'
+LLDP_PORT_NUMBER_RE = re.compile(r'\d{1,2}/\d{1,2}')
+# Seconds verify_ports listens for LLDP frames. Our switches send one every
+# 30 seconds, so this allows for a missed frame; verify_ports stops as soon
+# as every port the node expects has been seen.
+LLDP_TIMEOUT = 65
+
+# ddoemcli -health output. What we really get is SMART data for each SSD
+# behind the WarpDrive card, in a section starting with a line such as
+# "SSD Drive SMART Data Slot #: 4: Drive Serial Number     FL00AV2L".
+WARPDRIVE_SLOT_PREFIX = 'SSD Drive SMART Data Slot'
+WARPDRIVE_SLOT_RE = re.compile(r'Slot #:\s*(\d+):.*\s(\S+)$')
+WARPDRIVE_CUMULATIVE_PREFIX = '-------------- Cumulative'
+WARPDRIVE_FOOTER_PREFIX = 'Warranty Remaining'
+# Units or notes some values are followed by, which aren't part of the value
+WARPDRIVE_UNIT_RE = re.compile(r'\s+\((?:degree C|Gigabytes|%)\)$')
+# Characters that aren't safe in graphite metric names
+GRAPHITE_UNSAFE_RE = re.compile(r'[\(\)/\\]')
+
+# ddoemcli -format output. Each phase starts with a line containing the
+# first string, and a media erase pass completes at each
+# WARPDRIVE_FORMAT_PASS line.
+WARPDRIVE_FORMAT_PHASES = (
+    ('Preparing WarpDrive for format', 'prepare'),
+    ('Format of WarpDrive is in progress', 'format'),
+    ('WarpDrive format successfully completed', 'complete'),
+)
+WARPDRIVE_FORMAT_PASS = 'Media Erase is changed to standard'
+WARPDRIVE_FORMAT_SUCCESS = 'WarpDrive format successfully completed.'
+
+# Matches a PCI function in a sysfs path, such as 0000:02:00.0
+PCI_FUNCTION_RE = re.compile(r'^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]$')
+
+
+def _run_concurrently(func, items, max_workers, timeout=None):
+    """Call func(item) for every item, using at most max_workers threads.
+
+    Every item is run to completion or until it times out. Exceptions are
+    captured in the results instead of being raised, so one failing item
+    doesn't stop the others.
+
+    :param func: a callable taking a single item
+    :param items: an iterable of items to pass to func
+    :param max_workers: the maximum number of items processed at once
+    :param timeout: seconds each item may run for, or None to wait forever.
+                    An item still running after that is abandoned: its
+                    result records a CleaningError and its slot is given to
+                    the next item.
+    :return: a list of dicts, in the same order as items, of the form
+             {'item': item, 'result': return value of func or None,
+              'error': exception raised by func or None,
+              'duration': seconds taken by func}
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = collections.deque(enumerate(items))
+    # index of each running item -> time it started
+    running = {}
+    finished = six.moves.queue.Queue()
+
+    def _worker(idx, item):
+        result = error = None
+        start = time.time()
+        try:
+            result = func(item)
+        except Exception as e:
+            error = e
+        finished.put((idx, {'item': item, 'result': result, 'error': error,
+                            'duration': time.time() - start}))
+
+    while pending or running:
+        while pending and len(running) < max(1, max_workers):
+            idx, item = pending.popleft()
+            thread = threading.Thread(target=_worker, args=(idx, item))
+            # An abandoned item must not keep the agent from exiting
+            thread.daemon = True
+            running[idx] = time.time()
+            thread.start()
+
+        wait = None
+        if timeout is not None:
+            wait = max(0, min(running.values()) + timeout - time.time())
+        try:
+            idx, result = finished.get(timeout=wait)
+        except six.moves.queue.Empty:
+            now = time.time()
+            for idx, started in list(running.items()):
+                if now - started >= timeout:
+                    del running[idx]
+                    results[idx] = {
+                        'item': items[idx],
+                        'result': None,
+                        'error': errors.CleaningError(
+                            'Timed out after {0} seconds'.format(timeout)),
+                        'duration': now - started
+                    }
+            continue
+
+        # Results of items that already timed out are thrown away
+        if idx in running:
+            del running[idx]
+            results[idx] = result
+
+    return results
+
+
+def _version_tuple(version):
+    """Turn a version such as '12.22.00.00' into a comparable tuple.
+
+    Parts that aren't numbers compare lower than any number.
+    """
+    parts = []
+    for part in version.split('.'):
+        try:
+            parts.append(int(part))
+        except ValueError:
+            parts.append(-1)
+    return tuple(parts)
+
+
+def _parse_bios_settings(text):
+    """Parse 'name = value' lines, ignoring blank lines and # comments.
+
+    :return: a dict of {setting: value}
+    """
+    settings = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        settings[name.strip()] = value.strip()
+    return settings
+
+
+def _bios_settings_digest(settings, names=None):
+    """Hash BIOS settings, so they can be compared and recorded.
+
+    :param settings: a dict of {setting: value}
+    :param names: only hash these settings; a setting missing from
+                  settings hashes differently from any value. Defaults to
+                  every setting.
+    :return: a hex SHA-256 digest
+    """
+    if names is None:
+        names = settings
+    lines = [name if name not in settings
+             else '{0}={1}'.format(name, settings[name])
+             for name in sorted(names)]
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def _file_digest(path, *extra):
+    """Hash a file's contents, along with any extra strings.
+
+    :param path: the file to hash
+    :param extra: strings hashed after the contents, such as a version
+    :return: a hex SHA-256 digest, or None if the file can't be read
+    """
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha.update(block)
+    except (IOError, OSError) as e:
+        LOG.warning('Unable to hash %(path)s: %(error)s',
+                    {'path': path, 'error': e})
+        return None
+    for value in extra:
+        sha.update(b'\0' + value.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _read_boot_id():
+    """Return the ID of the current boot, or None if it can't be read."""
+    try:
+        with open(BOOT_ID_PATH, 'r') as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def _coalesce_reboots(steps):
+    """Merge the reboots of adjacent clean steps into one.
+
+    :param steps: a list of clean steps, as returned by get_clean_steps
+    :return: the steps in the order they run, where a step that requests a
+             reboot no longer does if the next step requests one too,
+             unless it is in FIRMWARE_REBOOT_STEPS
+    """
+    steps = sorted((dict(step) for step in steps),
+                   key=lambda step: step['priority'], reverse=True)
+    for step, next_step in zip(steps, steps[1:]):
+        if (step['reboot_requested'] and next_step['reboot_requested'] and
+                step['step'] not in FIRMWARE_REBOOT_STEPS):
+            step['reboot_requested'] = False
+    return steps
+
+
+def _parse_warpdrive_format(chunks):
+    """Follow ddoemcli -format output as it is written.
+
+    :param chunks: an iterable of output chunks, which needn't end on line
+                   boundaries
+    :return: a generator of (event, value) tuples, either
+             ('phase', a phase name from WARPDRIVE_FORMAT_PHASES) when a
+             phase starts, or ('pass', number of passes so far) when a
+             media erase pass completes
+    """
+    passes = 0
+    partial = ''
+    started = set()
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        # The last piece is an unfinished line, until a newline follows it
+        partial = lines.pop()
+        # The format phase is announced on a line that progress dots are
+        # appended to until it finishes, so look in the unfinished line too
+        for idx, line in enumerate(lines + [partial]):
+            if WARPDRIVE_FORMAT_PASS in line and idx < len(lines):
+                passes += 1
+                yield 'pass', passes
+                continue
+            for marker, phase in WARPDRIVE_FORMAT_PHASES:
+                if marker in line and phase not in started:
+                    started.add(phase)
+                    yield 'phase', phase
+
+
+def _iter_lines(text):
+    """Return a generator of the lines in text, without splitting it up front.
+
+    Unlike text.splitlines(), only one line is held in memory at a time.
+    """
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+# States of the _parse_warpdrive_health state machine
+_SEEK_SLOT, _SEEK_CUMULATIVE, _IN_CUMULATIVE = range(3)
+
+
+def _parse_warpdrive_health(lines):
+    """Parse ddoemcli -health output in a single pass, a line at a time.
+
+    Only the cumulative metrics of each SSD are parsed; the current ones
+    only cover the time since the last power cycle.
+
+    :param lines: an iterable of output lines, such as a file object
+    :return: a generator of (drive, metric name, value) tuples, where drive
+             is '<slot>_<serial>' and names and values are safe for graphite
+    """
+    state = _SEEK_SLOT
+    drive = None
+    # Every SSD reports the same metric names, so each is only sanitized once
+    keys = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith(WARPDRIVE_SLOT_PREFIX):
+            match = WARPDRIVE_SLOT_RE.search(line)
+            drive = match.group(1) + '_' + match.group(2)
+            state = _SEEK_CUMULATIVE
+        elif state == _SEEK_CUMULATIVE:
+            if line.startswith(WARPDRIVE_CUMULATIVE_PREFIX):
+                state = _IN_CUMULATIVE
+        elif state == _IN_CUMULATIVE:
+            if line.startswith(WARPDRIVE_FOOTER_PREFIX):
+                state = _SEEK_SLOT
+                continue
+            # It doesn't make sense to store time in graphite
+            if line.endswith('(Hours:Minutes:Seconds)'):
+                continue
+            if line.endswith(')'):
+                line = WARPDRIVE_UNIT_RE.sub('', line)
+            name, value = line.rsplit(None, 1)
+            key = keys.get(name)
+            if key is None:
+                key = keys[name] = GRAPHITE_UNSAFE_RE.sub(
+                    '_', name.replace(' ', ''))
+            yield drive, key, GRAPHITE_UNSAFE_RE.sub('_', value)
 
 
 class OnMetalHardwareManager(hardware.GenericHardwareManager):
@@ -49,11 +480,79 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
     # This should be incremented at every upgrade to avoid making the agent
     # change which hardware manager it uses when cleaning in the middle of a
     # hardware manager upgrade.
-    HARDWARE_MANAGER_VERSION = '4'
+    HARDWARE_MANAGER_VERSION = '5'
+
+    def __init__(self):
+        super(OnMetalHardwareManager, self).__init__()
+        # Hardware state shared by every clean step for the life of the
+        # agent. Anything that changes the hardware must call
+        # _invalidate_caches.
+        self._cache_lock = threading.RLock()
+        self._lsi_inventory = None
+        self._block_device_topology = None
+        self._bios_version = None
+        self._bios_settings = None
+        self._smart_reader = None
+        self._metric_snapshot = None
+        self._executor = None
+        self._hardware_snapshot = None
+        self._os_install_device = None
+        self._clean_step_plan = None
+        self._prefetch_thread = None
+        # What the machine is doesn't change, so this isn't invalidated
+        self._hardware_profile = None
+        self._journal = None
 
     def evaluate_hardware_support(cls):
+        profile = cls._get_hardware_profile()
+        if profile.sys_vendor is None:
+            # Without DMI there's no telling, so claim the machine as this
+            # manager always did before it looked
+            LOG.warning('Unable to read the system vendor, assuming OnMetal '
+                        'hardware: %s', profile)
+        elif not profile.sys_vendor.startswith(ONMETAL_SYS_VENDORS):
+            LOG.info('Not OnMetal hardware: %s', profile)
+            return hardware.HardwareSupport.NONE
+        if PREFETCH_ON_LOAD:
+            cls._start_prefetch()
         return hardware.HardwareSupport.SERVICE_PROVIDER
 
+    def _start_prefetch(self):
+        """Start warming the hardware caches in the background, once.
+
+        Every cache is filled under _cache_lock, so a step asking for
+        something that is still being fetched waits for it instead of
+        fetching it a second time.
+
+        :return: the prefetch thread
+        """
+        with self._cache_lock:
+            if self._prefetch_thread is None:
+                self._prefetch_thread = threading.Thread(
+                    target=self._prefetch, name='onmetal-prefetch')
+                # Prefetching must not keep the agent from exiting
+                self._prefetch_thread.daemon = True
+                self._prefetch_thread.start()
+            return self._prefetch_thread
+
+    def _prefetch(self):
+        """Fill the hardware caches, in the order clean steps use them.
+
+        A cache that fails to fill is left empty, so the step that needs it
+        fetches it again and sees the error itself.
+        """
+        start = time.time()
+        for fetch in (self._get_hardware_snapshot, self._get_lsi_inventory,
+                      self._get_block_device_topology,
+                      self._get_bios_version):
+            try:
+                fetch()
+            except Exception as e:
+                LOG.warning('Prefetching %(fetch)s failed: %(error)s',
+                            {'fetch': fetch.__name__, 'error': e})
+        LOG.info('Prefetched hardware inventory in %.3fs',
+                 time.time() - start)
+
     @metrics.instrument(__name__, 'erase_block_device')
     def erase_block_device(self, block_device):
         if self._erase_lsi_warpdrive(block_device):
@@ -61,6 +560,79 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
 
         super(OnMetalHardwareManager, self).erase_block_device(block_device)
 
+    @metrics.instrument(__name__, 'erase_devices')
+    def erase_devices(self, node, ports):
+        """Erase all block devices concurrently, one lane per device.
+
+        Up to ERASE_CONCURRENCY devices are erased at once, each by
+        erase_block_device: WarpDrive cards are formatted, and any other
+        device gets the generic ATA secure erase, or shred if that isn't
+        supported. A device failing to erase does not interrupt the others;
+        the step only fails once every device has finished.
+
+        :param node: a dict representation of a Node object
+        :param ports: a dict representation of Ports connected to the node
+        :raises BlockDeviceEraseError: if any device failed to erase
+        :return: a list of dicts, one per block device, of the form
+                 {'device': block device name,
+                  'method': 'warpdrive' or 'generic', 'success': bool,
+                  'duration': seconds, 'bytes': size of the device,
+                  'throughput': bytes erased per second, or None if the
+                                erase failed,
+                  'error': error message or None}
+        """
+        block_devices = self._get_hardware_snapshot().block_devices
+        progress = {'done': 0, 'total': len(block_devices)}
+        progress_lock = threading.Lock()
+
+        def _erase(block_device):
+            LOG.info('Erasing %s', block_device.name)
+            start = time.time()
+            self.erase_block_device(block_device.device)
+            duration = time.time() - start
+            with progress_lock:
+                progress['done'] += 1
+                LOG.info('Erased %(device)s in %(duration).3fs at '
+                         '%(throughput)d bytes/s, %(done)s of %(total)s '
+                         'devices done',
+                         dict(progress, device=block_device.name,
+                              duration=duration,
+                              throughput=block_device.size /
+                              max(duration, 0.001)))
+
+        results = _run_concurrently(_erase, block_devices, ERASE_CONCURRENCY)
+        report = []
+        for result in results:
+            block_device = result['item']
+            entry = {
+                'device': block_device.name,
+                'method': ('warpdrive' if self._is_warpdrive(block_device)
+                           else 'generic'),
+                'success': result['error'] is None,
+                'duration': round(result['duration'], 3),
+                'bytes': block_device.size,
+                'throughput': None,
+                'error': None
+            }
+            if result['error'] is not None:
+                entry['error'] = six.text_type(result['error'])
+                LOG.error('Erasing %(device)s (%(method)s) failed after '
+                          '%(duration)ss: %(error)s', entry)
+            elif result['duration'] > 0:
+                entry['throughput'] = int(block_device.size /
+                                          result['duration'])
+            report.append(entry)
+
+        failed = [entry for entry in report if not entry['success']]
+        if failed:
+            raise errors.BlockDeviceEraseError(
+                'Erasing {0} of {1} block devices failed: {2}'.format(
+                    len(failed), len(report),
+                    '; '.join('{0}: {1}'.format(entry['device'],
+                                                entry['error'])
+                              for entry in failed)))
+        return report
+
     def get_clean_steps(self, node, ports):
         """Get a list of clean steps with priority.
 
@@ -72,13 +644,22 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
                      first.
          'reboot_requested': whether the agent should reboot after the step is
                              complete.
-        :return: a default list of decommission steps, as a list of
+
+        Steps that have nothing to do on this node, such as flashing firmware
+        that is already current, are left out. Of adjacent steps that
+        request a reboot, only the last one does, so that a single reboot
+        covers them all; a BIOS flash always keeps its own reboot, so the
+        steps after it run on the new BIOS.
+
+        :return: a list of decommission steps for this node, as a list of
         dictionaries
         """
         # NOTE(supermari0): GenericHardwareManager is assumed to have an
-        # erase_devices step. We implement erase_block_device which is called
-        # by erase_devices. We need to be aware of that if IPA changes.
-        return [
+        # erase_devices step. We override erase_devices to erase every
+        # device concurrently, each through erase_block_device. We need to be
+        # aware of that if IPA changes.
+        needed = self._get_clean_step_plan(node)
+        steps = [
             {
                 'step': 'remove_bootloader',
                 'interface': 'deploy',
@@ -103,13 +684,6 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
                 'priority': 70,
                 'reboot_requested': False,
             },
-            # This step is a no-op for now.
-            {
-                'step': 'update_intel_nic_firmware',
-                'interface': 'deploy',
-                'priority': 60,
-                'reboot_requested': True,
-            },
             {
                 'step': 'erase_devices',
                 'interface': 'deploy',
@@ -141,77 +715,477 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
                 'reboot_requested': False
             }
         ]
+        return _coalesce_reboots([step for step in steps
+                                  if needed.get(step['step'], True)])
+
+    def _get_clean_step_plan(self, node):
+        """Work out which optional clean steps have anything to do, once.
+
+        The answer needs ddoemcli and BIOS_SETTINGS_READ_SCRIPT, so it is
+        kept until _invalidate_caches is called. A check that fails counts
+        the step as needed, rather than being run again on every call.
+
+        :param node: a dict representation of a Node object
+        :return: a dict of {step name: whether it needs to run}
+        """
+        with self._cache_lock:
+            if self._clean_step_plan is None:
+                bios_settings_plan = self._plan_bios_settings(node)
+                self._clean_step_plan = {
+                    'upgrade_bios': not self._bios_is_current(),
+                    'decom_bios_settings': bios_settings_plan['decom'],
+                    'update_warpdrive_firmware':
+                        self._warpdrive_firmware_needed(),
+                    'customer_bios_settings': bios_settings_plan['customer'],
+                }
+            return self._clean_step_plan
+
+    def _warpdrive_firmware_needed(self):
+        """Whether any WarpDrive card needs flashing.
+
+        If the cards can't be listed, update_warpdrive_firmware is assumed
+        to be needed, so that it runs and reports the problem.
+        """
+        try:
+            devices = self._get_lsi_inventory()['devices']
+        except Exception as e:
+            LOG.warning('Unable to list LSI devices to plan firmware '
+                        'updates: %s', e)
+            return True
+        return any(card['flashes']
+                   for card in self._plan_warpdrive_firmware(devices))
 
     @metrics.instrument(__name__, 'decom_bios_settings')
     def decom_bios_settings(self, node, ports):
         driver_info = node.get('driver_info', {})
         LOG.info('Decom BIOS Settings called with %s' % driver_info)
-        cmd = os.path.join(BIOS_DIR, 'write_bios_settings_decom.sh')
-        utils.execute(cmd, check_exit_code=[0])
+        self._apply_bios_settings(node, 'decom')
         return True
 
     @metrics.instrument(__name__, 'customer_bios_settings')
     def customer_bios_settings(self, node, ports):
         driver_info = node.get('driver_info', {})
         LOG.info('Customer BIOS Settings called with %s' % driver_info)
-        cmd = os.path.join(BIOS_DIR, 'write_bios_settings_customer.sh')
-        utils.execute(cmd, check_exit_code=[0])
+        self._apply_bios_settings(node, 'customer')
         return True
 
+    def _apply_bios_settings(self, node, profile):
+        """Write a BIOS settings profile, unless the BIOS already matches it.
+
+        When the current settings can't be read, as until the agent reboots
+        into a freshly flashed BIOS, the journal is trusted instead.
+
+        :param node: a dict representation of a Node object
+        :param profile: a key of BIOS_SETTINGS_PROFILES
+        :return: True if the settings were written, False if they already
+                 matched
+        """
+        step = profile + '_bios_settings'
+        script, _ = BIOS_SETTINGS_PROFILES[profile]
+        bios_is_current = self._bios_is_current()
+        desired = self._get_bios_settings_profile(profile)
+        if desired is not None:
+            digest = _bios_settings_digest(desired)
+            # Until the agent reboots into a freshly flashed BIOS, the
+            # settings it will have can't be read.
+            current = None
+            if bios_is_current:
+                current = self._get_bios_settings()
+            if (current is not None and
+                    _bios_settings_digest(current, desired) == digest):
+                LOG.info('BIOS settings already match the %(profile)s '
+                         'profile (%(digest)s), not writing them.',
+                         {'profile': profile, 'digest': digest})
+                self._record_bios_settings(node, profile, digest,
+                                           same_boot=False)
+                return False
+            if current is None and self._step_is_done(node, step, digest):
+                LOG.info('The %(profile)s BIOS settings profile '
+                         '(%(digest)s) was already written, not writing it '
+                         'again.', {'profile': profile, 'digest': digest})
+                return False
+        else:
+            digest = None
+
+        self._execute(os.path.join(BIOS_DIR, script), check_exit_code=[0])
+        self._invalidate_caches()
+        # Settings written to the BIOS that is about to be replaced may not
+        # outlive booting the new one
+        self._record_bios_settings(node, profile, digest,
+                                   same_boot=not bios_is_current)
+        return True
+
+    def _plan_bios_settings(self, node):
+        """Work out which BIOS settings profiles will need writing.
+
+        Profiles are checked in the order their steps run, each against the
+        settings the BIOS will have once the steps before it are done.
+        Flashing the BIOS may reset its settings, so every profile needs
+        writing if the BIOS is going to be flashed. When the current
+        settings can't be read, the journal is trusted instead, as
+        _apply_bios_settings does.
+
+        :param node: a dict representation of a Node object
+        :return: a dict of {profile: whether its settings need writing}
+        """
+        bios_is_current = self._bios_is_current()
+        settings = None
+        if bios_is_current:
+            settings = self._get_bios_settings()
+        plan = {}
+        for profile in BIOS_SETTINGS_PROFILES:
+            desired = self._get_bios_settings_profile(profile)
+            if desired is None:
+                # Without the profile's settings, there's nothing to compare
+                plan[profile] = True
+            elif settings is None:
+                plan[profile] = not (bios_is_current and self._step_is_done(
+                    node, profile + '_bios_settings',
+                    _bios_settings_digest(desired)))
+            else:
+                plan[profile] = (_bios_settings_digest(settings, desired) !=
+                                 _bios_settings_digest(desired))
+            # The next profile is compared with what this one leaves behind
+            if desired is None:
+                settings = None
+            else:
+                settings = dict(settings or {}, **desired)
+        return plan
+
+    def _get_bios_settings_profile(self, profile):
+        """Read the settings a profile writes.
+
+        :param profile: a key of BIOS_SETTINGS_PROFILES
+        :return: a dict of {setting: value}, or None if the profile has no
+                 settings file
+        """
+        path = os.path.join(BIOS_DIR, BIOS_SETTINGS_PROFILES[profile][1])
+        try:
+            with open(path, 'r') as f:
+                return _parse_bios_settings(f.read())
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to read the %(profile)s BIOS settings from '
+                        '%(path)s, they will always be written: %(error)s',
+                        {'profile': profile, 'path': path, 'error': e})
+            return None
+
+    def _get_bios_settings(self):
+        """Read the current BIOS settings, running the script only once.
+
+        :return: a dict of {setting: value}, or None if they can't be read
+        """
+        with self._cache_lock:
+            if self._bios_settings is None:
+                cmd = os.path.join(BIOS_DIR, BIOS_SETTINGS_READ_SCRIPT)
+                try:
+                    out = self._execute(cmd, check_exit_code=[0])[0]
+                except Exception as e:
+                    LOG.warning('Unable to read the current BIOS settings: '
+                                '%s', e)
+                    return None
+                self._bios_settings = _parse_bios_settings(out)
+            return self._bios_settings
+
+    def _record_bios_settings(self, node, profile, digest, same_boot):
+        """Record in the journal the profile the BIOS was last left with.
+
+        Writing a profile may undo the settings of the others, so they are
+        forgotten, leaving the journal with only the last one.
+
+        :param node: a dict representation of a Node object
+        :param profile: a key of BIOS_SETTINGS_PROFILES
+        :param digest: the digest of the profile's settings, or None
+        :param same_boot: whether the settings only count as written until
+                          the agent reboots
+        """
+        self._forget_steps(node, ['{0}_bios_settings'.format(other)
+                                  for other in BIOS_SETTINGS_PROFILES
+                                  if other != profile])
+        self._record_step(node, profile + '_bios_settings', digest,
+                          same_boot=same_boot)
+
     @metrics.instrument(__name__, 'remove_bootloader')
     def remove_bootloader(self, node, ports):
         driver_info = node.get('driver_info', {})
         LOG.info('Remove Bootloader called with %s' % driver_info)
-        bootdisk = self.get_os_install_device()
-        cmd = ['dd', 'if=/dev/zero', 'of=' + bootdisk, 'bs=1M', 'count=1']
-        utils.execute(*cmd, check_exit_code=[0])
+        bootdisk = self._get_os_install_device()
+        # Both ends, as GPT keeps a backup at the end of the disk
+        regions = wipe.wipe_partition_tables(bootdisk)
+        LOG.info('Zeroed %(regions)s of %(device)s',
+                 {'regions': regions, 'device': bootdisk})
         return True
 
     @metrics.instrument(__name__, 'upgrade_bios')
     def upgrade_bios(self, node, ports):
         driver_info = node.get('driver_info', {})
         LOG.info('Update BIOS called with %s' % driver_info)
+        if self._bios_is_current():
+            LOG.info('BIOS already version %s, not upgrading.',
+                     self._get_bios_version())
+            return True
         cmd = os.path.join(BIOS_DIR, 'flash_bios.sh')
-        utils.execute(cmd, check_exit_code=[0])
+        digest = _file_digest(cmd, BIOS_VERSION)
+        # The new version only shows once the agent has rebooted, so only a
+        # flash in this boot counts. After a reboot, DMI still reporting the
+        # old version means the flash didn't take.
+        if self._step_is_done(node, 'upgrade_bios', digest):
+            LOG.info('BIOS already flashed to %s, waiting for a reboot.',
+                     BIOS_VERSION)
+            return True
+        self._execute(cmd, check_exit_code=[0])
+        self._invalidate_caches()
+        self._record_step(node, 'upgrade_bios', digest, same_boot=True)
+        # Flashing may reset the BIOS settings, so they must be written again
+        self._forget_steps(node, ['{0}_bios_settings'.format(profile)
+                                  for profile in BIOS_SETTINGS_PROFILES])
         return True
 
     @metrics.instrument(__name__, 'update_warpdrive_firmware')
     def update_warpdrive_firmware(self, node, ports):
+        """Bring every WarpDrive card up to LSI_FIRMWARE_VERSION.
+
+        The flashes each card needs are planned up front by
+        _plan_warpdrive_firmware. Cards are then flashed concurrently, up to
+        LSI_FLASH_CONCURRENCY at once, each one running its own flashes in
+        order. A card failing to flash does not interrupt the others; the
+        step only fails once every card has finished.
+
+        :param node: a dict representation of a Node object
+        :param ports: a dict representation of Ports connected to the node
+        :raises CleaningError: if any card failed to flash
+        :return: a list of dicts, one per card, of the form
+                 {'id': controller id, 'version': version before flashing,
+                  'flashes': ['preflash' and/or 'package', in order],
+                  'success': bool, 'duration': seconds,
+                  'error': error message or None}
+        """
         driver_info = node.get('driver_info', {})
         LOG.info('Update Warpdrive called with %s' % driver_info)
-        devices = self._list_lsi_devices()
+        plan = self._plan_warpdrive_firmware(
+            self._get_lsi_inventory()['devices'])
+        try:
+            results = _run_concurrently(
+                self._flash_warpdrive_card,
+                [card for card in plan if card['flashes']],
+                LSI_FLASH_CONCURRENCY)
+        finally:
+            # Flashing changes the firmware version reported by the cards,
+            # even when only some of them were flashed.
+            self._invalidate_caches()
+
+        report = []
+        results = dict((result['item']['device']['id'], result)
+                       for result in results)
+        for card in plan:
+            device = card['device']
+            entry = {
+                'id': device['id'],
+                'version': device['version'],
+                'flashes': card['flashes'],
+                'success': True,
+                'duration': 0,
+                'error': None
+            }
+            result = results.get(device['id'])
+            if result is None:
+                LOG.info('Device %(id)s already version %(version)s, '
+                         'not upgrading.', entry)
+            else:
+                entry['duration'] = round(result['duration'], 3)
+                if result['error'] is not None:
+                    entry['success'] = False
+                    entry['error'] = six.text_type(result['error'])
+                    LOG.error('Flashing WarpDrive %(id)s failed after '
+                              '%(duration)ss: %(error)s', entry)
+                else:
+                    LOG.info('Flashed WarpDrive %(id)s from %(version)s in '
+                             '%(duration)ss', entry)
+            report.append(entry)
+
+        failed = [entry for entry in report if not entry['success']]
+        if failed:
+            raise errors.CleaningError(
+                'Flashing {0} of {1} LSI cards failed: {2}'.format(
+                    len(failed), len(report),
+                    '; '.join('{0}: {1}'.format(entry['id'], entry['error'])
+                              for entry in failed)))
+        return report
+
+    def _plan_warpdrive_firmware(self, devices):
+        """Work out which flashes each WarpDrive card needs.
+
+        :param devices: a list of devices returned by _list_lsi_devices
+        :return: a list of dicts, one per device, of the form
+                 {'device': device, 'flashes': a list of 'preflash' and/or
+                  'package' in the order to flash them, empty if the card is
+                  already at or above LSI_FIRMWARE_VERSION}
+        """
+        target = _version_tuple(LSI_FIRMWARE_VERSION)
+        plan = []
         for device in devices:
-            # Don't reflash the same firmware
-            if device['version'] != LSI_FIRMWARE_VERSION:
-                preflash_path = os.path.join(LSI_WARPDRIVE_DIR,
-                                             LSI_FIRMWARE_PREFLASH)
-                firmware_path = os.path.join(LSI_WARPDRIVE_DIR,
-                                             LSI_FIRMWARE_PACKAGE)
-
-                # note(JayF): New firmware requires us to flash a new firmware
-                # flasher before flashing the update package
-                precmd = [DDOEMCLI, '-c', device['id'], '-f', preflash_path]
-                cmd = [DDOEMCLI, '-c', device['id'],
-                       '-updatepkg', firmware_path]
-                with metrics.instrument_context(
-                        __name__, 'upgrade_warpdrive_firmware_preflash'):
-                    utils.execute(*precmd, check_exit_code=[0])
-                with metrics.instrument_context(
-                        __name__, 'upgrade_warpdrive_firmware_package'):
-                    utils.execute(*cmd, check_exit_code=[0])
+            flashes = []
+            version = _version_tuple(device['version'])
+            # Don't reflash the same firmware, or downgrade newer firmware
+            if version < target:
+                # note(JayF): New firmware requires us to flash a new
+                # firmware flasher before flashing the update package
+                if version < _version_tuple(LSI_FIRMWARE_PREFLASH_VERSION):
+                    flashes.append('preflash')
+                flashes.append('package')
+            elif version > target:
+                LOG.info('WarpDrive %(id)s has firmware %(version)s, newer '
+                         'than %(target)s, not flashing.',
+                         {'id': device['id'], 'version': device['version'],
+                          'target': LSI_FIRMWARE_VERSION})
+            plan.append({'device': device, 'flashes': flashes})
+        return plan
+
+    def _flash_warpdrive_card(self, card):
+        """Run the flashes planned for a single WarpDrive card, in order.
+
+        :param card: an entry returned by _plan_warpdrive_firmware
+        """
+        device_id = card['device']['id']
+        for flash in card['flashes']:
+            if flash == 'preflash':
+                cmd = [DDOEMCLI, '-c', device_id, '-f',
+                       os.path.join(LSI_WARPDRIVE_DIR, LSI_FIRMWARE_PREFLASH)]
             else:
-                LOG.info('Device %(id)s already version %(version)s, '
-                         'not upgrading.' % {
-                             'id': device['id'],
-                             'version': device['version']
-                         })
+                cmd = [DDOEMCLI, '-c', device_id, '-updatepkg',
+                       os.path.join(LSI_WARPDRIVE_DIR, LSI_FIRMWARE_PACKAGE)]
+            with metrics.instrument_context(
+                    __name__, 'upgrade_warpdrive_firmware_' + flash):
+                self._execute(*cmd, check_exit_code=[0])
+
+    def _invalidate_caches(self):
+        """Drop cached hardware state so it is read again when next used.
+
+        Called after any step that flashes firmware or requests a reboot,
+        as either can change what the hardware reports.
+        """
+        with self._cache_lock:
+            self._lsi_inventory = None
+            self._block_device_topology = None
+            self._bios_version = None
+            self._bios_settings = None
+            self._hardware_snapshot = None
+            self._os_install_device = None
+            self._clean_step_plan = None
+
+    def _get_hardware_profile(self):
+        """Return what the machine is, reading /sys and /proc only once.
+
+        :return: an inventory.HardwareProfile
+        """
+        with self._cache_lock:
+            if self._hardware_profile is None:
+                start = time.time()
+                self._hardware_profile = inventory.detect(self.sys_path,
+                                                          MEMINFO_PATH)
+                LOG.debug('Detected %(profile)s in %(duration).3fs, with '
+                          '%(cards)s Nytro WarpDrive cards',
+                          {'profile': self._hardware_profile,
+                           'duration': time.time() - start,
+                           'cards': self._hardware_profile.count_pci_devices(
+                               NYTRO_PCI_IDS)})
+            return self._hardware_profile
+
+    def _get_detected_flavor(self):
+        """Work out the flavor from the memory the machine has.
+
+        :return: a flavor from FLAVOR_MEMORY_MB, or None if the memory
+                 couldn't be read or matches none of them
+        """
+        memory_kb = self._get_hardware_profile().memory_kb
+        if memory_kb is None:
+            return None
+        for flavor, memory_mb in six.iteritems(FLAVOR_MEMORY_MB):
+            if (memory_mb * 1024 * FLAVOR_MEMORY_FRACTION <= memory_kb <=
+                    memory_mb * 1024):
+                return flavor
+        return None
+
+    def _get_hardware_snapshot(self):
+        """Return the block devices, enumerating them only once per session.
+
+        Like the LSI inventory, the snapshot is shared by every clean step
+        until _invalidate_caches is called.
+
+        :return: an inventory.HardwareSnapshot
+        """
+        with self._cache_lock:
+            if self._hardware_snapshot is None:
+                self._hardware_snapshot = inventory.HardwareSnapshot(
+                    self.list_block_devices())
+                LOG.debug('Took a hardware snapshot of %s',
+                          self._hardware_snapshot.block_devices)
+            return self._hardware_snapshot
+
+    def _get_os_install_device(self):
+        """Return the OS install device, finding it only once per session.
+
+        :return: the path of the device, such as /dev/sda
+        """
+        with self._cache_lock:
+            if self._os_install_device is None:
+                self._os_install_device = self.get_os_install_device()
+            return self._os_install_device
+
+    def _get_bios_version(self):
+        """Return the BIOS version reported by DMI, reading it only once.
+
+        :return: the version string, or None if it can't be read
+        """
+        with self._cache_lock:
+            if self._bios_version is None:
+                try:
+                    with open(DMI_BIOS_VERSION_PATH, 'r') as f:
+                        self._bios_version = f.read().strip()
+                except (IOError, OSError) as e:
+                    LOG.warning('Unable to read the BIOS version from '
+                                '%(path)s: %(error)s',
+                                {'path': DMI_BIOS_VERSION_PATH, 'error': e})
+                    return None
+            return self._bios_version
+
+    def _bios_is_current(self):
+        """Whether the BIOS is already the version flash_bios.sh installs.
+
+        A BIOS whose version can't be read is never current, so it is
+        always flashed.
+        """
+        version = self._get_bios_version()
+        return bool(version) and version.endswith(BIOS_VERSION)
+
+    def _get_lsi_inventory(self):
+        """Return the LSI devices, listing them only once per session.
 
-    def update_intel_nic_firmware(self, node, ports):
-        LOG.info('NOOP: Update Intel NIC called with %s' %
-                 node.get('driver_info'))
+        The result of _list_lsi_devices is cached on the manager and shared
+        by every clean step until _invalidate_caches is called.
+
+        :return: a dict of the form
+                 {'devices': the list returned by _list_lsi_devices,
+                  'by_id': {controller id: device},
+                  'by_pci_address': {PCI address: [devices]}}
+        """
+        with self._cache_lock:
+            if self._lsi_inventory is None:
+                devices = self._list_lsi_devices()
+                by_pci_address = {}
+                for device in devices:
+                    by_pci_address.setdefault(device['pci_address'],
+                                              []).append(device)
+                self._lsi_inventory = {
+                    'devices': devices,
+                    'by_id': dict((device['id'], device)
+                                  for device in devices),
+                    'by_pci_address': by_pci_address
+                }
+            return self._lsi_inventory
 
     def _list_lsi_devices(self):
-        lines = utils.execute(DDOEMCLI, '-listall')[0].split('\n')
+        lines = self._execute(DDOEMCLI, '-listall',
+                              timeout=LSI_QUERY_TIMEOUT)[0].split('\n')
         matching_devices = [line.split() for line in lines if LSI_MODEL
                             in line]
         devices = []
@@ -225,9 +1199,26 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
             })
         return devices
 
-    def _get_warpdrive_card(self, block_device):
-        device_name = os.path.basename(block_device.name)
-        sys_block_path = '{0}/block/{1}'.format(self.sys_path, device_name)
+    def _get_block_device_topology(self):
+        """Map every block device to its PCI address and LSI card.
+
+        /sys/block is walked once and matched against the LSI inventory, and
+        the result is cached until _invalidate_caches is called.
+
+        :return: a dict of the form
+                 {device name: {'pci_address': PCI address or None,
+                                'lsi_cards': [LSI devices at that address]}}
+        """
+        with self._cache_lock:
+            if self._block_device_topology is None:
+                sys_block_path = os.path.join(self.sys_path, 'block')
+                self._block_device_topology = dict(
+                    (name, self._resolve_block_device(name))
+                    for name in os.listdir(sys_block_path))
+            return self._block_device_topology
+
+    def _resolve_block_device(self, device_name):
+        sys_block_path = os.path.join(self.sys_path, 'block', device_name)
 
         # NOTE(russell_h): Trying to map a block device name to an LSI card
         # gets a little weird. It seems like if we follow the
@@ -240,13 +1231,31 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
         # address 00:02:00:00
         real_path = os.path.realpath(sys_block_path)
 
-        # pull out a segment such as 0000:02:00.0 and trim it to 00:02:00
-        pci_address = real_path.split('/')[5][2:-2]
+        # Anything between the root complex and the card is a PCI bridge, so
+        # the card is the last PCI function in the path, however deeply it
+        # is nested.
+        functions = [segment for segment in real_path.split('/')
+                     if PCI_FUNCTION_RE.match(segment)]
+        if not functions:
+            return {'pci_address': None, 'lsi_cards': []}
 
-        devices = self._list_lsi_devices()
+        # trim a segment such as 0000:02:00.0 to 00:02:00
+        pci_address = functions[-1][2:-2]
+        lsi_cards = self._get_lsi_inventory()['by_pci_address'].get(
+            pci_address, [])
+        return {'pci_address': pci_address, 'lsi_cards': lsi_cards}
 
-        matching_devices = [device for device in devices if
-                            device['pci_address'] == pci_address]
+    def _get_warpdrive_card(self, block_device):
+        device_name = os.path.basename(block_device.name)
+        topology = self._get_block_device_topology()
+        if device_name not in topology:
+            # The device showed up after /sys/block was indexed
+            with self._cache_lock:
+                topology[device_name] = self._resolve_block_device(
+                    device_name)
+
+        pci_address = topology[device_name]['pci_address']
+        matching_devices = topology[device_name]['lsi_cards']
 
         if len(matching_devices) == 0:
             raise errors.CleaningError(('Unable to locate an LSI '
@@ -265,128 +1274,242 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
             return True
 
     def _get_smartctl_attributes(self, block_device):
-        smartout = utils.execute('smartctl', '--attributes', block_device.name)
-        header = None
-        it = iter(smartout.split('\n'))
-        for line in it:
-            # note(JayF): skip forward until we get to the header and pull
-            # it out
-            if line.strip().startswith('ID#'):
-                header = line.strip().split()
-                break
+        """Read the SMART attributes of a block device.
 
-        attributes = {}
-        # note(JayF): All lines at this point contain metrics or are blank.
-        for line in it:
-            line = line.strip()
-            if not line:
-                continue
-            linelist = line.split()
-            # note(JayF): match up headers to values to generate a dict
-            key = linelist[0] + '-' + linelist[1]
-            value = dict(zip(header[2:], linelist[2:]))
-            attributes[key] = value
+        :param block_device: a BlockDevice object
+        :return: a dict of {'<ID#>-<ATTRIBUTE_NAME>': smart.SmartAttribute}
+        """
+        return self._get_smart_reader().get_attributes(block_device.name)
 
-        return attributes
+    def _get_journal(self):
+        """Return the clean step journal, or None if disabled."""
+        if JOURNAL_PATH is None:
+            return None
+        with self._cache_lock:
+            if self._journal is None:
+                self._journal = journal.StepJournal(JOURNAL_PATH,
+                                                    JOURNAL_MAX_AGE)
+            return self._journal
+
+    def _step_is_done(self, node, step, digest):
+        """Whether the journal shows a step already finished on this node.
+
+        Nothing is taken as done for a node without a UUID, for a step whose
+        input couldn't be hashed, or when the journal is disabled. A step
+        recorded with same_boot only counts until the agent reboots.
+
+        :param node: a dict representation of a Node object
+        :param step: the clean step name
+        :param digest: the hash of what the step was given, or None
+        """
+        step_journal = self._get_journal()
+        if step_journal is None or not node.get('uuid') or digest is None:
+            return False
+        return step_journal.is_done(node['uuid'], step, digest,
+                                    _read_boot_id())
+
+    def _record_step(self, node, step, digest, same_boot=False):
+        """Record in the journal that a step finished on this node.
+
+        :param node: a dict representation of a Node object
+        :param step: the clean step name
+        :param digest: the hash of what the step was given, or None
+        :param same_boot: whether the step only counts as done until the
+                          agent reboots. If the boot can't be told, it isn't
+                          recorded at all.
+        """
+        step_journal = self._get_journal()
+        if step_journal is None or not node.get('uuid') or digest is None:
+            return
+        boot_id = None
+        if same_boot:
+            boot_id = _read_boot_id()
+            if boot_id is None:
+                return
+        step_journal.record(node['uuid'], step, digest, boot_id)
+
+    def _forget_steps(self, node, steps):
+        step_journal = self._get_journal()
+        if step_journal is not None and node.get('uuid'):
+            step_journal.forget(node['uuid'], steps)
+
+    def _get_smart_reader(self):
+        """Return the SmartReader, probing smartctl only the first time."""
+        with self._cache_lock:
+            if self._smart_reader is None:
+                self._smart_reader = smart.SmartReader(self._execute,
+                                                       SMART_BACKENDS)
+            return self._smart_reader
+
+    def _get_executor(self):
+        """Return the Executor every vendor command is run through."""
+        with self._cache_lock:
+            if self._executor is None:
+                self._executor = executor.Executor(
+                    utils.execute, COMMAND_LIMITS, COMMAND_TIMEOUTS)
+            return self._executor
+
+    def _execute(self, *cmd, **kwargs):
+        """Run a vendor command through the executor.
+
+        See executor.Executor.execute.
+        """
+        return self._get_executor().execute(*cmd, **kwargs)
 
     def _get_warpdrive_attributes(self, block_device):
         device = self._get_warpdrive_card(block_device)
-        result = utils.execute(DDOEMCLI, '-c', device['id'], '-health')
+        result = self._execute(DDOEMCLI, '-c', device['id'], '-health',
+                               timeout=LSI_QUERY_TIMEOUT)
         attributes = {}
-        attrkey = None
-        # note(JayF): What we really get here is SMART data for the 4 SSDs
-        # behind the Warpdrive card. Split them up to parse separately.
-        for idx, lines in enumerate(result.split('SSD Drive SMART')):
-            # note(JayF): The first entry is headers, throw it away
-            if idx == 0:
-                continue
-            it = iter(lines.split('\n'))
-            for line in it:
-                line = line.strip()
-                if not line:
-                    continue
-                if line.startswith('Data Slot #'):
-                    # note(JayF): Get the drive number and serial. The full
-                    # line is actually "SSD Drive SMART Data Slot #" but by
-                    # splitting on it above we lose the first three words.
-                    drivenum = line.split()[3][0]
-                    driveserial = line.split()[7]
-                    attrkey = drivenum + '_' + driveserial
-                    attributes[attrkey] = {}
-                # note(JayF): Once we know what drive this is, skip past the
-                # current metrics (which are only for a power cycle), to put
-                # the iterator in the right place for starting to grab k:v
-                # pairs below
-                if line.startswith('-------------- Cumulative'):
-                    break
-
-            for line in it:
-                line = line.strip()
-                # note(JayF): It doesn't make sense to store time in graphite
-                if not line or line.endswith('(Hours:Minutes:Seconds)'):
-                    continue
-                # note(JayF): This is the first line of the footer. If we get
-                # here, we're done parsing.
-                if line.startswith('Warranty Remaining'):
-                    break
-                # note(JayF): Some of the metrics have units or notes in
-                # parens, we look for these and adjust our rsplit accordingly
-                if line.endswith('(degree C)'):
-                    key = line.rsplit(None, 3)[0].replace(" ", "")
-                    value = line.rsplit(None, 3)[1]
-                elif (line.endswith('(Gigabytes)')
-                       or line.endswith('(%)')):
-                    key = line.rsplit(None, 2)[0].replace(" ", "")
-                    value = line.rsplit(None, 2)[1]
-                else:
-                    key = line.rsplit(None, 1)[0].replace(" ", "")
-                    value = line.rsplit(None, 1)[1]
-                # note(JayF): Ensure all characters are safe for graphite
-                key = re.sub(r'[\(\)/\\]', '_', key)
-                attributes[attrkey][key] = re.sub(r'[\(\)/\\]', '_', value)
-
+        for drive, key, value in _parse_warpdrive_health(
+                _iter_lines(result[0])):
+            attributes.setdefault(drive, {})[key] = value
         return attributes
 
     def _send_gauges(self, prefix, metrics_to_send):
         """Batch-send gauges to MetricsLogger.
 
+        See gauges.GaugeBatch for how the batch is sent.
+
         :param prefix: The prefix given to MetricLogger
         :param metrics: Dict in the format {'key': 'value'} where key is the
                         metric name and value is the metric.
+        :return: a dict of the form {'sent': number of gauges sent,
+                                     'dropped': number of gauges dropped}
+        """
+        return self._send_gauge_batch({prefix: metrics_to_send})
+
+    def _send_gauge_batch(self, gauges_by_prefix):
+        """Send gauges under several prefixes in a single batch.
+
+        In statsd mode, gauges for every prefix share packets, and only one
+        socket is opened.
+
+        :param gauges_by_prefix: a dict of {prefix: {metric name: value}}
+        :return: a dict of the form {'sent': number of gauges sent,
+                                     'dropped': number of gauges dropped}
         """
-        logger = metrics.getLogger(prefix)
-        for name, gauge in six.iteritems(metrics_to_send):
-            logger.gauge(name, gauge)
+        batch = gauges.GaugeBatch(metrics.getLogger,
+                                  statsd_address=STATSD_ADDRESS,
+                                  packet_size=STATSD_PACKET_SIZE)
+        for prefix, metrics_to_send in six.iteritems(gauges_by_prefix):
+            batch.add(prefix, metrics_to_send)
+        return batch.flush()
 
     def get_disk_metrics(self, node, ports):
-        smart_data_columns = ['VALUE', 'WORST', 'RAW_VALUE']
-        block_devices = self.list_block_devices()
-        for block_device in block_devices:
-            if self._is_warpdrive(block_device):
-                wdmetrics = self._get_warpdrive_attributes(block_device)
-                prefix = 'smartdata_{0}_{1}'.format(
-                        os.path.basename(block_device.name),
-                        block_device.model.replace(" ", ""))
-                metrics_to_send = {}
-                for disk, stats in six.iteritems(wdmetrics):
-                    for key, value in six.iteritems(stats):
-                        metrickey = disk + '.' + key
-                        metrics_to_send[metrickey] = value
+        """Send SMART data for every block device as gauges.
 
-            else:
-                disk_metrics = self._get_smartctl_attributes(block_device)
-                prefix = 'smartdata_{0}_{1}'.format(
-                        os.path.basename(block_device.name),
-                        block_device.model.replace(" ", ""))
-                metrics_to_send = {}
-                for k, v in six.iteritems(disk_metrics):
-                    if v['RAW_VALUE'] == '0':
-                        continue
-                    for heading in smart_data_columns:
-                        key = k + '.' + heading
-                        metrics_to_send[key] = v[heading]
-
-            self._send_gauges(prefix, metrics_to_send)
+        Devices are read concurrently, DISK_METRICS_CONCURRENCY at a time.
+        A device that fails, or takes longer than DISK_METRICS_TIMEOUT
+        seconds, doesn't hold up the others; once the gauges of every other
+        device have been sent, the step fails naming it.
+
+        Unless SMART_SNAPSHOT_PATH is None, only gauges that changed since
+        they were last sent are sent, along with rates for SMART_COUNTERS,
+        and disks no longer in the machine are dropped from the snapshot.
+        The durations of every vendor command run since the agent started
+        are sent as well, under COMMAND_DURATIONS_PREFIX.
+
+        :param node: a dict representation of a Node object
+        :param ports: a dict representation of Ports connected to the node
+        :raises CleaningError: if SMART data could not be collected from
+                any block device
+        """
+        block_devices = self._get_hardware_snapshot().block_devices
+        results = _run_concurrently(self._collect_disk_metrics,
+                                    block_devices,
+                                    DISK_METRICS_CONCURRENCY,
+                                    timeout=DISK_METRICS_TIMEOUT)
+        metric_snapshot = self._get_metric_snapshot()
+        failed = []
+        # Sent once every device has been read, in as few packets as fit
+        to_send = collections.OrderedDict()
+        for result in results:
+            block_device = result['item']
+            if result['error'] is not None:
+                failed.append(result)
+                LOG.error('Unable to collect SMART data from %(device)s: '
+                          '%(error)s', {'device': block_device.name,
+                                        'error': result['error']})
+                continue
+            prefix, metrics_to_send = result['result']
+            if metric_snapshot is not None:
+                # Gauges lost on the way are sent at the next full refresh
+                metrics_to_send = metric_snapshot.changes(
+                    self._metric_snapshot_key(block_device), prefix,
+                    metrics_to_send)
+            to_send[prefix] = metrics_to_send
+        if metric_snapshot is not None:
+            # Disks that failed to read are kept, as they are still there
+            metric_snapshot.prune([self._metric_snapshot_key(block_device)
+                                   for block_device in block_devices])
+            metric_snapshot.save()
+
+        command_durations = self._get_executor().histogram.gauges()
+        if command_durations:
+            to_send[COMMAND_DURATIONS_PREFIX] = command_durations
+        if to_send:
+            counts = self._send_gauge_batch(to_send)
+            LOG.info('Sent %(sent)s gauges, dropped %(dropped)s', counts)
+
+        if failed:
+            raise errors.CleaningError(
+                'Collecting SMART data from {0} of {1} block devices '
+                'failed: {2}'.format(
+                    len(failed), len(results),
+                    '; '.join('{0}: {1}'.format(result['item'].name,
+                                                result['error'])
+                              for result in failed)))
+
+    def _get_metric_snapshot(self):
+        """Return the snapshot of sent SMART gauges, or None if disabled."""
+        if SMART_SNAPSHOT_PATH is None:
+            return None
+        with self._cache_lock:
+            if self._metric_snapshot is None:
+                self._metric_snapshot = snapshot.MetricSnapshot(
+                    SMART_SNAPSHOT_PATH, SMART_FULL_REFRESH_INTERVAL,
+                    SMART_COUNTERS)
+            return self._metric_snapshot
+
+    @staticmethod
+    def _disk_metrics_prefix(block_device):
+        """Return the prefix a block device's SMART gauges are sent under."""
+        return 'smartdata_{0}_{1}'.format(
+                os.path.basename(block_device.name),
+                block_device.model.replace(" ", ""))
+
+    def _metric_snapshot_key(self, block_device):
+        """Return what identifies a block device in the metric snapshot."""
+        return (block_device.serial or
+                self._disk_metrics_prefix(block_device))
+
+    def _collect_disk_metrics(self, block_device):
+        """Read SMART data for a block device.
+
+        :param block_device: a BlockDevice object
+        :return: a tuple of (gauge prefix, {metric name: value})
+        """
+        prefix = self._disk_metrics_prefix(block_device)
+        metrics_to_send = {}
+        if self._is_warpdrive(block_device):
+            wdmetrics = self._get_warpdrive_attributes(block_device)
+            for disk, stats in six.iteritems(wdmetrics):
+                for key, value in six.iteritems(stats):
+                    metrickey = disk + '.' + key
+                    metrics_to_send[metrickey] = value
+
+        else:
+            disk_metrics = self._get_smartctl_attributes(block_device)
+            for k, v in six.iteritems(disk_metrics):
+                if v.raw == 0:
+                    continue
+                metrics_to_send[k + '.VALUE'] = v.value
+                metrics_to_send[k + '.WORST'] = v.worst
+                if v.raw is not None:
+                    metrics_to_send[k + '.RAW_VALUE'] = v.raw
+
+        return prefix, metrics_to_send
 
     def _erase_lsi_warpdrive(self, block_device):
         if not self._is_warpdrive(block_device):
@@ -396,18 +1519,93 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
         # don't produce invalidly-short metrics.
         with metrics.instrument_context(__name__, 'erase_lsi_warpdrive'):
             device = self._get_warpdrive_card(block_device)
-            result = utils.execute(DDOEMCLI, '-c', device['id'], '-format',
-                    '-op', '-level', 'nom', '-s')
-            if 'WarpDrive format successfully completed.' not in result[0]:
+            output = self._format_warpdrive(device['id'])
+            if WARPDRIVE_FORMAT_SUCCESS not in output:
                 raise errors.BlockDeviceEraseError(('Erasing LSI card failed: '
-                    '{0}').format(result[0]))
+                    '{0}').format(output))
 
         return True
 
+    def _format_warpdrive(self, card_id):
+        """Format a WarpDrive card, following its progress as it goes.
+
+        The time spent in each phase and the media erase passes completed
+        are sent as gauges under warpdrive_format_<card id> as they happen.
+        ddoemcli is run on a pseudo terminal, so that its progress isn't
+        held back in a pipe buffer.
+
+        A format that prints nothing for LSI_FORMAT_STALL_TIMEOUT seconds is
+        warned about, and killed once LSI_FORMAT_STALL_WARNINGS warnings
+        have gone by without any output.
+
+        :param card_id: the controller id of the card
+        :raises BlockDeviceEraseError: if the format stalled and was killed
+        :return: everything ddoemcli printed
+        """
+        cmd = [DDOEMCLI, '-c', card_id, '-format', '-op', '-level', 'nom',
+               '-s']
+        prefix = 'warpdrive_format_{0}'.format(card_id)
+        output = []
+        phase = 'start'
+        phase_start = time.time()
+        # Warnings since ddoemcli last printed anything
+        stalls = {'count': 0}
+
+        def _on_stall(seconds):
+            stalls['count'] += 1
+            if (LSI_FORMAT_STALL_WARNINGS is not None and
+                    stalls['count'] >= LSI_FORMAT_STALL_WARNINGS):
+                # Kills ddoemcli, as the stream is abandoned
+                raise executor.StallError(
+                    '{0} wrote nothing for {1} seconds'.format(
+                        cmd[0], int(seconds)))
+            LOG.warning('WarpDrive %(id)s format has printed nothing for '
+                        '%(seconds)ds, in the %(phase)s phase; still '
+                        'waiting for it.', {'id': card_id,
+                                            'seconds': seconds,
+                                            'phase': phase})
+
+        def _chunks():
+            for chunk in self._get_executor().stream(
+                    cmd, stall_timeout=LSI_FORMAT_STALL_TIMEOUT,
+                    on_stall=_on_stall, tty=True):
+                stalls['count'] = 0
+                output.append(chunk)
+                yield chunk
+
+        try:
+            for event, value in _parse_warpdrive_format(_chunks()):
+                if event == 'phase':
+                    now = time.time()
+                    LOG.info('WarpDrive %(id)s format: %(phase)s phase took '
+                             '%(seconds).1fs', {'id': card_id, 'phase': phase,
+                                                'seconds': now - phase_start})
+                    self._send_gauges(prefix, {
+                        phase + '.seconds': round(now - phase_start, 3)})
+                    phase, phase_start = value, now
+                else:
+                    LOG.info('WarpDrive %(id)s format: media erase pass '
+                             '%(passes)s done', {'id': card_id,
+                                                 'passes': value})
+                    self._send_gauges(prefix, {'media_erase_passes': value})
+        except executor.StallError as e:
+            raise errors.BlockDeviceEraseError(
+                'WarpDrive {0} stalled in the {1} phase, after {2} seconds '
+                'in it: {3}'.format(card_id, phase,
+                                    int(time.time() - phase_start), e))
+        return ''.join(output)
+
     @metrics.instrument(__name__, 'verify_ports')
     def verify_ports(self, node, ports):
         """Given Port dicts, verify they match LLDP information
 
+        LLDP is captured from every interface at once, until every port the
+        node expects has been seen or LLDP_TIMEOUT seconds have passed. As
+        capturing stops then, other interfaces may or may not have been
+        heard from; switch ports seen on them are logged, but are not a
+        mismatch. Interfaces the node does know about must still be cabled
+        to their own switch ports.
+
         :param node: a dict representation of a Node object
         :param ports: a dict representation of Ports connected to the node
         :raises CleaningError: if any of the steps determine the node
@@ -419,21 +1617,35 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
             # with only driver_info, don't fail.
             return
 
+        def _all_seen(lldp_info):
+            seen = set()
+            for tlvs in lldp_info.values():
+                try:
+                    seen.add(self._get_port_from_lldp(tlvs))
+                except errors.CleaningError:
+                    # Reported once capturing is over
+                    pass
+            return node_switchports <= seen
+
         interface_names = [x.name for x in self.list_network_interfaces()]
-        lldp_info = netutils.get_lldp_info(interface_names)
+        lldp_info = lldp.capture(interface_names, LLDP_TIMEOUT,
+                                 done=_all_seen)
 
         # Both should be a set of tuples: (chassis, port)
-        lldp_ports = set()
-
-        for lldp in lldp_info.values():
-            lldp_ports.add(self._get_port_from_lldp(lldp))
+        lldp_ports_by_interface = dict(
+            (name, self._get_port_from_lldp(tlvs))
+            for name, tlvs in six.iteritems(lldp_info))
+        lldp_ports = set(lldp_ports_by_interface.values())
         LOG.info('LLDP ports: %s', lldp_ports)
         LOG.info('Node ports: %s', node_switchports)
-        # TODO(JoshNang) add check that ports, chassis *and* interface match
-        # when port/chassis are stored on Port objects
 
-        # Compare the ports
-        if node_switchports != lldp_ports:
+        # Compare the ports. Every port of the node must have been seen, but
+        # whether the ones it doesn't know about were depends on when
+        # capturing stopped.
+        unexpected = lldp_ports - node_switchports
+        if unexpected:
+            LOG.warning('LLDP ports not known to the node: %s', unexpected)
+        if not node_switchports <= lldp_ports:
             LOG.error('Ports did not match, LLDP: %(lldp)s, Node: %(node)s',
                       {'lldp': lldp_ports, 'node': node_switchports})
             # TODO(supermari0) The old error here - VerificationError - seems
@@ -444,20 +1656,37 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
                 'Node ports: %(node)s.' %
                 {'lldp': lldp_ports, 'node': node_switchports})
 
+        # The right ports can still be cabled to the wrong interfaces
+        miswired = []
+        for interface in self._get_node_interfaces(node).values():
+            name = interface.get('name')
+            if (name not in lldp_ports_by_interface or
+                    'switch_port_id' not in interface):
+                continue
+            expected = (interface.get('switch_chassis_id', '').lower(),
+                        interface['switch_port_id'].lower())
+            if lldp_ports_by_interface[name] != expected:
+                miswired.append('%s: LLDP %s, Node %s' % (
+                    name, lldp_ports_by_interface[name], expected))
+        if miswired:
+            LOG.error('Interfaces did not match: %s', miswired)
+            raise errors.CleaningError(
+                'Detected interface mismatches: %s.' % '; '.join(
+                    sorted(miswired)))
+
         # Return the LLDP info
         LOG.debug('Ports match, returning LLDP info: %s', lldp_info)
         # Ensure the return value is properly encode or JSON throws errors
-        return unicode(lldp_info)
+        return six.text_type(lldp_info)
 
     def _get_port_from_lldp(self, lldp_info):
         """Return a set of tuples (chassis, port) from the given LLDP info
 
-        :param lldp_info: the return from netutils.get_lldp_info()
+        :param lldp_info: the lldp.TlvIndex captured from an interface
         :return: a Set of tuples (chassis, port)
         """
-
-        tlv_port = self._get_tlv(LLDP_PORT_TYPE, lldp_info)
-        tlv_chassis = self._get_tlv(LLDP_CHASSIS_TYPE, lldp_info)
+        tlv_port = lldp_info.get(LLDP_PORT_TYPE)
+        tlv_chassis = lldp_info.get(LLDP_CHASSIS_TYPE)
 
         if len(tlv_port) != 1 or len(tlv_chassis) != 1:
             raise errors.CleaningError(
@@ -465,16 +1694,21 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
                 'chassis: %(chassis)s' %
                 {'port': tlv_port, 'chassis': tlv_chassis})
 
-        port_number = re.search(r'\d{1,2}/\d{1,2}', tlv_port[0])
+        port_number = LLDP_PORT_NUMBER_RE.search(
+            tlv_port[0].decode('utf-8', 'replace'))
+        if port_number is None:
+            raise errors.CleaningError(
+                'Malformed LLDP info. No port number in port: %s' % tlv_port)
         lldp_port = 'eth' + port_number.group()
-        return tlv_chassis[0].lower(), lldp_port.lower()
+        return (tlv_chassis[0].decode('utf-8', 'replace').lower(),
+                lldp_port.lower())
 
     def _get_node_switchports(self, node, ports):
         """Find the chassis and ports the node is attached to
 
         Return a set of tuples (chassis, port). Supports pulling them
-        from node['extra'], with support for pull chassis/port/interface from
-        port['extra'] in the future.
+        from node['extra'], for any number of interfaces, with support for
+        pull chassis/port/interface from port['extra'] in the future.
 
         :param node: a dict representation of a Node object
         :param ports: a dict representation of Ports connected to the node
@@ -483,42 +1717,46 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
         if not node.get('extra'):
             return set()
         LOG.info('Matching against node ports: %s', node.get('extra'))
-        try:
-            return set([
-                (node['extra']['hardware/interfaces/0/'
-                               'switch_chassis_id'].lower(),
-                 node['extra']['hardware/interfaces/0/'
-                               'switch_port_id'].lower()),
-                (node['extra']['hardware/interfaces/1/'
-                               'switch_chassis_id'].lower(),
-                 node['extra']['hardware/interfaces/1/'
-                               'switch_port_id'].lower())
-            ])
-        except KeyError:
+        switchports = set()
+        interfaces = self._get_node_interfaces(node)
+        for index in sorted(interfaces):
+            chassis = interfaces[index].get('switch_chassis_id')
+            port = interfaces[index].get('switch_port_id')
+            if chassis is None and port is None:
+                # Not cabled to a switch we know about
+                continue
+            if chassis is None or port is None:
+                raise errors.CleaningError(
+                    'Node has malformed extra data, could not find chassis'
+                    ' and port for interface %s: %s' % (index, node['extra']))
+            switchports.add((chassis.lower(), port.lower()))
+        if not switchports:
             raise errors.CleaningError(
                 'Node has malformed extra data, could not find chassis'
                 ' and port: %s' % node['extra'])
+        return switchports
 
-    def _get_tlv(self, tlv_type, lldp_info):
-        """Return all LLDP values that match a TLV type (an int) as a list."""
-        # Use a list because TLV type 127 may be be used multiple times in LLDP
-        values = []
-        for tlv in lldp_info:
-            if len(tlv) != 2:
-                raise errors.CleaningError('Malformed LLDP info %s'
-                                               % lldp_info)
-            if tlv[0] == tlv_type:
-                values.append(tlv[1])
-        return values
+    def _get_node_interfaces(self, node):
+        """Collect the hardware/interfaces/<n>/ keys of node['extra']
+
+        :param node: a dict representation of a Node object
+        :return: a dict of {interface index: {field: value}}, where fields
+                 are the rest of the key, such as 'name',
+                 'switch_chassis_id' and 'switch_port_id'
+        """
+        interfaces = {}
+        for key, value in six.iteritems(node.get('extra') or {}):
+            match = NODE_INTERFACE_KEY_RE.match(key)
+            if match:
+                interfaces.setdefault(int(match.group(1)),
+                                      {})[match.group(2)] = value
+        return interfaces
 
     def _get_flavor_from_node(self, node):
         ram = node['properties']['memory_mb']
-        if ram == (1024 * 32):
-            return 'onmetal-compute1'
-        if ram == (1024 * 128):
-            return 'onmetal-io1'
-        if ram == (1024 * 512):
-            return 'onmetal-memory1'
+        for flavor, memory_mb in six.iteritems(FLAVOR_MEMORY_MB):
+            if ram == memory_mb:
+                return flavor
         raise errors.CleaningError('unknown flavor')
 
     def _verify_blockdevice_count(self, block_devices, model, count):
@@ -530,7 +1768,12 @@ class OnMetalHardwareManager(hardware.GenericHardwareManager):
     @metrics.instrument(__name__, 'verify_hardware')
     def verify_hardware(self, node, ports):
         flavor = self._get_flavor_from_node(node)
-        block_devices = self.list_block_devices()
+        detected_flavor = self._get_detected_flavor()
+        if detected_flavor is not None and detected_flavor != flavor:
+            raise errors.CleaningError(
+                'Node is registered as {0}, but has the memory of '
+                '{1}'.format(flavor, detected_flavor))
+        block_devices = self._get_hardware_snapshot().block_devices
 
         if flavor == 'onmetal-io1':
             # verify it has two IO cards
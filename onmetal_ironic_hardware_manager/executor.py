@@ -0,0 +1,387 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import codecs
+import contextlib
+import errno
+import os
+import pty
+import subprocess
+import termios
+import threading
+import time
+
+import six
+
+from oslo_concurrency import processutils
+from oslo_log import log
+
+LOG = log.getLogger()
+
+# Bytes read from a streamed command at a time. Whatever has been written
+# is returned straight away, so a partial line still counts as output.
+STREAM_CHUNK_SIZE = 4096
+# Upper bounds, in seconds, of the buckets command durations are counted in.
+# Anything slower is only counted in the total.
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 1800, 7200)
+
+
+class StallError(Exception):
+    """A streamed command wrote nothing for longer than its stall timeout."""
+
+
+class CommandTimeout(Exception):
+    """A command ran for longer than its timeout, and was killed."""
+
+
+def command_name(path):
+    """Return the name commands run from path are limited and counted by.
+
+    :param path: the command, with or without its directory
+    :return: the command's file name, with dots replaced so that it can be
+             used in a metric name
+    """
+    return os.path.basename(path).replace('.', '_')
+
+
+class DurationHistogram(object):
+    """How long each command took, counted in cumulative buckets.
+
+    Safe to update from several threads at once.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._commands = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        """Count a call of a command.
+
+        :param name: the command name, from command_name
+        :param seconds: how long the call took
+        """
+        with self._lock:
+            entry = self._commands.get(name)
+            if entry is None:
+                entry = {'count': 0, 'sum': 0.0,
+                         'buckets': [0] * len(self._buckets)}
+                self._commands[name] = entry
+            entry['count'] += 1
+            entry['sum'] += seconds
+            for idx, bound in enumerate(self._buckets):
+                if seconds <= bound:
+                    entry['buckets'][idx] += 1
+
+    def snapshot(self):
+        """Return the counts so far.
+
+        :return: a dict of {command name: {'count': calls,
+                                           'sum': total seconds,
+                                           'buckets': [(upper bound,
+                                                        calls that took at
+                                                        most that long)]}}
+        """
+        with self._lock:
+            return dict((name, {'count': entry['count'],
+                                'sum': entry['sum'],
+                                'buckets': list(zip(self._buckets,
+                                                    entry['buckets']))})
+                        for name, entry in six.iteritems(self._commands))
+
+    def gauges(self):
+        """Return the counts so far as gauges, for _send_gauges.
+
+        :return: a dict of {'<command>.count': calls,
+                            '<command>.sum': total seconds,
+                            '<command>.le_<bound>': calls that took at most
+                                                    bound seconds}
+        """
+        metrics = {}
+        for name, entry in six.iteritems(self.snapshot()):
+            metrics[name + '.count'] = entry['count']
+            metrics[name + '.sum'] = round(entry['sum'], 3)
+            for bound, count in entry['buckets']:
+                bound = str(bound).replace('.', '_')
+                metrics['{0}.le_{1}'.format(name, bound)] = count
+        return metrics
+
+
+class Executor(object):
+    """Runs vendor commands, limiting how many of each run at once.
+
+    Every call is counted in a DurationHistogram, which is shared by all
+    the clean steps using the executor. That lets steps run their own work
+    concurrently without together running more of a command than the
+    hardware behind it copes with.
+    """
+
+    def __init__(self, execute, limits=None, timeouts=None):
+        """Create an executor.
+
+        :param execute: the function running commands, such as
+                        utils.execute. It is passed on_execute and
+                        on_completion callbacks for commands with a
+                        timeout, as processutils.execute accepts.
+        :param limits: a dict of {command name: the most calls of it that
+                       may run at once}. Commands not listed are unlimited.
+        :param timeouts: a dict of {command name: seconds a call may run
+                         for before it is killed}, for calls that don't
+                         give their own
+        """
+        self._execute = execute
+        self._limits = dict(limits or {})
+        self._timeouts = dict(timeouts or {})
+        self._slots = {}
+        self._slots_lock = threading.Lock()
+        self.histogram = DurationHistogram()
+
+    def execute(self, *cmd, **kwargs):
+        """Run a command, waiting for a free slot first if it is limited.
+
+        :param cmd: the command and its arguments
+        :param timeout: seconds the command may run for before it is killed,
+                        overriding the executor's timeout for it. None
+                        waits forever.
+        :param kwargs: passed on to the execute function
+        :raises CommandTimeout: if the command was killed for running too
+                                long
+        :return: a (stdout, stderr) tuple
+        """
+        name = command_name(cmd[0])
+        timeout = kwargs.pop('timeout', self._timeouts.get(name))
+        with self._timed(name):
+            if timeout is None:
+                stdout, stderr = self._execute(*cmd, **kwargs)
+            else:
+                stdout, stderr = self._execute_with_timeout(cmd, timeout,
+                                                            kwargs)
+        if stderr:
+            LOG.debug('%(cmd)s wrote to stderr: %(stderr)s',
+                      {'cmd': ' '.join(cmd), 'stderr': stderr})
+        return stdout, stderr
+
+    def stream(self, cmd, stall_timeout=None, on_stall=None, tty=False):
+        """Run a command like the module's stream, in one of its slots.
+
+        The slot is held until the output has been read to the end, or the
+        caller stops reading it.
+
+        :param cmd: the command and its arguments, as a list
+        :param stall_timeout: seconds the command may go without writing
+                              anything, or None to wait forever
+        :param on_stall: called instead of killing a stalled command, as
+                         for the module's stream
+        :param tty: whether the command writes to a pseudo terminal
+        :return: a generator of output chunks, as text
+        """
+        with self._timed(command_name(cmd[0])):
+            output = stream(cmd, stall_timeout=stall_timeout,
+                            on_stall=on_stall, tty=tty)
+            try:
+                for chunk in output:
+                    yield chunk
+            finally:
+                # Kills the command straight away if the caller gave up
+                output.close()
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        with self._slot(name):
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.histogram.observe(name, time.time() - start)
+
+    def _slot(self, name):
+        limit = self._limits.get(name)
+        if limit is None:
+            return _NO_SLOT
+        with self._slots_lock:
+            if name not in self._slots:
+                self._slots[name] = threading.Semaphore(max(1, limit))
+            return self._slots[name]
+
+    def _execute_with_timeout(self, cmd, timeout, kwargs):
+        timers = []
+        killed = threading.Event()
+
+        def _kill(process):
+            killed.set()
+            LOG.warning('Killing %(cmd)s after %(timeout)s seconds',
+                        {'cmd': ' '.join(cmd), 'timeout': timeout})
+            try:
+                process.kill()
+            except OSError:
+                # It exited in the meantime
+                pass
+
+        def _on_execute(process):
+            timer = threading.Timer(timeout, _kill, (process,))
+            timer.daemon = True
+            timers.append(timer)
+            timer.start()
+
+        def _on_completion(process):
+            for timer in timers:
+                timer.cancel()
+
+        try:
+            result = self._execute(*cmd, on_execute=_on_execute,
+                                   on_completion=_on_completion, **kwargs)
+        except processutils.ProcessExecutionError as e:
+            if not killed.is_set():
+                raise
+            result = (e.stdout, e.stderr)
+        finally:
+            _on_completion(None)
+        if killed.is_set():
+            raise CommandTimeout('{0} was killed after {1} seconds: '
+                                 '{2}'.format(' '.join(cmd), timeout,
+                                              result[1]))
+        return result
+
+
+class _NoSlot(object):
+    """Stands in for a semaphore, for commands without a limit."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SLOT = _NoSlot()
+
+
+def _open_tty():
+    """Open a pseudo terminal that leaves newlines as they are written.
+
+    :return: a tuple of (master fd, slave fd)
+    """
+    master, slave = pty.openpty()
+    try:
+        # Otherwise every '\n' written comes out of the master as '\r\n'
+        attrs = termios.tcgetattr(slave)
+        attrs[1] &= ~termios.ONLCR
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    except Exception:
+        os.close(master)
+        os.close(slave)
+        raise
+    return master, slave
+
+
+def stream(cmd, stall_timeout=None, on_stall=None, tty=False):
+    """Run a command, yielding its output as it is written.
+
+    stdout and stderr are merged. If the command writes nothing for
+    stall_timeout seconds it is killed, unless on_stall is given, in which
+    case on_stall is called with the seconds since it last wrote and it is
+    left running. The command is also killed if the caller stops iterating
+    before it exits.
+
+    Most programs buffer what they write to a pipe, so their output only
+    arrives in blocks of several KiB. With tty, the command writes to a
+    pseudo terminal instead, which they write to a line at a time.
+
+    :param cmd: the command and its arguments, as a list
+    :param stall_timeout: seconds the command may go without writing
+                          anything, or None to wait forever
+    :param on_stall: a callable taking the seconds since the command last
+                     wrote, called every stall_timeout seconds it stays
+                     quiet
+    :param tty: whether the command writes to a pseudo terminal rather
+                than a pipe
+    :raises StallError: if the command stalled, and on_stall wasn't given
+    :raises ProcessExecutionError: if the command exited non-zero
+    :return: a generator of output chunks, as text
+    """
+    LOG.debug('Streaming command: %s', ' '.join(cmd))
+    if tty:
+        fd, slave = _open_tty()
+        try:
+            process = subprocess.Popen(cmd, stdout=slave, stderr=slave,
+                                       close_fds=True)
+        except Exception:
+            os.close(fd)
+            raise
+        finally:
+            # Only the command holds the terminal open, so reading it ends
+            # once the command exits
+            os.close(slave)
+    else:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, close_fds=True)
+        fd = process.stdout.fileno()
+    chunks = six.moves.queue.Queue()
+
+    def _read():
+        try:
+            while True:
+                try:
+                    chunk = os.read(fd, STREAM_CHUNK_SIZE)
+                except OSError as e:
+                    # A pseudo terminal with nothing left to read and no
+                    # one writing to it fails rather than returning ''
+                    if not tty or e.errno != errno.EIO:
+                        raise
+                    break
+                if not chunk:
+                    break
+                chunks.put(chunk)
+        finally:
+            if tty:
+                os.close(fd)
+            else:
+                process.stdout.close()
+            chunks.put(None)
+
+    reader = threading.Thread(target=_read)
+    reader.daemon = True
+    reader.start()
+
+    # A chunk may end part way through a multi-byte character
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    output = []
+    last_output = time.time()
+    try:
+        while True:
+            try:
+                chunk = chunks.get(timeout=stall_timeout)
+            except six.moves.queue.Empty:
+                if on_stall is None:
+                    raise StallError(
+                        '{0} wrote nothing for {1} seconds'.format(
+                            cmd[0], stall_timeout))
+                on_stall(time.time() - last_output)
+                continue
+            if chunk is None:
+                break
+            last_output = time.time()
+            chunk = decoder.decode(chunk)
+            if chunk:
+                output.append(chunk)
+                yield chunk
+        returncode = process.wait()
+        if returncode != 0:
+            raise processutils.ProcessExecutionError(
+                stdout=''.join(output), exit_code=returncode,
+                cmd=' '.join(cmd))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
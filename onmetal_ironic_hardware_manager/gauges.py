@@ -0,0 +1,186 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import socket
+
+import six
+
+from oslo_log import log
+
+LOG = log.getLogger()
+
+# The largest statsd packet that fits in a standard 1500 byte Ethernet frame
+# once IP and UDP headers are taken off.
+DEFAULT_PACKET_SIZE = 1432
+
+
+class GaugeBatch(object):
+    """Buffers gauges per prefix and sends them in as few emits as possible.
+
+    On flush, the gauges for each prefix are sent, in order of preference:
+
+    - in a single call to the metrics logger's send_gauges method, if the
+      backend has one
+    - as statsd packets of at most packet_size bytes, if a statsd address
+      was given. Gauges are named as the metrics logger would name them, so
+      they carry the agent's global prefix and host either way.
+    - one logger.gauge call per gauge otherwise
+
+    Gauges whose value isn't a number, or that can't be sent, are dropped
+    and counted rather than raising.
+    """
+
+    def __init__(self, get_logger, statsd_address=None,
+                 packet_size=DEFAULT_PACKET_SIZE):
+        """Create an empty batch.
+
+        :param get_logger: a callable returning the metrics logger for a
+                           prefix, such as metrics.getLogger
+        :param statsd_address: a (host, port) tuple to send statsd packets
+                               to, or None to send through the logger
+        :param packet_size: the largest statsd packet to send, in bytes
+        """
+        self._get_logger = get_logger
+        self._statsd_address = statsd_address
+        self._packet_size = packet_size
+        self._buffer = collections.OrderedDict()
+
+    def add(self, prefix, metrics_to_send):
+        """Buffer gauges until the next flush.
+
+        :param prefix: the prefix given to the metrics logger
+        :param metrics_to_send: dict in the format {'key': 'value'} where
+                                key is the metric name and value is the
+                                metric
+        """
+        self._buffer.setdefault(prefix, {}).update(metrics_to_send)
+
+    def flush(self):
+        """Send every buffered gauge and empty the buffer.
+
+        :return: a dict of the form {'sent': number of gauges sent,
+                                     'dropped': number of gauges dropped}
+        """
+        counts = {'sent': 0, 'dropped': 0}
+        buffered, self._buffer = self._buffer, collections.OrderedDict()
+
+        lines = []
+        for prefix, metrics_to_send in six.iteritems(buffered):
+            gauges = {}
+            for name, value in six.iteritems(metrics_to_send):
+                if _is_number(value):
+                    gauges[name] = value
+                else:
+                    LOG.debug('Dropping non-numeric gauge %(prefix)s.%(name)s'
+                              ': %(value)r', {'prefix': prefix, 'name': name,
+                                              'value': value})
+                    counts['dropped'] += 1
+
+            if self._statsd_address is not None:
+                metric_name = self._metric_namer(prefix)
+                lines.extend('{0}:{1}|g'.format(metric_name(name), value)
+                             for name, value in six.iteritems(gauges))
+            else:
+                self._send_to_logger(prefix, gauges, counts)
+
+        if lines:
+            self._send_packets(lines, counts)
+        return counts
+
+    def _metric_namer(self, prefix):
+        """Return a function giving the full name of a gauge under prefix.
+
+        The metrics logger's own naming is used where it has one, as it
+        adds the global prefix and host the agent is configured with.
+        """
+        get_metric_name = getattr(self._get_logger(prefix),
+                                  'get_metric_name', None)
+        if get_metric_name is None:
+            return lambda name: '{0}.{1}'.format(prefix, name)
+        return get_metric_name
+
+    def _send_to_logger(self, prefix, gauges, counts):
+        logger = self._get_logger(prefix)
+        send_gauges = getattr(logger, 'send_gauges', None)
+        if send_gauges is not None:
+            try:
+                send_gauges(gauges)
+            except Exception:
+                LOG.exception('Unable to send gauges for %s', prefix)
+                counts['dropped'] += len(gauges)
+            else:
+                counts['sent'] += len(gauges)
+            return
+
+        for name, value in six.iteritems(gauges):
+            try:
+                logger.gauge(name, value)
+            except Exception:
+                LOG.exception('Unable to send gauge %(prefix)s.%(name)s',
+                              {'prefix': prefix, 'name': name})
+                counts['dropped'] += 1
+            else:
+                counts['sent'] += 1
+
+    def _send_packets(self, lines, counts):
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            self._statsd_address[0], self._statsd_address[1], 0,
+            socket.SOCK_DGRAM)[0]
+        sock = socket.socket(family, socktype, proto)
+        try:
+            for packet, count in self._packets(lines, counts):
+                try:
+                    sock.sendto(packet, address)
+                except socket.error as e:
+                    LOG.error('Unable to send %(count)s gauges to statsd: '
+                              '%(error)s', {'count': count, 'error': e})
+                    counts['dropped'] += count
+                else:
+                    counts['sent'] += count
+        finally:
+            sock.close()
+
+    def _packets(self, lines, counts):
+        """Pack newline separated lines into packets of at most packet_size.
+
+        :return: a generator of (packet bytes, number of gauges in it)
+        """
+        packet = []
+        size = 0
+        for line in lines:
+            line = line.encode('utf-8')
+            if len(line) > self._packet_size:
+                LOG.debug('Dropping gauge larger than a packet: %r', line)
+                counts['dropped'] += 1
+                continue
+            # Every line after the first costs an extra byte for the newline
+            if packet and size + 1 + len(line) > self._packet_size:
+                yield b'\n'.join(packet), len(packet)
+                packet = []
+                size = 0
+            size += len(line) + (1 if packet else 0)
+            packet.append(line)
+        if packet:
+            yield b'\n'.join(packet), len(packet)
+
+
+def _is_number(value):
+    if isinstance(value, bool):
+        return False
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
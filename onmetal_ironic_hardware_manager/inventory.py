@@ -0,0 +1,141 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+
+class BlockDeviceRecord(object):
+    """What the clean steps need to know about a block device.
+
+    The BlockDevice it was made from is kept as device, for anything that
+    hands it back to the generic hardware manager.
+    """
+
+    __slots__ = ('name', 'model', 'size', 'rotational', 'serial', 'device')
+
+    def __init__(self, device):
+        """Record a block device.
+
+        :param device: a hardware.BlockDevice
+        """
+        self.name = device.name
+        self.model = device.model
+        self.size = device.size
+        self.rotational = device.rotational
+        self.serial = getattr(device, 'serial', None)
+        self.device = device
+
+    def __repr__(self):
+        return '<BlockDeviceRecord {0} {1!r} {2}>'.format(
+            self.name, self.model, self.size)
+
+
+class HardwareSnapshot(object):
+    """The hardware enumerated once, and shared by every clean step."""
+
+    __slots__ = ('block_devices', 'taken_at')
+
+    def __init__(self, block_devices, now=None):
+        """Take a snapshot.
+
+        :param block_devices: a list of hardware.BlockDevice
+        :param now: when the snapshot was taken, defaults to time.time()
+        """
+        self.block_devices = tuple(BlockDeviceRecord(device)
+                                   for device in block_devices)
+        self.taken_at = time.time() if now is None else now
+
+
+class HardwareProfile(object):
+    """What the machine is, as read from /sys and /proc."""
+
+    __slots__ = ('sys_vendor', 'product_name', 'pci_ids', 'memory_kb')
+
+    def __init__(self, sys_vendor, product_name, pci_ids, memory_kb):
+        """Describe a machine.
+
+        :param sys_vendor: the DMI system vendor, or None
+        :param product_name: the DMI product name, or None
+        :param pci_ids: a tuple of (vendor ID, device ID) ints, one per PCI
+                        function
+        :param memory_kb: MemTotal from /proc/meminfo, in kB, or None
+        """
+        self.sys_vendor = sys_vendor
+        self.product_name = product_name
+        self.pci_ids = pci_ids
+        self.memory_kb = memory_kb
+
+    def count_pci_devices(self, ids):
+        """Count the PCI functions with any of the given IDs.
+
+        :param ids: a collection of (vendor ID, device ID) ints
+        :return: the number of matching functions
+        """
+        return len([pci_id for pci_id in self.pci_ids if pci_id in ids])
+
+    def __repr__(self):
+        return ('<HardwareProfile {0!r} {1!r}, {2} PCI functions, '
+                '{3} kB>'.format(self.sys_vendor, self.product_name,
+                                 len(self.pci_ids), self.memory_kb))
+
+
+def _read_first_line(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def _read_memory_kb(meminfo_path):
+    try:
+        with open(meminfo_path, 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def detect(sys_path='/sys', meminfo_path='/proc/meminfo'):
+    """Read what the machine is, without running anything.
+
+    Only a few small files are read, so this takes milliseconds. Anything
+    that can't be read is left as None, or left out.
+
+    :param sys_path: where sysfs is mounted
+    :param meminfo_path: the path of /proc/meminfo
+    :return: a HardwareProfile
+    """
+    dmi_path = os.path.join(sys_path, 'class', 'dmi', 'id')
+    pci_path = os.path.join(sys_path, 'bus', 'pci', 'devices')
+    pci_ids = []
+    try:
+        functions = sorted(os.listdir(pci_path))
+    except (IOError, OSError):
+        functions = []
+    for function in functions:
+        vendor = _read_first_line(os.path.join(pci_path, function, 'vendor'))
+        device = _read_first_line(os.path.join(pci_path, function, 'device'))
+        try:
+            pci_ids.append((int(vendor, 16), int(device, 16)))
+        except (TypeError, ValueError):
+            continue
+    return HardwareProfile(
+        _read_first_line(os.path.join(dmi_path, 'sys_vendor')),
+        _read_first_line(os.path.join(dmi_path, 'product_name')),
+        tuple(pci_ids),
+        _read_memory_kb(meminfo_path))
@@ -0,0 +1,223 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import errno
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+
+import six
+
+from oslo_log import log
+
+from onmetal_ironic_hardware_manager import jsonfile
+
+LOG = log.getLogger()
+
+# Where the kernel exposes EFI variables. A journal kept here is stored in
+# the firmware's NVRAM, so it survives reboots and erasing the disks.
+EFIVARS_DIR = '/sys/firmware/efi/efivars'
+# Non-volatile, and readable both at boot and at run time
+EFI_VARIABLE_ATTRIBUTES = 0x7
+# Every file in EFIVARS_DIR starts with the variable's attributes
+EFI_VARIABLE_HEADER = struct.Struct('<I')
+# The kernel makes most files in EFIVARS_DIR immutable, which has to be
+# cleared before they can be written. The ioctls are defined as taking a
+# long, but pass an int.
+FS_IMMUTABLE_FL = 0x10
+FS_IOC_GETFLAGS = 2 << 30 | struct.calcsize('l') << 16 | ord('f') << 8 | 1
+FS_IOC_SETFLAGS = 1 << 30 | struct.calcsize('l') << 16 | ord('f') << 8 | 2
+
+
+def is_efi_variable(path):
+    """Whether path is a variable in EFIVARS_DIR rather than a plain file."""
+    return (os.path.dirname(os.path.abspath(path)) ==
+            os.path.abspath(EFIVARS_DIR))
+
+
+def read_efi_variable(path):
+    """Read the value of an EFI variable, without its attributes.
+
+    :param path: the variable's file in EFIVARS_DIR, <name>-<vendor GUID>
+    :raises: IOError or OSError if the variable can't be read
+    :return: the value, as bytes
+    """
+    with open(path, 'rb') as f:
+        return f.read()[EFI_VARIABLE_HEADER.size:]
+
+
+def write_efi_variable(path, value):
+    """Set an EFI variable, creating it if needed.
+
+    efivarfs can't rename files, so unlike jsonfile.write_json this writes
+    the variable in place. The firmware replaces the whole value at once,
+    so a reader still never sees it partly written.
+
+    :param path: the variable's file in EFIVARS_DIR, <name>-<vendor GUID>
+    :param value: the value, as bytes
+    :raises: IOError or OSError if the variable can't be written
+    """
+    if os.path.exists(path):
+        _make_mutable(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, EFI_VARIABLE_HEADER.pack(EFI_VARIABLE_ATTRIBUTES) +
+                 value)
+    finally:
+        os.close(fd)
+
+
+def _make_mutable(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        flags = array.array('i', [0])
+        try:
+            fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags, True)
+        except (IOError, OSError) as e:
+            # Filesystems without inode flags have nothing to clear
+            if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP):
+                return
+            raise
+        if flags[0] & FS_IMMUTABLE_FL:
+            flags[0] &= ~FS_IMMUTABLE_FL
+            fcntl.ioctl(fd, FS_IOC_SETFLAGS, flags)
+    finally:
+        os.close(fd)
+
+
+class StepJournal(object):
+    """The clean steps each node has finished, kept as a small JSON document.
+
+    It is kept in an EFI variable when its path is in EFIVARS_DIR, and in a
+    plain file otherwise. It holds one entry per node and step:
+
+        {node uuid: {step: {'digest': hash of what the step was given,
+                            'boot_id': the boot it finished in, or None,
+                            'time': when it finished}}}
+
+    A step is only taken as done if it finished with the same digest within
+    max_age seconds, so a journal left over from an earlier cleaning is
+    ignored. It is for steps whose result the hardware can't always
+    confirm, such as BIOS changes that only show after a reboot; nothing
+    that erases data may be skipped because of it. A journal that can't
+    be read counts as empty, and one that can't be written is still kept
+    in memory for the life of the agent.
+    """
+
+    def __init__(self, path, max_age):
+        """Create a journal backed by a file, which is read when first used.
+
+        :param path: the JSON file or EFI variable to keep the journal in
+        :param max_age: seconds after which an entry no longer counts
+        """
+        self._path = path
+        self._max_age = max_age
+        self._efi_variable = is_efi_variable(path)
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def is_done(self, node_uuid, step, digest, boot_id=None, now=None):
+        """Whether a step already finished on a node, given the same input.
+
+        :param node_uuid: the node's UUID
+        :param step: the clean step name
+        :param digest: the hash of what the step was given
+        :param boot_id: the current boot, or None if unknown. A step recorded
+                        with a boot only counts in that boot.
+        :param now: the current time in seconds since the epoch, defaults to
+                    time.time()
+        :return: True if the step can be skipped
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._load().get(node_uuid, {}).get(step)
+        if entry is None or entry['digest'] != digest:
+            return False
+        if entry.get('boot_id') not in (None, boot_id):
+            return False
+        # A clock that went backwards doesn't count as recent either
+        return 0 <= now - entry['time'] < self._max_age
+
+    def record(self, node_uuid, step, digest, boot_id=None, now=None):
+        """Record that a step finished, and write the journal straight away.
+
+        Entries older than max_age are dropped at the same time. A step
+        already recorded with the same digest and boot is left as it is,
+        and the journal isn't written again, to spare the NVRAM an EFI
+        variable is kept in.
+
+        :param node_uuid: the node's UUID
+        :param step: the clean step name
+        :param digest: the hash of what the step was given
+        :param boot_id: the boot the step finished in, or None
+        :param now: the current time in seconds since the epoch, defaults to
+                    time.time()
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entries = self._load()
+            changed = False
+            for steps in six.itervalues(entries):
+                for name, entry in list(steps.items()):
+                    if not 0 <= now - entry['time'] < self._max_age:
+                        del steps[name]
+                        changed = True
+            previous = entries.get(node_uuid, {}).get(step)
+            if (previous is None or previous['digest'] != digest or
+                    previous.get('boot_id') != boot_id):
+                entries.setdefault(node_uuid, {})[step] = {
+                    'digest': digest, 'boot_id': boot_id, 'time': now}
+                changed = True
+            for uuid in [uuid for uuid, steps in six.iteritems(entries)
+                         if not steps]:
+                del entries[uuid]
+            if changed:
+                self._save()
+
+    def forget(self, node_uuid, steps):
+        """Forget steps, so they run again even with the same input.
+
+        :param node_uuid: the node's UUID
+        :param steps: the clean step names
+        """
+        with self._lock:
+            node_steps = self._load().get(node_uuid, {})
+            if any(step in node_steps for step in steps):
+                for step in steps:
+                    node_steps.pop(step, None)
+                self._save()
+
+    def _save(self):
+        try:
+            if self._efi_variable:
+                write_efi_variable(self._path, json.dumps(
+                    self._entries, separators=(',', ':')).encode('utf-8'))
+            else:
+                jsonfile.write_json(self._path, self._entries)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to save clean step journal to %(path)s: '
+                        '%(error)s', {'path': self._path, 'error': e})
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = jsonfile.read_json(
+                self._path, 'clean step journal',
+                read=read_efi_variable if self._efi_variable else None)
+        return self._entries
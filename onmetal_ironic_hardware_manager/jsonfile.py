@@ -0,0 +1,74 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import json
+import os
+import tempfile
+
+from oslo_log import log
+
+LOG = log.getLogger()
+
+
+def read_json(path, description, read=None):
+    """Read a small JSON document the agent keeps between runs.
+
+    A document that is missing, can't be read or is corrupt is read as
+    empty, so whatever it remembered is simply done again.
+
+    :param path: the file to read
+    :param description: what the document is, for log messages
+    :param read: a callable taking path and returning the document as
+                 bytes, for documents not kept in a plain file
+    :return: the parsed document, or {} if it couldn't be read
+    """
+    try:
+        if read is not None:
+            return json.loads(read(path).decode('utf-8'))
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            LOG.warning('Unable to read %(description)s from %(path)s: '
+                        '%(error)s', {'description': description,
+                                      'path': path, 'error': e})
+    except ValueError as e:
+        LOG.warning('Ignoring corrupt %(description)s %(path)s: %(error)s',
+                    {'description': description, 'path': path, 'error': e})
+    return {}
+
+
+def write_json(path, data):
+    """Write data to a JSON file, replacing it atomically.
+
+    The directory is created if needed, and a reader never sees a partly
+    written file.
+
+    :param path: the file to write
+    :param data: anything json.dump can serialize
+    :raises: IOError or OSError if the file can't be written
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or None,
+                                    prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
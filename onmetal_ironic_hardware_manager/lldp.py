@@ -0,0 +1,205 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import select
+import socket
+import struct
+import time
+
+import six
+
+from oslo_log import log
+
+LOG = log.getLogger()
+
+LLDP_ETHERTYPE = 0x88cc
+# Nearest-bridge address LLDP frames are sent to
+LLDP_MULTICAST_ADDRESS = b'\x01\x80\xc2\x00\x00\x0e'
+# Large enough for any frame on a standard MTU link
+LLDP_FRAME_SIZE = 1518
+ETHERNET_HEADER_SIZE = 14
+TLV_HEADER = struct.Struct('!H')
+TLV_END = 0
+
+# From linux/if_packet.h and linux/sockios.h
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_MULTICAST = 0
+SIOCGIFINDEX = 0x8933
+
+
+class TlvIndex(object):
+    """The TLVs of an LLDP frame, indexed by type.
+
+    Values are kept as memoryview slices of the frame, and only copied out
+    when asked for.
+    """
+
+    def __init__(self):
+        self._index = {}
+
+    def add(self, tlv_type, value):
+        """Add a TLV.
+
+        :param tlv_type: the TLV type
+        :param value: the TLV value, as bytes or a memoryview
+        """
+        self._index.setdefault(tlv_type, []).append(memoryview(value))
+
+    def get(self, tlv_type):
+        """Return the values of every TLV of a type, in the order they were
+        sent. Types such as 127 may appear more than once.
+
+        :param tlv_type: the TLV type
+        :return: a list of values, as bytes
+        """
+        return [value.tobytes() for value in self._index.get(tlv_type, ())]
+
+    def types(self):
+        """Return the TLV types in the frame, in ascending order."""
+        return sorted(self._index)
+
+    def __eq__(self, other):
+        if not isinstance(other, TlvIndex):
+            return NotImplemented
+        return (self.types() == other.types() and
+                all(self.get(t) == other.get(t) for t in self.types()))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict((tlv_type, self.get(tlv_type))
+                         for tlv_type in self.types()))
+
+
+def parse_frame(frame):
+    """Index the TLVs of an LLDP frame by type, in a single pass.
+
+    :param frame: the frame as received, starting with its Ethernet header
+    :raises ValueError: if the frame is truncated
+    :return: a TlvIndex, without the End of LLDPDU TLV
+    """
+    view = memoryview(frame)
+    tlvs = TlvIndex()
+    offset = ETHERNET_HEADER_SIZE
+    while offset + TLV_HEADER.size <= len(frame):
+        header, = TLV_HEADER.unpack_from(frame, offset)
+        tlv_type, length = header >> 9, header & 0x1ff
+        offset += TLV_HEADER.size
+        if tlv_type == TLV_END:
+            return tlvs
+        if offset + length > len(frame):
+            raise ValueError('LLDP TLV of type {0} runs past the end of the '
+                             'frame'.format(tlv_type))
+        tlvs.add(tlv_type, view[offset:offset + length])
+        offset += length
+    raise ValueError('LLDP frame has no End of LLDPDU TLV')
+
+
+def capture(interface_names, timeout, done=None, open_socket=None):
+    """Capture an LLDP frame from every interface, listening on all at once.
+
+    Each interface is listened on until a frame arrives on it, until
+    timeout seconds have passed, or until done returns True, whichever
+    comes first. Frames that can't be parsed are ignored, and interfaces
+    that can't be listened on or read from are logged and left out.
+
+    :param interface_names: the interfaces to listen on
+    :param timeout: the most seconds to listen for
+    :param done: an optional callable taking the LLDP info captured so far,
+                 in the form returned, and returning True once nothing more
+                 is needed. Called each time a frame is captured.
+    :param open_socket: a callable taking an interface name and returning a
+                        socket receiving its LLDP frames, for testing.
+                        Defaults to open_lldp_socket.
+    :return: a dict of {interface name: TlvIndex}, for every interface a
+             frame was captured from
+    """
+    open_socket = open_socket or open_lldp_socket
+    listening = {}
+    lldp_info = {}
+    try:
+        for name in interface_names:
+            try:
+                listening[open_socket(name)] = name
+            except (IOError, OSError, socket.error) as e:
+                LOG.warning('Unable to listen for LLDP on %(interface)s: '
+                            '%(error)s', {'interface': name, 'error': e})
+
+        deadline = time.time() + timeout
+        while listening:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                LOG.warning('No LLDP frame captured from %(interfaces)s '
+                            'within %(timeout)s seconds',
+                            {'interfaces': sorted(listening.values()),
+                             'timeout': timeout})
+                break
+            readable = select.select(list(listening), [], [], remaining)[0]
+            for sock in readable:
+                try:
+                    frame = sock.recv(LLDP_FRAME_SIZE)
+                except (IOError, OSError, socket.error) as e:
+                    # e.g. the interface went down; the others are still
+                    # listened on
+                    LOG.warning('Unable to capture LLDP from %(interface)s: '
+                                '%(error)s', {'interface': listening.pop(sock),
+                                              'error': e})
+                    sock.close()
+                    continue
+                try:
+                    tlvs = parse_frame(frame)
+                except ValueError as e:
+                    LOG.debug('Ignoring LLDP frame from %(interface)s: '
+                              '%(error)s', {'interface': listening[sock],
+                                            'error': e})
+                    continue
+                lldp_info[listening.pop(sock)] = tlvs
+                sock.close()
+            if readable and done is not None and done(lldp_info):
+                break
+        return lldp_info
+    finally:
+        for sock in listening:
+            sock.close()
+
+
+def open_lldp_socket(interface_name):
+    """Open a raw socket receiving the LLDP frames sent to an interface.
+
+    The interface joins the LLDP multicast group for as long as the socket
+    is open, so it doesn't need to be put in promiscuous mode.
+
+    :param interface_name: the interface to listen on
+    :raises: socket.error if the socket can't be opened, which needs root
+    :return: the socket
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                         socket.htons(LLDP_ETHERTYPE))
+    try:
+        sock.bind((interface_name, LLDP_ETHERTYPE))
+        name = interface_name
+        if isinstance(name, six.text_type):
+            name = name.encode('ascii')
+        index = struct.unpack('16sI', fcntl.ioctl(
+            sock.fileno(), SIOCGIFINDEX, struct.pack('16sI', name, 0)))[1]
+        sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, struct.pack(
+            'iHH8s', index, PACKET_MR_MULTICAST, len(LLDP_MULTICAST_ADDRESS),
+            LLDP_MULTICAST_ADDRESS))
+    except Exception:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,391 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import fcntl
+import json
+import re
+import struct
+import threading
+
+from oslo_log import log
+
+LOG = log.getLogger()
+
+# smartctl learned --json in 7.0
+SMARTCTL_JSON_VERSION = (7, 0)
+SMARTCTL_VERSION_RE = re.compile(r'^smartctl (\d+)\.(\d+)')
+# How --json reports WHEN_FAILED, and how the text output prints it
+SMARTCTL_JSON_WHEN_FAILED = {'now': 'FAILING_NOW', 'past': 'In_the_past'}
+
+# ATA SMART READ DATA and READ THRESHOLDS, sent with the HDIO_DRIVE_CMD ioctl
+HDIO_DRIVE_CMD = 0x031f
+ATA_SMART_CMD = 0xb0
+ATA_SMART_READ_VALUES = 0xd0
+ATA_SMART_READ_THRESHOLDS = 0xd1
+ATA_SECTOR_SIZE = 512
+# Both structures are a 2 byte revision followed by 30 12 byte entries
+ATA_SMART_ENTRY = struct.Struct('<BHBB6sB')
+ATA_SMART_THRESHOLD_ENTRY = struct.Struct('<BB10x')
+ATA_SMART_ENTRIES = 30
+# Names smartctl uses for common attributes. The ATA data only carries ids;
+# smartctl gets names from its drive database.
+ATA_ATTRIBUTE_NAMES = {
+    1: 'Raw_Read_Error_Rate',
+    2: 'Throughput_Performance',
+    3: 'Spin_Up_Time',
+    4: 'Start_Stop_Count',
+    5: 'Reallocated_Sector_Ct',
+    7: 'Seek_Error_Rate',
+    9: 'Power_On_Hours',
+    10: 'Spin_Retry_Count',
+    12: 'Power_Cycle_Count',
+    194: 'Temperature_Celsius',
+    196: 'Reallocated_Event_Count',
+    197: 'Current_Pending_Sector',
+    198: 'Offline_Uncorrectable',
+    199: 'UDMA_CRC_Error_Count',
+}
+# Attributes whose raw value packs the current, minimum and maximum
+# temperature into its first, third and fifth bytes
+ATA_TEMPERATURE_IDS = (190, 194)
+
+# The columns of the smartctl --attributes table, in the order the
+# SmartAttribute constructor takes them.
+SMARTCTL_COLUMNS = ('ID#', 'ATTRIBUTE_NAME', 'FLAG', 'VALUE', 'WORST',
+                    'THRESH', 'TYPE', 'UPDATED', 'WHEN_FAILED', 'RAW_VALUE')
+HEADING_RE = re.compile(r'\S+')
+# The integer a RAW_VALUE such as '40 (Min/Max 30/60)' starts with
+RAW_INTEGER_RE = re.compile(r'\d+')
+# What smartctl prints in the THRESH column when it has no threshold for
+# an attribute, such as when the disk's thresholds couldn't be read
+NO_THRESHOLD = '---'
+
+
+class SmartAttribute(object):
+    """A single SMART attribute of a disk.
+
+    value and worst are integers, and thresh is an integer or None if the
+    disk has no threshold for the attribute. raw_value is the raw value as
+    smartctl printed it, and raw is the integer it starts with, or None if
+    it doesn't start with one.
+    """
+    __slots__ = ('id', 'name', 'flag', 'value', 'worst', 'thresh', 'type',
+                 'updated', 'when_failed', 'raw_value', 'raw')
+
+    def __init__(self, id, name, flag, value, worst, thresh, type, updated,
+                 when_failed, raw_value, raw=None):
+        self.id = id
+        self.name = name
+        self.flag = flag
+        self.value = value
+        self.worst = worst
+        self.thresh = thresh
+        self.type = type
+        self.updated = updated
+        self.when_failed = when_failed
+        self.raw_value = raw_value
+        if raw is None:
+            match = RAW_INTEGER_RE.match(raw_value)
+            raw = int(match.group()) if match else None
+        self.raw = raw
+
+    @property
+    def key(self):
+        """The key attributes are stored under, such as '9-Power_On_Hours'."""
+        return '{0}-{1}'.format(self.id, self.name)
+
+    def __eq__(self, other):
+        return (isinstance(other, SmartAttribute) and
+                all(getattr(self, slot) == getattr(other, slot)
+                    for slot in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'SmartAttribute({0})'.format(', '.join(
+            '{0}={1!r}'.format(slot, getattr(self, slot))
+            for slot in self.__slots__))
+
+
+def parse_smartctl_attributes(output):
+    """Parse the attribute table printed by smartctl --attributes.
+
+    Column offsets are worked out once from the ID# header, and every row
+    is sliced at those offsets rather than split on whitespace, so values
+    containing spaces such as a RAW_VALUE of '40 (Min/Max 30/60)' are kept
+    whole.
+
+    :param output: the stdout of smartctl --attributes
+    :return: a dict of {'<ID#>-<ATTRIBUTE_NAME>': SmartAttribute}
+    """
+    lines = iter(output.split('\n'))
+    for line in lines:
+        if line.lstrip().startswith('ID#'):
+            header = line
+            break
+    else:
+        return {}
+
+    # Each column runs from the start of its heading to the start of the
+    # next one. The ID# column is right aligned, so it also runs up to the
+    # next heading.
+    starts = dict((match.group(), match.start())
+                  for match in HEADING_RE.finditer(header))
+    try:
+        offsets = [starts[column] for column in SMARTCTL_COLUMNS]
+    except KeyError as e:
+        raise ValueError('smartctl attribute header is missing the {0} '
+                         'column: {1}'.format(e, header.strip()))
+    slices = [slice(start, end) for start, end in
+              zip([0] + offsets[1:], offsets[1:] + [None])]
+
+    attributes = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = [line[s].strip() for s in slices]
+        try:
+            thresh = (None if fields[5] == NO_THRESHOLD
+                      else int(fields[5]))
+            attribute = SmartAttribute(
+                int(fields[0]), fields[1], fields[2], int(fields[3]),
+                int(fields[4]), thresh, *fields[6:])
+        except ValueError:
+            LOG.warning('Skipping unparseable SMART attribute: %s', line)
+            continue
+        attributes[attribute.key] = attribute
+
+    return attributes
+
+
+def parse_smartctl_json(output):
+    """Parse the attribute table from smartctl --json --attributes.
+
+    raw is taken from the raw value as smartctl prints it, the same as for
+    the text output, rather than the packed 48 bit raw value; they differ
+    for attributes such as temperatures.
+
+    :param output: the stdout of smartctl --json --attributes
+    :return: a dict of {'<ID#>-<ATTRIBUTE_NAME>': SmartAttribute}
+    """
+    table = json.loads(output).get('ata_smart_attributes', {}).get('table',
+                                                                  [])
+    attributes = {}
+    for entry in table:
+        flags = entry['flags']
+        attribute = SmartAttribute(
+            entry['id'], entry['name'], '0x{0:04x}'.format(flags['value']),
+            entry['value'], entry['worst'], entry.get('thresh'),
+            'Pre-fail' if flags['prefailure'] else 'Old_age',
+            'Always' if flags['updated_online'] else 'Offline',
+            SMARTCTL_JSON_WHEN_FAILED.get(entry.get('when_failed'), '-'),
+            entry['raw']['string'])
+        attributes[attribute.key] = attribute
+    return attributes
+
+
+def parse_ata_smart_data(values, thresholds):
+    """Parse the sectors returned by ATA SMART READ DATA/READ THRESHOLDS.
+
+    Attribute names come from ATA_ATTRIBUTE_NAMES, as the sectors only
+    carry attribute ids.
+
+    :param values: the 512 byte SMART READ DATA sector
+    :param thresholds: the 512 byte SMART READ THRESHOLDS sector
+    :return: a dict of {'<ID#>-<ATTRIBUTE_NAME>': SmartAttribute}
+    """
+    thresh_by_id = {}
+    for idx in range(ATA_SMART_ENTRIES):
+        offset = 2 + idx * ATA_SMART_THRESHOLD_ENTRY.size
+        id, thresh = ATA_SMART_THRESHOLD_ENTRY.unpack_from(thresholds,
+                                                            offset)
+        if id:
+            thresh_by_id[id] = thresh
+
+    attributes = {}
+    for idx in range(ATA_SMART_ENTRIES):
+        offset = 2 + idx * ATA_SMART_ENTRY.size
+        id, flags, value, worst, raw_bytes, _ = ATA_SMART_ENTRY.unpack_from(
+            values, offset)
+        if not id:
+            continue
+        raw_bytes = bytearray(raw_bytes)
+        thresh = thresh_by_id.get(id, 0)
+        if id in ATA_TEMPERATURE_IDS:
+            raw = raw_bytes[0]
+            raw_value = str(raw)
+            if raw_bytes[2] or raw_bytes[4]:
+                raw_value += ' (Min/Max {0}/{1})'.format(raw_bytes[2],
+                                                         raw_bytes[4])
+        else:
+            raw = sum(b << (8 * i) for i, b in enumerate(raw_bytes))
+            raw_value = str(raw)
+        if thresh and value <= thresh:
+            when_failed = 'FAILING_NOW'
+        elif thresh and worst <= thresh:
+            when_failed = 'In_the_past'
+        else:
+            when_failed = '-'
+        attribute = SmartAttribute(
+            id, ATA_ATTRIBUTE_NAMES.get(id, 'Unknown_Attribute'),
+            '0x{0:04x}'.format(flags), value, worst, thresh,
+            'Pre-fail' if flags & 0x1 else 'Old_age',
+            'Always' if flags & 0x2 else 'Offline',
+            when_failed, raw_value, raw=raw)
+        attributes[attribute.key] = attribute
+    return attributes
+
+
+def _ata_smart_command(device, feature):
+    """Send an ATA SMART command to a device and return the sector read."""
+    buf = array.array('B', [ATA_SMART_CMD, 1, feature, 1] +
+                      [0] * ATA_SECTOR_SIZE)
+    with open(device, 'rb') as f:
+        fcntl.ioctl(f.fileno(), HDIO_DRIVE_CMD, buf, True)
+    return bytes(bytearray(buf[4:]))
+
+
+def read_ata_smart_data(device):
+    """Read the SMART data and threshold sectors straight from a device.
+
+    :param device: the path to an ATA block device, such as /dev/sda
+    :return: a tuple of (SMART READ DATA sector, READ THRESHOLDS sector)
+    """
+    return (_ata_smart_command(device, ATA_SMART_READ_VALUES),
+            _ata_smart_command(device, ATA_SMART_READ_THRESHOLDS))
+
+
+class SmartctlJsonBackend(object):
+    """Reads attributes with smartctl --json, on smartctl 7.0 and newer."""
+    name = 'json'
+
+    def __init__(self, execute):
+        self._execute = execute
+
+    def is_supported(self):
+        first_line = self._execute('smartctl', '--version')[0].lstrip()
+        match = SMARTCTL_VERSION_RE.match(first_line)
+        if not match:
+            return False
+        version = tuple(int(part) for part in match.groups())
+        return version >= SMARTCTL_JSON_VERSION
+
+    def get_attributes(self, device):
+        output = self._execute('smartctl', '--json', '--attributes',
+                               device)[0]
+        return parse_smartctl_json(output)
+
+
+class SmartctlTextBackend(object):
+    """Reads attributes by parsing the text printed by smartctl."""
+    name = 'text'
+
+    def __init__(self, execute):
+        self._execute = execute
+
+    def is_supported(self):
+        return True
+
+    def get_attributes(self, device):
+        output = self._execute('smartctl', '--attributes', device)[0]
+        return parse_smartctl_attributes(output)
+
+
+class AtaIoctlBackend(object):
+    """Reads attributes straight from the device with ATA SMART commands.
+
+    This needs no smartctl, but only works for devices that take
+    HDIO_DRIVE_CMD, and only knows the names in ATA_ATTRIBUTE_NAMES.
+    """
+    name = 'ata_ioctl'
+
+    def __init__(self, execute, read_smart_data=read_ata_smart_data):
+        """Create the backend.
+
+        :param execute: unused, as no command is run. It is taken so that
+                        SmartReader can build every backend in BACKENDS
+                        the same way.
+        :param read_smart_data: a callable with the interface of
+                                read_ata_smart_data
+        """
+        self._read_smart_data = read_smart_data
+
+    def is_supported(self):
+        return True
+
+    def get_attributes(self, device):
+        return parse_ata_smart_data(*self._read_smart_data(device))
+
+
+BACKENDS = dict((backend.name, backend) for backend in
+                (SmartctlJsonBackend, SmartctlTextBackend, AtaIoctlBackend))
+
+
+class SmartReader(object):
+    """Reads SMART attributes with the first backend that works.
+
+    Backends are tried in the order given. Ones that aren't supported on
+    this machine are skipped, which is only checked once. If a backend
+    fails for a device, the next one is tried.
+    """
+
+    def __init__(self, execute, backends=('json', 'text')):
+        """Create a reader.
+
+        :param execute: a callable with the interface of utils.execute
+        :param backends: names of backends from BACKENDS, in order of
+                         preference
+        """
+        self._backends = [BACKENDS[name](execute) for name in backends]
+        self._supported = None
+        self._lock = threading.Lock()
+
+    def supported_backends(self):
+        with self._lock:
+            if self._supported is None:
+                self._supported = []
+                for backend in self._backends:
+                    try:
+                        supported = backend.is_supported()
+                    except Exception as e:
+                        LOG.warning('Unable to tell if the %(backend)s SMART '
+                                    'backend is supported: %(error)s',
+                                    {'backend': backend.name, 'error': e})
+                        supported = False
+                    if supported:
+                        self._supported.append(backend)
+            return self._supported
+
+    def get_attributes(self, device):
+        """Read the SMART attributes of a device.
+
+        :param device: the path to a block device, such as /dev/sda
+        :raises ValueError: if no backend is supported
+        :return: a dict of {'<ID#>-<ATTRIBUTE_NAME>': SmartAttribute}
+        """
+        backends = self.supported_backends()
+        if not backends:
+            raise ValueError('No SMART backend is supported')
+        for backend in backends[:-1]:
+            try:
+                return backend.get_attributes(device)
+            except Exception as e:
+                LOG.warning('Reading SMART data from %(device)s with the '
+                            '%(backend)s backend failed, falling back: '
+                            '%(error)s', {'device': device,
+                                          'backend': backend.name,
+                                          'error': e})
+        return backends[-1].get_attributes(device)
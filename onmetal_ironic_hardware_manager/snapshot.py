@@ -0,0 +1,145 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import six
+
+from oslo_log import log
+
+from onmetal_ironic_hardware_manager import jsonfile
+
+LOG = log.getLogger()
+
+# Suffix of the gauge holding a counter's rate of change, in units per hour
+RATE_SUFFIX = '.PER_HOUR'
+SECONDS_PER_HOUR = 60 * 60
+
+
+class MetricSnapshot(object):
+    """The gauges last sent for each disk, kept in a small JSON file.
+
+    The file holds one entry per disk:
+
+        {key: {'prefix': gauge prefix the values were sent under,
+               'time': when the values were sent,
+               'full_time': when every value was last sent,
+               'values': {metric name: value}}}
+
+    Reading or writing the file never raises; a snapshot that can't be
+    read is treated as empty, so every gauge is sent again.
+    """
+
+    def __init__(self, path, full_refresh_interval, counters=()):
+        """Create a snapshot backed by a file, which is read when first used.
+
+        :param path: the JSON file to keep the snapshot in
+        :param full_refresh_interval: seconds after which every gauge for a
+                                      disk is sent, changed or not
+        :param counters: suffixes of metric names that are counters, and
+                         get a rate of change gauge named
+                         <name>.PER_HOUR
+        """
+        self._path = path
+        self._full_refresh_interval = full_refresh_interval
+        self._counters = tuple(counters)
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def changes(self, key, prefix, metrics_to_send, now=None):
+        """Record new values for a disk and return the gauges to send.
+
+        Only values that differ from the snapshot are returned, unless the
+        disk is new, was last seen under another prefix, or its last full
+        refresh is older than full_refresh_interval, in which case every
+        value is. Rates are added for counters seen in both.
+
+        :param key: what identifies the disk across boots, such as its
+                    serial number
+        :param prefix: the prefix the gauges are sent under
+        :param metrics_to_send: dict of {metric name: value}
+        :param now: the current time in seconds since the epoch, defaults to
+                    time.time()
+        :return: dict of {metric name: value} to send
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entries = self._load()
+            previous = entries.get(key)
+            values = dict(metrics_to_send)
+            if previous is not None:
+                values.update(self._rates(previous, values, now))
+            if previous is not None and previous['prefix'] == prefix:
+                # A clock that went backwards also forces a full refresh
+                if 0 <= now - previous['full_time'] < \
+                        self._full_refresh_interval:
+                    full_time = previous['full_time']
+                    old_values = previous['values']
+                    to_send = dict((name, value) for name, value in
+                                   six.iteritems(values)
+                                   if old_values.get(name) != value)
+                else:
+                    full_time = now
+                    to_send = values
+            else:
+                full_time = now
+                to_send = values
+            entries[key] = {'prefix': prefix, 'time': now,
+                            'full_time': full_time, 'values': values}
+            return to_send
+
+    def prune(self, keys):
+        """Drop the entries of disks that are gone, when next saved.
+
+        :param keys: the keys of every disk still in the machine
+        """
+        with self._lock:
+            entries = self._load()
+            for key in set(entries) - set(keys):
+                del entries[key]
+
+    def save(self):
+        """Write the snapshot to its file, replacing it atomically."""
+        with self._lock:
+            try:
+                jsonfile.write_json(self._path, self._load())
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to save SMART snapshot to %(path)s: '
+                            '%(error)s', {'path': self._path, 'error': e})
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = jsonfile.read_json(self._path, 'SMART snapshot')
+        return self._entries
+
+    def _rates(self, previous, values, now):
+        elapsed = now - previous['time']
+        if elapsed <= 0:
+            return {}
+        rates = {}
+        for name, value in six.iteritems(values):
+            if not name.endswith(self._counters):
+                continue
+            try:
+                delta = float(value) - float(previous['values'][name])
+            except (KeyError, TypeError, ValueError):
+                continue
+            # A counter that went down was reset; there's no useful rate
+            if delta >= 0:
+                rates[name + RATE_SUFFIX] = round(
+                    delta * SECONDS_PER_HOUR / elapsed, 6)
+        return rates
+
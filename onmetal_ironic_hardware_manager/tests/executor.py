@@ -0,0 +1,229 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import time
+
+import mock
+from oslo_concurrency import processutils
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import executor
+from onmetal_ironic_hardware_manager.tests import fakes
+
+DDOEMCLI = '/mnt/LSI/12.22.00.00/ddoemcli'
+
+
+def _python(script):
+    return [sys.executable, '-c', script]
+
+
+class TestStream(test_base.BaseTestCase):
+    def test_stream(self):
+        chunks = list(executor.stream(_python(
+            'import sys, time\n'
+            'sys.stdout.write("in progress"); sys.stdout.flush()\n'
+            'time.sleep(0.2)\n'
+            'sys.stderr.write("...done\\n")\n')))
+
+        # Output is returned as it is written, not a line at a time
+        self.assertEqual('in progress', chunks[0])
+        self.assertEqual('in progress...done\n', ''.join(chunks))
+
+    def test_stream_stall(self):
+        start = time.time()
+        output = executor.stream(_python(
+            'import sys, time\n'
+            'sys.stdout.write("starting"); sys.stdout.flush()\n'
+            'time.sleep(30)\n'), stall_timeout=0.5)
+
+        self.assertEqual('starting', next(output))
+        self.assertRaises(executor.StallError, next, output)
+        self.assertLess(time.time() - start, 10)
+
+    def test_stream_stall_carries_on(self):
+        stalls = []
+        output = executor.stream(_python(
+            'import sys, time\n'
+            'sys.stdout.write("starting"); sys.stdout.flush()\n'
+            'time.sleep(1)\n'
+            'sys.stdout.write("...done")\n'), stall_timeout=0.3,
+            on_stall=stalls.append)
+
+        self.assertEqual('starting...done', ''.join(output))
+        self.assertTrue(stalls)
+        self.assertEqual(sorted(stalls), stalls)
+
+    def test_stream_tty(self):
+        # Nothing is flushed, so a pipe would get it all at exit
+        chunks = list(executor.stream(_python(
+            'import sys, time\n'
+            'sys.stdout.write("tty: %s\\n" % sys.stdout.isatty())\n'
+            'time.sleep(0.2)\n'
+            'sys.stdout.write("done\\n")\n'), tty=True))
+
+        self.assertEqual('tty: True\n', chunks[0])
+        self.assertEqual('tty: True\ndone\n', ''.join(chunks))
+
+    def test_stream_tty_failure(self):
+        output = executor.stream(_python(
+            'import sys\n'
+            'sys.stdout.write("bad card\\n")\n'
+            'sys.exit(3)\n'), tty=True)
+
+        error = self.assertRaises(processutils.ProcessExecutionError,
+                                  list, output)
+        self.assertEqual(3, error.exit_code)
+        self.assertEqual('bad card\n', error.stdout)
+
+    def test_stream_failure(self):
+        output = executor.stream(_python(
+            'import sys\n'
+            'sys.stdout.write("bad card\\n")\n'
+            'sys.exit(3)\n'))
+
+        error = self.assertRaises(processutils.ProcessExecutionError,
+                                  list, output)
+        self.assertEqual(3, error.exit_code)
+        self.assertEqual('bad card\n', error.stdout)
+
+
+class TestExecutor(test_base.BaseTestCase):
+    def _run_all(self, func, cmds):
+        threads = [threading.Thread(target=func, args=cmd) for cmd in cmds]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+    def test_execute(self):
+        cli = fakes.FakeCli()
+        cmd_executor = executor.Executor(cli)
+
+        stdout, stderr = cmd_executor.execute(DDOEMCLI, '-listall')
+
+        self.assertEqual(fakes.read_fixture('ddoemcli_listall_out.txt'),
+                         stdout)
+        self.assertEqual([(DDOEMCLI, '-listall')], cli.calls)
+        self.assertEqual(1, cmd_executor.histogram.snapshot()[
+            'ddoemcli']['count'])
+
+    def test_execute_returns_stderr(self):
+        cli = fakes.FakeCli(responses={
+            ('smartctl', '--attributes'): ('', 'Read Device Identity '
+                                               'failed')})
+        cmd_executor = executor.Executor(cli)
+
+        self.assertEqual(('', 'Read Device Identity failed'),
+                         cmd_executor.execute('smartctl', '--attributes',
+                                              '/dev/sda'))
+
+    def test_execute_failure_is_counted(self):
+        cli = fakes.FakeCli(responses={
+            ('ddoemcli', '-health'): processutils.ProcessExecutionError(
+                exit_code=1)})
+        cmd_executor = executor.Executor(cli)
+
+        self.assertRaises(processutils.ProcessExecutionError,
+                          cmd_executor.execute, DDOEMCLI, '-c', '1',
+                          '-health')
+        self.assertEqual(1, cmd_executor.histogram.snapshot()[
+            'ddoemcli']['count'])
+
+    def test_execute_limits(self):
+        cli = fakes.FakeCli(delay=0.1)
+        cmd_executor = executor.Executor(cli, limits={'ddoemcli': 2})
+
+        self._run_all(cmd_executor.execute,
+                      [(DDOEMCLI, '-c', str(card), '-health')
+                       for card in range(6)] +
+                      [('smartctl', '--attributes', '/dev/sd' + disk)
+                       for disk in 'abcd'])
+
+        self.assertEqual(10, len(cli.calls))
+        self.assertEqual(2, cli.max_running['ddoemcli'])
+        # Unlimited commands aren't held up by limited ones
+        self.assertEqual(4, cli.max_running['smartctl'])
+
+    def test_execute_timeout(self):
+        cli = fakes.FakeCli(delay=30)
+        cmd_executor = executor.Executor(cli)
+
+        start = time.time()
+        error = self.assertRaises(executor.CommandTimeout,
+                                  cmd_executor.execute, DDOEMCLI,
+                                  '-listall', timeout=0.2)
+
+        self.assertLess(time.time() - start, 10)
+        self.assertIn('killed after 0.2 seconds', str(error))
+
+    def test_execute_default_timeout(self):
+        cli = fakes.FakeCli(delay=30)
+        cmd_executor = executor.Executor(cli, timeouts={'smartctl': 0.2})
+
+        self.assertRaises(executor.CommandTimeout, cmd_executor.execute,
+                          'smartctl', '--attributes', '/dev/sda')
+
+    def test_execute_within_timeout(self):
+        execute = mock.Mock(return_value=('out', ''))
+        cmd_executor = executor.Executor(execute)
+
+        self.assertEqual(('out', ''), cmd_executor.execute(
+            DDOEMCLI, '-listall', timeout=60))
+        execute.assert_called_once_with(DDOEMCLI, '-listall',
+                                        on_execute=mock.ANY,
+                                        on_completion=mock.ANY)
+
+    @mock.patch.object(executor, 'stream')
+    def test_stream_limits(self, mocked_stream):
+        cli = fakes.FakeCli()
+        mocked_stream.side_effect = cli.stream
+        cmd_executor = executor.Executor(cli, limits={'ddoemcli': 1})
+        cmds = [[DDOEMCLI, '-c', str(card), '-format'] for card in range(3)]
+        outputs = []
+
+        def _format(cmd):
+            outputs.append(''.join(cmd_executor.stream(cmd)))
+
+        self._run_all(_format, [(cmd,) for cmd in cmds])
+
+        # Another card's format only starts once one has been read through
+        self.assertEqual(1, cli.max_running['ddoemcli'])
+        self.assertEqual(
+            [fakes.read_fixture('ddoemcli_format_out.txt')] * 3, outputs)
+        self.assertEqual(3, cmd_executor.histogram.snapshot()[
+            'ddoemcli']['count'])
+
+
+class TestDurationHistogram(test_base.BaseTestCase):
+    def test_observe(self):
+        histogram = executor.DurationHistogram(buckets=(1, 10))
+        for seconds in (0.5, 2, 20):
+            histogram.observe('ddoemcli', seconds)
+
+        self.assertEqual(
+            {'ddoemcli': {'count': 3, 'sum': 22.5,
+                          'buckets': [(1, 1), (10, 2)]}},
+            histogram.snapshot())
+
+    def test_gauges(self):
+        histogram = executor.DurationHistogram(buckets=(0.5, 10))
+        histogram.observe(executor.command_name('/mnt/bios/flash_bios.sh'),
+                          0.25)
+
+        self.assertEqual({'flash_bios_sh.count': 1,
+                          'flash_bios_sh.sum': 0.25,
+                          'flash_bios_sh.le_0_5': 1,
+                          'flash_bios_sh.le_10': 1}, histogram.gauges())
@@ -0,0 +1,155 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import struct
+import threading
+
+from oslo_concurrency import processutils
+import six
+
+from onmetal_ironic_hardware_manager import executor
+from onmetal_ironic_hardware_manager import lldp
+
+SMARTCTL_VERSION_OUT = (
+    'smartctl 7.1 2019-12-30 r5022 [x86_64-linux-4.4.0] (local build)\n'
+    'Copyright (C) 2002-19, Bruce Allen, Christian Franke, '
+    'www.smartmontools.org\n')
+
+# (command name, option, fixture in tests/data) in the order they are
+# matched, so '--json --attributes' finds the JSON fixture.
+FIXTURES = (
+    ('ddoemcli', '-listall', 'ddoemcli_listall_out.txt'),
+    ('ddoemcli', '-health', 'ddoemcli_health_out.txt'),
+    ('ddoemcli', '-format', 'ddoemcli_format_out.txt'),
+    ('smartctl', '--json', 'smartctl_attributes_out.json'),
+    ('smartctl', '--attributes', 'smartctl_attributes_out.txt'),
+)
+
+
+def lldp_frame(tlvs, end=True):
+    """Build an LLDP frame, with its Ethernet header, from TLVs.
+
+    :param tlvs: a list of (TLV type, value) tuples. Text values are sent
+                 as latin-1.
+    :param end: whether to finish the frame with an End of LLDPDU TLV
+    """
+    frame = (lldp.LLDP_MULTICAST_ADDRESS + b'\x02\x00\x00\x00\x00\x01' +
+             struct.pack('!H', lldp.LLDP_ETHERTYPE))
+    for tlv_type, value in tlvs:
+        if isinstance(value, six.text_type):
+            value = value.encode('latin-1')
+        frame += struct.pack('!H', tlv_type << 9 | len(value)) + value
+    if end:
+        frame += struct.pack('!H', lldp.TLV_END)
+    return frame
+
+
+def read_fixture(name):
+    filename = os.path.join(os.path.dirname(__file__), 'data', name)
+    with open(filename, 'r') as data:
+        return data.read()
+
+
+class FakeProcess(object):
+    """What FakeCli passes to on_execute, in place of a Popen object."""
+
+    def __init__(self):
+        self.killed = threading.Event()
+
+    def kill(self):
+        self.killed.set()
+
+
+class FakeCli(object):
+    """Stands in for utils.execute and executor.stream, replaying fixtures.
+
+    ddoemcli and smartctl are answered from the tests/data fixtures their
+    output was captured in, whatever directory they are run from. Calls are
+    recorded, along with the most of each command that ran at once.
+    """
+
+    def __init__(self, delay=0, responses=None):
+        """Create a fake CLI.
+
+        :param delay: seconds every call takes, unless it is killed
+        :param responses: a dict of {(command name, option): (stdout,
+                          stderr) or an exception to raise}, taking
+                          precedence over the fixtures
+        """
+        self.delay = delay
+        self.responses = dict(responses or {})
+        self.calls = []
+        self.max_running = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *cmd, **kwargs):
+        process = FakeProcess()
+        if kwargs.get('on_execute'):
+            kwargs['on_execute'](process)
+        try:
+            with self._run(cmd):
+                response = self._respond(cmd)
+                if self.delay:
+                    process.killed.wait(self.delay)
+                if process.killed.is_set():
+                    raise processutils.ProcessExecutionError(
+                        stdout='', stderr='Killed', exit_code=-9,
+                        cmd=' '.join(cmd))
+                if isinstance(response, Exception):
+                    raise response
+                return response
+        finally:
+            if kwargs.get('on_completion'):
+                kwargs['on_completion'](process)
+
+    def stream(self, cmd, stall_timeout=None, on_stall=None, tty=False,
+               chunk_size=64):
+        """Replay a fixture in small chunks, as executor.stream would."""
+        with self._run(cmd):
+            response = self._respond(cmd)
+            if isinstance(response, Exception):
+                raise response
+            output = response[0]
+            for idx in range(0, len(output), chunk_size):
+                yield output[idx:idx + chunk_size]
+
+    @contextlib.contextmanager
+    def _run(self, cmd):
+        name = executor.command_name(cmd[0])
+        with self._lock:
+            self.calls.append(tuple(cmd))
+            running = self._running.get(name, 0) + 1
+            self._running[name] = running
+            self.max_running[name] = max(running,
+                                         self.max_running.get(name, 0))
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running[name] -= 1
+
+    def _respond(self, cmd):
+        name = executor.command_name(cmd[0])
+        for option in cmd[1:]:
+            if (name, option) in self.responses:
+                return self.responses[(name, option)]
+        if name == 'smartctl' and '--version' in cmd:
+            return (SMARTCTL_VERSION_OUT, '')
+        for fixture_name, option, fixture in FIXTURES:
+            if name == fixture_name and option in cmd:
+                return (read_fixture(fixture), '')
+        raise OSError('Unexpected command: {0}'.format(' '.join(cmd)))
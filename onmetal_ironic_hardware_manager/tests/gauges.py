@@ -0,0 +1,124 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+import mock
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import gauges
+
+
+class TestGaugeBatch(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestGaugeBatch, self).setUp()
+        # A statsd-style listener to send packets to
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(5)
+        self.addCleanup(self.listener.close)
+        self.address = self.listener.getsockname()
+        self.get_logger = mock.Mock()
+        self.get_logger.return_value = mock.Mock(spec=['gauge'])
+
+    def _receive(self, count):
+        return [self.listener.recv(65535) for _ in range(count)]
+
+    def test_flush_statsd(self):
+        batch = gauges.GaugeBatch(self.get_logger,
+                                  statsd_address=self.address)
+        batch.add('smartdata_sda', {'9-Power_On_Hours.VALUE': 100,
+                                    '4_FL00AV2L.WriteAmplification': '1.29'})
+        batch.add('smartdata_sdb', {'12-Power_Cycle_Count.RAW_VALUE': '68'})
+
+        self.assertEqual({'sent': 3, 'dropped': 0}, batch.flush())
+
+        packet = self._receive(1)[0]
+        self.assertEqual(set([
+            b'smartdata_sda.9-Power_On_Hours.VALUE:100|g',
+            b'smartdata_sda.4_FL00AV2L.WriteAmplification:1.29|g',
+            b'smartdata_sdb.12-Power_Cycle_Count.RAW_VALUE:68|g'
+        ]), set(packet.split(b'\n')))
+        self.assertEqual(0, self.get_logger.return_value.gauge.call_count)
+
+    def test_flush_statsd_logger_naming(self):
+        logger = mock.Mock(spec=['gauge', 'get_metric_name'])
+        logger.get_metric_name.side_effect = (
+            lambda name: 'global.host1.smartdata_sda.' + name)
+        self.get_logger.return_value = logger
+        batch = gauges.GaugeBatch(self.get_logger,
+                                  statsd_address=self.address)
+        batch.add('smartdata_sda', {'9-Power_On_Hours.VALUE': 100})
+
+        self.assertEqual({'sent': 1, 'dropped': 0}, batch.flush())
+
+        self.assertEqual(
+            [b'global.host1.smartdata_sda.9-Power_On_Hours.VALUE:100|g'],
+            self._receive(1))
+        self.get_logger.assert_called_once_with('smartdata_sda')
+
+    def test_flush_statsd_packet_size(self):
+        batch = gauges.GaugeBatch(self.get_logger,
+                                  statsd_address=self.address,
+                                  packet_size=100)
+        # Each line is 19 bytes: 'prefix.metricNN:1|g'
+        batch.add('prefix', dict(('metric%02d' % i, 1) for i in range(20)))
+
+        self.assertEqual({'sent': 20, 'dropped': 0}, batch.flush())
+
+        # Five 19 byte lines and four newlines fit in 100 bytes
+        packets = self._receive(4)
+        for packet in packets:
+            self.assertTrue(len(packet) <= 100)
+        self.assertEqual(20, sum(len(p.split(b'\n')) for p in packets))
+
+    def test_flush_drops_unsendable(self):
+        batch = gauges.GaugeBatch(self.get_logger,
+                                  statsd_address=self.address,
+                                  packet_size=30)
+        batch.add('prefix', {'ok': 1,
+                             'not_a_number': 'FL00AV2L',
+                             'much_too_long_for_a_packet': 1})
+
+        self.assertEqual({'sent': 1, 'dropped': 2}, batch.flush())
+        self.assertEqual([b'prefix.ok:1|g'], self._receive(1))
+
+    def test_flush_empties_buffer(self):
+        batch = gauges.GaugeBatch(self.get_logger,
+                                  statsd_address=self.address)
+        batch.add('prefix', {'metric': 1})
+        batch.flush()
+
+        self.assertEqual({'sent': 0, 'dropped': 0}, batch.flush())
+
+    def test_flush_logger(self):
+        logger = mock.Mock(spec=['gauge'])
+        self.get_logger.return_value = logger
+        batch = gauges.GaugeBatch(self.get_logger)
+        batch.add('prefix', {'metric': '1', 'other': 'NA'})
+
+        self.assertEqual({'sent': 1, 'dropped': 1}, batch.flush())
+        self.get_logger.assert_called_once_with('prefix')
+        logger.gauge.assert_called_once_with('metric', '1')
+
+    def test_flush_logger_bulk(self):
+        logger = mock.Mock(spec=['gauge', 'send_gauges'])
+        self.get_logger.return_value = logger
+        batch = gauges.GaugeBatch(self.get_logger)
+        batch.add('prefix', {'metric': '1', 'other': 2})
+
+        self.assertEqual({'sent': 2, 'dropped': 0}, batch.flush())
+        logger.send_gauges.assert_called_once_with({'metric': '1',
+                                                    'other': 2})
+        self.assertEqual(0, logger.gauge.call_count)
@@ -0,0 +1,101 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import shutil
+import tempfile
+
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import inventory
+
+FakeBlockDevice = collections.namedtuple(
+    'FakeBlockDevice', ['name', 'model', 'size', 'rotational'])
+
+
+class TestHardwareSnapshot(test_base.BaseTestCase):
+    def test_snapshot(self):
+        devices = [
+            FakeBlockDevice('/dev/sda', 'NWD-BLP4-1600', 1073741824, False),
+            FakeBlockDevice('/dev/sdb', '32G MLC SATADOM', 31016853504,
+                            False)]
+
+        snapshot = inventory.HardwareSnapshot(devices, now=1000)
+
+        self.assertEqual(1000, snapshot.taken_at)
+        self.assertEqual(
+            [('/dev/sda', 'NWD-BLP4-1600', 1073741824, False, None),
+             ('/dev/sdb', '32G MLC SATADOM', 31016853504, False, None)],
+            [(record.name, record.model, record.size, record.rotational,
+              record.serial) for record in snapshot.block_devices])
+        self.assertEqual(devices, [record.device
+                                   for record in snapshot.block_devices])
+
+    def test_records_have_no_dict(self):
+        snapshot = inventory.HardwareSnapshot(
+            [FakeBlockDevice('/dev/sda', 'NWD-BLP4-1600', 1073741824, False)])
+
+        self.assertFalse(hasattr(snapshot, '__dict__'))
+        self.assertFalse(hasattr(snapshot.block_devices[0], '__dict__'))
+        self.assertRaises(AttributeError, setattr, snapshot.block_devices[0],
+                          'vendor', 'LSI')
+
+
+class TestDetect(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestDetect, self).setUp()
+        self.sys_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sys_path)
+        self.meminfo_path = os.path.join(self.sys_path, 'meminfo')
+
+    def _write(self, path, text):
+        path = os.path.join(self.sys_path, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_detect(self):
+        self._write('class/dmi/id/sys_vendor', 'Quanta\n')
+        self._write('class/dmi/id/product_name', 'Winterfell\n')
+        self._write('bus/pci/devices/0000:00:00.0/vendor', '0x8086\n')
+        self._write('bus/pci/devices/0000:00:00.0/device', '0x0e00\n')
+        self._write('bus/pci/devices/0000:02:00.0/vendor', '0x1000\n')
+        self._write('bus/pci/devices/0000:02:00.0/device', '0x007e\n')
+        self._write('bus/pci/devices/0000:04:00.0/vendor', '0x1000\n')
+        self._write('bus/pci/devices/0000:04:00.0/device', '0x007e\n')
+        self._write('meminfo', 'MemTotal:       131890176 kB\n'
+                               'MemFree:        130000000 kB\n')
+
+        profile = inventory.detect(self.sys_path, self.meminfo_path)
+
+        self.assertEqual('Quanta', profile.sys_vendor)
+        self.assertEqual('Winterfell', profile.product_name)
+        self.assertEqual(((0x8086, 0x0e00), (0x1000, 0x007e),
+                          (0x1000, 0x007e)), profile.pci_ids)
+        self.assertEqual(131890176, profile.memory_kb)
+        self.assertEqual(2, profile.count_pci_devices(
+            frozenset([(0x1000, 0x007e)])))
+
+    def test_detect_nothing_readable(self):
+        self._write('bus/pci/devices/0000:00:00.0/vendor', '0x8086\n')
+        self._write('meminfo', 'MemFree:        130000000 kB\n')
+
+        profile = inventory.detect(self.sys_path, self.meminfo_path)
+
+        self.assertIsNone(profile.sys_vendor)
+        self.assertIsNone(profile.product_name)
+        self.assertEqual((), profile.pci_ids)
+        self.assertIsNone(profile.memory_kb)
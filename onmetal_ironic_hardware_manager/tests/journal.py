@@ -0,0 +1,213 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import journal
+from onmetal_ironic_hardware_manager import jsonfile
+
+MAX_AGE = 24 * 60 * 60
+
+
+class TestStepJournal(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestStepJournal, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        # A directory that doesn't exist yet, as after a fresh install
+        self.path = os.path.join(self.tempdir, 'state', 'journal.json')
+
+    def _journal(self):
+        return journal.StepJournal(self.path, MAX_AGE)
+
+    def test_record(self):
+        self._journal().record('node-1', 'upgrade_bios', 'abc', now=1000)
+
+        # Read back from the file, as after a reboot
+        step_journal = self._journal()
+        self.assertTrue(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                             now=1001))
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios',
+                                              'def', now=1001))
+        self.assertFalse(step_journal.is_done('node-1', 'decom_bios_settings',
+                                              'abc', now=1001))
+        self.assertFalse(step_journal.is_done('node-2', 'upgrade_bios', 'abc',
+                                              now=1001))
+
+    def test_is_done_too_old(self):
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                              now=1000 + MAX_AGE))
+        # Nor if the clock went backwards
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                              now=999))
+
+    def test_is_done_boot_id(self):
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', boot_id='boot-1',
+                            now=1000)
+
+        self.assertTrue(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                             boot_id='boot-1', now=1001))
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                              boot_id='boot-2', now=1001))
+        # Nor when the boot can't be told
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                              now=1001))
+
+    def test_is_done_any_boot(self):
+        step_journal = self._journal()
+        step_journal.record('node-1', 'decom_bios_settings', 'abc',
+                            now=1000)
+
+        self.assertTrue(step_journal.is_done('node-1', 'decom_bios_settings',
+                                             'abc', boot_id='boot-2',
+                                             now=1001))
+
+    @mock.patch.object(jsonfile, 'write_json', autospec=True)
+    def test_record_unchanged(self, mocked_write):
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', boot_id='boot-1',
+                            now=1000)
+        self.assertEqual(1, mocked_write.call_count)
+
+        # Already recorded, so not written again
+        step_journal.record('node-1', 'upgrade_bios', 'abc', boot_id='boot-1',
+                            now=1500)
+        self.assertEqual(1, mocked_write.call_count)
+        # Nor does it count as more recent than it is
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                              boot_id='boot-1',
+                                              now=1000 + MAX_AGE))
+
+        step_journal.record('node-1', 'upgrade_bios', 'abc', boot_id='boot-2',
+                            now=1500)
+        step_journal.record('node-1', 'upgrade_bios', 'def', boot_id='boot-2',
+                            now=1500)
+        self.assertEqual(3, mocked_write.call_count)
+
+    def test_record_drops_old_entries(self):
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+        step_journal.record('node-2', 'upgrade_bios', 'abc',
+                            now=1000 + MAX_AGE)
+
+        with open(self.path) as f:
+            self.assertEqual(['node-2'], list(json.load(f)))
+
+    def test_forget(self):
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+        step_journal.record('node-1', 'decom_bios_settings', 'def', now=1000)
+
+        step_journal.forget('node-1', ['decom_bios_settings',
+                                       'customer_bios_settings'])
+
+        step_journal = self._journal()
+        self.assertTrue(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                             now=1001))
+        self.assertFalse(step_journal.is_done('node-1', 'decom_bios_settings',
+                                              'def', now=1001))
+
+    def test_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"node-1": {"upgrade_bios": ')
+
+        step_journal = self._journal()
+        self.assertFalse(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                              now=1000))
+        step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+        self.assertTrue(self._journal().is_done('node-1', 'upgrade_bios',
+                                                'abc', now=1001))
+
+    def test_record_unwritable(self):
+        # The state directory can't be created where a file is in the way
+        with open(os.path.join(self.tempdir, 'state'), 'w') as f:
+            f.write('')
+
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+
+        # Still remembered for the life of the agent
+        self.assertTrue(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                             now=1001))
+
+
+class TestEfiVariableJournal(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestEfiVariableJournal, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        patcher = mock.patch.object(journal, 'EFIVARS_DIR', self.tempdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(
+            self.tempdir, 'OnMetalCleanJournal-3f79fe27-529d-4d96-b5a2-'
+            '7fcd3bc18131')
+
+    def _journal(self):
+        return journal.StepJournal(self.path, MAX_AGE)
+
+    def test_record(self):
+        self._journal().record('node-1', 'upgrade_bios', 'abc', now=1000)
+
+        self.assertTrue(self._journal().is_done('node-1', 'upgrade_bios',
+                                                'abc', now=1001))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # Non-volatile, boot service and runtime access, then the value
+        self.assertEqual(b'\x07\x00\x00\x00', data[:4])
+        self.assertEqual(['node-1'], list(json.loads(data[4:].decode())))
+
+    @mock.patch.object(journal.fcntl, 'ioctl')
+    def test_record_clears_immutable(self, mocked_ioctl):
+        def _ioctl(fd, request, flags, mutate=False):
+            if request == journal.FS_IOC_GETFLAGS:
+                flags[0] = journal.FS_IMMUTABLE_FL | 0x80
+        mocked_ioctl.side_effect = _ioctl
+        step_journal = self._journal()
+        step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+        self.assertEqual(0, mocked_ioctl.call_count)
+
+        step_journal.record('node-1', 'decom_bios_settings', 'def',
+                            now=1000)
+
+        request, flags = mocked_ioctl.call_args[0][1:]
+        self.assertEqual(journal.FS_IOC_SETFLAGS, request)
+        self.assertEqual([0x80], list(flags))
+        self.assertTrue(self._journal().is_done(
+            'node-1', 'decom_bios_settings', 'def', now=1001))
+
+    def test_no_efi(self):
+        # Booted without EFI, so there's no efivarfs
+        efivars = os.path.join(self.tempdir, 'efivars')
+        self.path = os.path.join(efivars, os.path.basename(self.path))
+
+        with mock.patch.object(journal, 'EFIVARS_DIR', efivars):
+            step_journal = self._journal()
+            step_journal.record('node-1', 'upgrade_bios', 'abc', now=1000)
+
+        # Still remembered for the life of the agent
+        self.assertTrue(step_journal.is_done('node-1', 'upgrade_bios', 'abc',
+                                             now=1001))
+        self.assertFalse(os.path.exists(efivars))
@@ -0,0 +1,220 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import random
+import socket
+import time
+
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import lldp
+from onmetal_ironic_hardware_manager.tests import fakes
+
+SWITCH1_TLVS = [
+    # Chassis ID, a MAC address
+    (1, b'\x04\x00\x1b\x21\x3c\x4d\x5e'),
+    # Port ID, an interface name
+    (2, b'\x05Ethernet1/1'),
+    # TTL
+    (3, b'\x00x'),
+    # System Name
+    (5, b'switch1'),
+]
+
+
+def _index(tlvs):
+    index = lldp.TlvIndex()
+    for tlv_type, value in tlvs:
+        index.add(tlv_type, value)
+    return index
+
+
+class TestParseFrame(test_base.BaseTestCase):
+    def test_parse(self):
+        tlvs = lldp.parse_frame(fakes.lldp_frame(SWITCH1_TLVS))
+
+        self.assertEqual([1, 2, 3, 5], tlvs.types())
+        self.assertEqual([b'\x05Ethernet1/1'], tlvs.get(2))
+        self.assertEqual([], tlvs.get(4))
+        self.assertEqual(_index(SWITCH1_TLVS), tlvs)
+
+    def test_parse_repeated_type(self):
+        extra = [(127, b'\x00\x80\xc2\x01\x00\x01'),
+                 (127, b'\x00\x12\x0f\x01\x03\x6c\x03')]
+
+        tlvs = lldp.parse_frame(fakes.lldp_frame(SWITCH1_TLVS + extra))
+
+        self.assertEqual([value for _, value in extra], tlvs.get(127))
+
+    def test_parse_ignores_padding(self):
+        frame = fakes.lldp_frame(SWITCH1_TLVS) + b'\0' * 20
+
+        self.assertEqual(_index(SWITCH1_TLVS), lldp.parse_frame(frame))
+
+    def test_parse_truncated(self):
+        frame = fakes.lldp_frame(SWITCH1_TLVS, end=False)
+
+        for length in range(lldp.ETHERNET_HEADER_SIZE, len(frame) + 1):
+            self.assertRaises(ValueError, lldp.parse_frame, frame[:length])
+
+    def test_parse_random_frames(self):
+        rand = random.Random(1234)
+        for _ in range(500):
+            tlvs = [(rand.randint(1, 127),
+                     bytes(bytearray(rand.getrandbits(8) for _ in
+                                     range(rand.randint(0, 511)))))
+                    for _ in range(rand.randint(0, 20))]
+
+            self.assertEqual(_index(tlvs),
+                             lldp.parse_frame(fakes.lldp_frame(tlvs)))
+
+    def test_parse_random_bytes(self):
+        # Whatever is received, a frame either parses or raises ValueError
+        rand = random.Random(5678)
+        frame = bytearray(fakes.lldp_frame(SWITCH1_TLVS))
+        for _ in range(2000):
+            mutated = bytearray(frame)
+            for _ in range(rand.randint(1, 8)):
+                mutated[rand.randrange(len(mutated))] = rand.getrandbits(8)
+            mutated = bytes(mutated[:rand.randint(0, len(mutated))])
+            try:
+                tlvs = lldp.parse_frame(mutated)
+            except ValueError:
+                continue
+            for tlv_type in tlvs.types():
+                self.assertTrue(1 <= tlv_type <= 127)
+                for value in tlvs.get(tlv_type):
+                    self.assertIsInstance(value, bytes)
+
+
+class TestCapture(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestCapture, self).setUp()
+        # interface name -> the end of a socket pair frames are sent to
+        self.senders = {}
+        self.opened = []
+
+    def _open_socket(self, interface_name):
+        if interface_name not in self.senders:
+            raise socket.error('No such device')
+        receiver, sender = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        self.senders[interface_name] = sender
+        self.opened.append(receiver)
+        return receiver
+
+    def test_capture(self):
+        self.senders = {'eth0': None, 'eth1': None}
+        switch2_tlvs = [(1, b'\x07switch2'), (2, b'\x05Ethernet2/1')]
+
+        def _open_socket(interface_name):
+            sock = self._open_socket(interface_name)
+            # Both frames are sent once every interface is listening
+            if len(self.opened) == 2:
+                self.senders['eth1'].send(fakes.lldp_frame(switch2_tlvs))
+                self.senders['eth0'].send(fakes.lldp_frame(SWITCH1_TLVS))
+            return sock
+
+        lldp_info = lldp.capture(['eth0', 'eth1'], 5,
+                                 open_socket=_open_socket)
+
+        self.assertEqual({'eth0': _index(SWITCH1_TLVS),
+                          'eth1': _index(switch2_tlvs)}, lldp_info)
+
+    def test_capture_stops_when_done(self):
+        self.senders = {'eth0': None, 'eth1': None}
+
+        def _open_socket(interface_name):
+            sock = self._open_socket(interface_name)
+            if interface_name == 'eth0':
+                self.senders['eth0'].send(fakes.lldp_frame(SWITCH1_TLVS))
+            return sock
+
+        start = time.time()
+        lldp_info = lldp.capture(['eth0', 'eth1'], 30,
+                                 done=lambda info: 'eth0' in info,
+                                 open_socket=_open_socket)
+
+        # eth1 never sends anything, but isn't waited for
+        self.assertEqual({'eth0': _index(SWITCH1_TLVS)}, lldp_info)
+        self.assertLess(time.time() - start, 10)
+
+    def test_capture_timeout(self):
+        self.senders = {'eth0': None}
+
+        start = time.time()
+        lldp_info = lldp.capture(['eth0'], 0.2,
+                                 open_socket=self._open_socket)
+
+        self.assertEqual({}, lldp_info)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_capture_skips_bad_frames(self):
+        self.senders = {'eth0': None}
+
+        def _open_socket(interface_name):
+            sock = self._open_socket(interface_name)
+            self.senders['eth0'].send(fakes.lldp_frame(SWITCH1_TLVS)[:-5])
+            self.senders['eth0'].send(fakes.lldp_frame(SWITCH1_TLVS))
+            return sock
+
+        self.assertEqual({'eth0': _index(SWITCH1_TLVS)},
+                         lldp.capture(['eth0'], 5, open_socket=_open_socket))
+
+    def test_capture_interface_unavailable(self):
+        self.senders = {'eth0': None}
+
+        def _open_socket(interface_name):
+            sock = self._open_socket(interface_name)
+            self.senders['eth0'].send(fakes.lldp_frame(SWITCH1_TLVS))
+            return sock
+
+        self.assertEqual({'eth0': _index(SWITCH1_TLVS)},
+                         lldp.capture(['eth0', 'eth9'], 5,
+                                      open_socket=_open_socket))
+
+    def test_capture_interface_fails(self):
+        self.senders = {'eth0': None, 'eth1': None}
+        broken = []
+
+        class _BrokenSocket(object):
+            def __init__(self, sock):
+                self.sock = sock
+                self.closed = False
+
+            def fileno(self):
+                return self.sock.fileno()
+
+            def recv(self, size):
+                raise socket.error(errno.ENETDOWN, 'Network is down')
+
+            def close(self):
+                self.sock.close()
+                self.closed = True
+
+        def _open_socket(interface_name):
+            sock = self._open_socket(interface_name)
+            if interface_name == 'eth1':
+                self.senders['eth1'].send(fakes.lldp_frame(SWITCH1_TLVS))
+                broken.append(_BrokenSocket(sock))
+                return broken[0]
+            self.senders['eth0'].send(fakes.lldp_frame(SWITCH1_TLVS))
+            return sock
+
+        self.assertEqual({'eth0': _index(SWITCH1_TLVS)},
+                         lldp.capture(['eth0', 'eth1'], 5,
+                                      open_socket=_open_socket))
+        self.assertTrue(broken[0].closed)
@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import mock
 import os
+import re
+import shutil
 import six
+import tempfile
+import threading
 
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
@@ -22,6 +27,12 @@ from ironic_python_agent import utils
 from oslotest import base as test_base
 
 import onmetal_ironic_hardware_manager as onmetal_hardware_manager
+from onmetal_ironic_hardware_manager import executor
+from onmetal_ironic_hardware_manager import inventory
+from onmetal_ironic_hardware_manager import lldp
+from onmetal_ironic_hardware_manager import smart
+from onmetal_ironic_hardware_manager.tests import fakes
+from onmetal_ironic_hardware_manager import wipe
 
 if six.PY2:
     OPEN_FUNCTION_NAME = '__builtin__.open'
@@ -40,6 +51,12 @@ DDOEMCLI_LISTALL_OUT = _read_file('data/ddoemcli_listall_out.txt')
 DDOEMCLI_HEALTH_OUT = _read_file('data/ddoemcli_health_out.txt')
 SMARTCTL_ATTRIBUTES_OUT = _read_file('data/smartctl_attributes_out.txt')
 
+
+def _chunked(output, size=7):
+    """Split output into chunks that don't end on line boundaries."""
+    return [output[i:i + size] for i in range(0, len(output), size)]
+
+
 WARPDRIVE_ATTRIBUTES = {
     '4_FL00AV2L': {
         'DevicePowerCycleCount': '49',
@@ -119,204 +136,85 @@ WARPDRIVE_ATTRIBUTES = {
     }
 }
 
-SMARTCTL_ATTRIBUTES = {
-    '1-Raw_Read_Error_Rate': {
-        'FLAG': '0x000a',
-        'RAW_VALUE': '0',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '10-Unknown_SSD_Attribute': {
-        'FLAG': '0x0013',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '12-Power_Cycle_Count': {
-        'FLAG': '0x0012',
-        'RAW_VALUE': '68',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '167-Unknown_Attribute': {
-        'FLAG': '0x0022',
-        'RAW_VALUE': '0',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '168-Unknown_Attribute': {
-        'FLAG': '0x0012',
-        'RAW_VALUE': '0',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '169-Unknown_Attribute': {
-        'FLAG': '0x0013',
-        'RAW_VALUE': '262144',
-        'THRESH': '010',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '170-Unknown_Attribute': {
-        'FLAG': '0x0013',
-        'RAW_VALUE': '0',
-        'THRESH': '010',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '173-Unknown_Attribute': {
-        'FLAG': '0x0012',
-        'RAW_VALUE': '262146',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '199',
-        'WHEN_FAILED': '-',
-        'WORST': '199'
-    },
-    '175-Program_Fail_Count_Chip': {
-        'FLAG': '0x0013',
-        'RAW_VALUE': '0',
-        'THRESH': '010',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '192-Power-Off_Retract_Count': {
-        'FLAG': '0x0012',
-        'RAW_VALUE': '0',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '194-Temperature_Celsius': {
-        'FLAG': '0x0023',
-        'RAW_VALUE': '40',
-        'THRESH': '030',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '197-Current_Pending_Sector': {
-        'FLAG': '0x0012',
-        'RAW_VALUE': '0',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '2-Throughput_Performance': {
-        'FLAG': '0x0005',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Offline',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '240-Unknown_SSD_Attribute': {
-        'FLAG': '0x0013',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '3-Spin_Up_Time': {
-        'FLAG': '0x0007',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '5-Reallocated_Sector_Ct': {
-        'FLAG': '0x0013',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '7-Unknown_SSD_Attribute': {
-        'FLAG': '0x000b',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '8-Unknown_SSD_Attribute': {
-        'FLAG': '0x0005',
-        'RAW_VALUE': '0',
-        'THRESH': '050',
-        'TYPE': 'Pre-fail',
-        'UPDATED': 'Offline',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    },
-    '9-Power_On_Hours': {
-        'FLAG': '0x0012',
-        'RAW_VALUE': '1673',
-        'THRESH': '000',
-        'TYPE': 'Old_age',
-        'UPDATED': 'Always',
-        'VALUE': '100',
-        'WHEN_FAILED': '-',
-        'WORST': '100'
-    }
-}
+SMARTCTL_ATTRIBUTES = dict((attribute.key, attribute) for attribute in [
+    smart.SmartAttribute(
+        1, 'Raw_Read_Error_Rate', '0x000a', 100, 100, 0,
+        'Old_age', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        2, 'Throughput_Performance', '0x0005', 100, 100, 50,
+        'Pre-fail', 'Offline', '-', '0'),
+    smart.SmartAttribute(
+        3, 'Spin_Up_Time', '0x0007', 100, 100, 50,
+        'Pre-fail', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        5, 'Reallocated_Sector_Ct', '0x0013', 100, 100, 50,
+        'Pre-fail', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        7, 'Unknown_SSD_Attribute', '0x000b', 100, 100, 50,
+        'Pre-fail', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        8, 'Unknown_SSD_Attribute', '0x0005', 100, 100, 50,
+        'Pre-fail', 'Offline', '-', '0'),
+    smart.SmartAttribute(
+        9, 'Power_On_Hours', '0x0012', 100, 100, 0,
+        'Old_age', 'Always', '-', '1673'),
+    smart.SmartAttribute(
+        10, 'Unknown_SSD_Attribute', '0x0013', 100, 100, 50,
+        'Pre-fail', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        12, 'Power_Cycle_Count', '0x0012', 100, 100, 0,
+        'Old_age', 'Always', '-', '68'),
+    smart.SmartAttribute(
+        167, 'Unknown_Attribute', '0x0022', 100, 100, 0,
+        'Old_age', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        168, 'Unknown_Attribute', '0x0012', 100, 100, 0,
+        'Old_age', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        169, 'Unknown_Attribute', '0x0013', 100, 100, 10,
+        'Pre-fail', 'Always', '-', '262144'),
+    smart.SmartAttribute(
+        170, 'Unknown_Attribute', '0x0013', 100, 100, 10,
+        'Pre-fail', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        173, 'Unknown_Attribute', '0x0012', 199, 199, 0,
+        'Old_age', 'Always', '-', '262146'),
+    smart.SmartAttribute(
+        175, 'Program_Fail_Count_Chip', '0x0013', 100, 100, 10,
+        'Pre-fail', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        192, 'Power-Off_Retract_Count', '0x0012', 100, 100, 0,
+        'Old_age', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        194, 'Temperature_Celsius', '0x0023', 100, 100, 30,
+        'Pre-fail', 'Always', '-', '40 (Min/Max 30/60)'),
+    smart.SmartAttribute(
+        197, 'Current_Pending_Sector', '0x0012', 100, 100, 0,
+        'Old_age', 'Always', '-', '0'),
+    smart.SmartAttribute(
+        240, 'Unknown_SSD_Attribute', '0x0013', 100, 100, 50,
+        'Pre-fail', 'Always', '-', '0')
+])
 
 
 class TestOnMetalHardwareManager(test_base.BaseTestCase):
     def setUp(self):
         super(TestOnMetalHardwareManager, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        snapshot_patcher = mock.patch.object(
+            onmetal_hardware_manager, 'SMART_SNAPSHOT_PATH',
+            os.path.join(self.tempdir, 'smart.json'))
+        snapshot_patcher.start()
+        self.addCleanup(snapshot_patcher.stop)
+        journal_patcher = mock.patch.object(
+            onmetal_hardware_manager, 'JOURNAL_PATH',
+            os.path.join(self.tempdir, 'journal.json'))
+        journal_patcher.start()
+        self.addCleanup(journal_patcher.stop)
         self.hardware = onmetal_hardware_manager.OnMetalHardwareManager()
+        self.hardware._hardware_profile = inventory.HardwareProfile(
+            'Quanta', 'OnMetal', (), None)
         self.block_device = hardware.BlockDevice('/dev/sda', 'NWD-BLP4-1600',
                                                  1073741824, False)
 
@@ -349,26 +247,186 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
         devices = self.hardware._list_lsi_devices()
         self.assertEqual(self.FAKE_DEVICES, devices)
 
-    @mock.patch.object(os.path, 'realpath')
     @mock.patch.object(utils, 'execute')
+    def test__get_lsi_inventory(self, mocked_execute):
+        mocked_execute.return_value = (DDOEMCLI_LISTALL_OUT, '')
+
+        inventory = self.hardware._get_lsi_inventory()
+        # A second lookup is served from the cache
+        self.assertIs(inventory, self.hardware._get_lsi_inventory())
+
+        mocked_execute.assert_called_once_with(
+            onmetal_hardware_manager.DDOEMCLI, '-listall',
+            on_execute=mock.ANY, on_completion=mock.ANY)
+        self.assertEqual(self.FAKE_DEVICES, inventory['devices'])
+        self.assertEqual({'1': self.FAKE_DEVICES[0],
+                          '2': self.FAKE_DEVICES[1]}, inventory['by_id'])
+        self.assertEqual({'00:02:00': [self.FAKE_DEVICES[0]],
+                          '00:04:00': [self.FAKE_DEVICES[1]]},
+                         inventory['by_pci_address'])
+
+    @mock.patch.object(utils, 'execute')
+    def test__get_lsi_inventory_invalidated(self, mocked_execute):
+        mocked_execute.return_value = (DDOEMCLI_LISTALL_OUT, '')
+
+        self.hardware._get_lsi_inventory()
+        self.hardware._invalidate_caches()
+        self.hardware._get_lsi_inventory()
+
+        self.assertEqual(2, mocked_execute.call_count)
+
+    @mock.patch.object(os, 'listdir')
+    @mock.patch.object(os.path, 'realpath')
+    def test__get_block_device_topology(self, mocked_realpath,
+                                        mocked_listdir):
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        mocked_listdir.return_value = ['sda', 'sdb', 'sdc', 'loop0']
+        sys_paths = {
+            '/sys/block/sda': ('/sys/devices/pci0000:00/0000:00:02.0'
+                '/0000:02:00.0/host3/target3:1:0/3:1:0:0/block/sda'),
+            # The card sits behind a PCIe switch
+            '/sys/block/sdb': ('/sys/devices/pci0000:00/0000:00:03.0'
+                '/0000:02:00.0/0000:03:01.0/0000:04:00.0/host4'
+                '/target4:1:0/4:1:0:0/block/sdb'),
+            '/sys/block/sdc': ('/sys/devices/pci0000:00/0000:00:1f.2/ata1'
+                '/host0/target0:0:0/0:0:0:0/block/sdc'),
+            '/sys/block/loop0': '/sys/devices/virtual/block/loop0'
+        }
+        mocked_realpath.side_effect = lambda path: sys_paths[path]
+
+        topology = self.hardware._get_block_device_topology()
+
+        self.assertEqual({
+            'sda': {'pci_address': '00:02:00',
+                    'lsi_cards': [self.FAKE_DEVICES[0]]},
+            'sdb': {'pci_address': '00:04:00',
+                    'lsi_cards': [self.FAKE_DEVICES[1]]},
+            'sdc': {'pci_address': '00:00:1f', 'lsi_cards': []},
+            'loop0': {'pci_address': None, 'lsi_cards': []},
+        }, topology)
+        mocked_listdir.assert_called_once_with('/sys/block')
+        self.assertEqual(1, self.hardware._list_lsi_devices.call_count)
+
+    @mock.patch.object(os, 'listdir', lambda path: ['sda', 'sdb'])
+    @mock.patch.object(os.path, 'realpath')
+    def test__get_warpdrive_card_indexed_once(self, mocked_realpath):
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        mocked_realpath.side_effect = [
+            ('/sys/devices/pci0000:00/0000:00:02.0/0000:02:00.0/host3'
+             '/target3:1:0/3:1:0:0/block/sda'),
+            ('/sys/devices/pci0000:00/0000:00:03.0/0000:04:00.0/host4'
+             '/target4:1:0/4:1:0:0/block/sdb')]
+        sdb = hardware.BlockDevice('/dev/sdb', 'NWD-BLP4-1600', 1073741824,
+                                   False)
+
+        self.assertEqual(self.FAKE_DEVICES[0],
+                         self.hardware._get_warpdrive_card(self.block_device))
+        self.assertEqual(self.FAKE_DEVICES[1],
+                         self.hardware._get_warpdrive_card(sdb))
+        self.assertEqual(2, mocked_realpath.call_count)
+        self.assertEqual(1, self.hardware._list_lsi_devices.call_count)
+
+    @mock.patch.object(os, 'listdir', lambda path: ['sda'])
+    @mock.patch.object(os.path, 'realpath')
+    @mock.patch.object(executor, 'stream')
     def test_erase_block_device_lsi_success(self,
-                                            mocked_execute,
+                                            mocked_stream,
                                             mocked_realpath):
         self.hardware._list_lsi_devices = mock.Mock()
         self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        self.hardware._send_gauges = mock.Mock()
 
         # Mock the PCI address lookup
         mocked_realpath.return_value = ('/sys/devices/pci0000:00/0000:00:02.0'
             '/0000:02:00.0/host3/target3:1:0/3:1:0:0/block/sdb')
 
-        mocked_execute.return_value = (DDOEMCLI_FORMAT_OUT, '')
+        mocked_stream.return_value = (chunk for chunk in
+                                       _chunked(DDOEMCLI_FORMAT_OUT))
 
         self.hardware.erase_block_device(self.block_device)
 
-        mocked_execute.assert_called_once_with(
-                onmetal_hardware_manager.DDOEMCLI,
-                '-c', '1', '-format', '-op', '-level', 'nom', '-s')
+        mocked_stream.assert_called_once_with(
+                [onmetal_hardware_manager.DDOEMCLI,
+                 '-c', '1', '-format', '-op', '-level', 'nom', '-s'],
+                stall_timeout=(
+                    onmetal_hardware_manager.LSI_FORMAT_STALL_TIMEOUT),
+                on_stall=mock.ANY, tty=True)
+        sent = {}
+        for call in self.hardware._send_gauges.call_args_list:
+            self.assertEqual('warpdrive_format_1', call[0][0])
+            sent.update(call[0][1])
+        self.assertEqual(set(['start.seconds', 'prepare.seconds',
+                              'format.seconds', 'media_erase_passes']),
+                         set(sent))
+        self.assertEqual(4, sent['media_erase_passes'])
+
+    @mock.patch.object(os, 'listdir', lambda path: ['sda'])
+    @mock.patch.object(os.path, 'realpath')
+    @mock.patch.object(executor, 'stream')
+    @mock.patch.object(onmetal_hardware_manager, 'LOG')
+    def test_erase_block_device_lsi_stalled(self, mocked_log, mocked_stream,
+                                            mocked_realpath):
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        self.hardware._send_gauges = mock.Mock()
+        mocked_realpath.return_value = ('/sys/devices/pci0000:00/0000:00:02.0'
+            '/0000:02:00.0/host3/target3:1:0/3:1:0:0/block/sdb')
 
+        def _stream(cmd, stall_timeout, on_stall, tty):
+            split = DDOEMCLI_FORMAT_OUT.index('.....')
+            yield DDOEMCLI_FORMAT_OUT[:split]
+            on_stall(stall_timeout)
+            yield DDOEMCLI_FORMAT_OUT[split:]
+        mocked_stream.side_effect = _stream
+
+        # A quiet format is only warned about, and left to finish
+        self.hardware.erase_block_device(self.block_device)
+
+        self.assertEqual(1, mocked_log.warning.call_count)
+        self.assertEqual('format',
+                         mocked_log.warning.call_args[0][1]['phase'])
+
+    @mock.patch.object(os, 'listdir', lambda path: ['sda'])
+    @mock.patch.object(os.path, 'realpath')
+    @mock.patch.object(executor, 'stream')
+    @mock.patch.object(onmetal_hardware_manager, 'LOG')
+    def test_erase_block_device_lsi_stall_killed(self, mocked_log,
+                                                 mocked_stream,
+                                                 mocked_realpath):
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        self.hardware._send_gauges = mock.Mock()
+        mocked_realpath.return_value = ('/sys/devices/pci0000:00/0000:00:02.0'
+            '/0000:02:00.0/host3/target3:1:0/3:1:0:0/block/sdb')
+        warnings = onmetal_hardware_manager.LSI_FORMAT_STALL_WARNINGS
+
+        def _stream(cmd, stall_timeout, on_stall, tty):
+            split = DDOEMCLI_FORMAT_OUT.index('.....')
+            yield DDOEMCLI_FORMAT_OUT[:split]
+            for count in range(1, warnings + 1):
+                on_stall(stall_timeout * count)
+            yield DDOEMCLI_FORMAT_OUT[split:]
+        mocked_stream.side_effect = _stream
+
+        exc = self.assertRaises(errors.BlockDeviceEraseError,
+                                self.hardware.erase_block_device,
+                                self.block_device)
+        self.assertIn('WarpDrive 1 stalled in the format phase', str(exc))
+        self.assertEqual(warnings - 1, mocked_log.warning.call_count)
+
+    def test__parse_warpdrive_format(self):
+        expected = [('phase', 'prepare'), ('phase', 'format'), ('pass', 1),
+                    ('pass', 2), ('pass', 3), ('pass', 4),
+                    ('phase', 'complete')]
+
+        for size in (1, 7, len(DDOEMCLI_FORMAT_OUT)):
+            self.assertEqual(expected, list(
+                onmetal_hardware_manager._parse_warpdrive_format(
+                    _chunked(DDOEMCLI_FORMAT_OUT, size))))
+
+    @mock.patch.object(os, 'listdir', lambda path: ['sda'])
     @mock.patch.object(os.path, 'realpath')
     @mock.patch.object(utils, 'execute')
     def test_erase_block_device_lsi_notfound(self,
@@ -390,6 +448,7 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
 
         self.assertEqual(0, mocked_execute.call_count)
 
+    @mock.patch.object(os, 'listdir', lambda path: ['sda'])
     @mock.patch.object(os.path, 'realpath')
     @mock.patch.object(utils, 'execute')
     def test_erase_block_device_lsi_multiple(self,
@@ -412,13 +471,15 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
 
         self.assertEqual(0, mocked_execute.call_count)
 
+    @mock.patch.object(os, 'listdir', lambda path: ['sda'])
     @mock.patch.object(os.path, 'realpath')
-    @mock.patch.object(utils, 'execute')
+    @mock.patch.object(executor, 'stream')
     def test_erase_block_device_lsi_error(self,
-                                          mocked_execute,
+                                          mocked_stream,
                                           mocked_realpath):
         self.hardware._list_lsi_devices = mock.Mock()
         self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        self.hardware._send_gauges = mock.Mock()
 
         mocked_realpath.return_value = ('/sys/devices/pci0000:00/0000:00:02.0'
             '/0000:02:00.0/host3/target3:1:0/3:1:0:0/block/sdb')
@@ -428,14 +489,16 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
             'WarpDrive format successfully completed.',
             'Something went terribly, terribly wrong.')
 
-        mocked_execute.return_value = (error_output, '')
+        mocked_stream.return_value = (chunk for chunk in [error_output])
         self.assertRaises(errors.BlockDeviceEraseError,
                           self.hardware.erase_block_device,
                           self.block_device)
 
-        mocked_execute.assert_called_once_with(
-            onmetal_hardware_manager.DDOEMCLI,
-            '-c', '1', '-format', '-op', '-level', 'nom', '-s'),
+        mocked_stream.assert_called_once_with(
+            [onmetal_hardware_manager.DDOEMCLI,
+             '-c', '1', '-format', '-op', '-level', 'nom', '-s'],
+            stall_timeout=onmetal_hardware_manager.LSI_FORMAT_STALL_TIMEOUT,
+            on_stall=mock.ANY, tty=True)
 
     @mock.patch('ironic_python_agent.hardware.GenericHardwareManager'
                 '.erase_block_device')
@@ -450,15 +513,120 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
         self.assertEqual(0, mocked_execute.call_count)
         mocked_generic.assert_called_once_with(self.block_device)
 
+    @mock.patch('ironic_python_agent.hardware.GenericHardwareManager'
+                '.erase_block_device')
+    def test_erase_devices(self, mocked_generic):
+        satadom = hardware.BlockDevice('/dev/sdc', '32G MLC SATADOM',
+                                       31016853504, False)
+        warpdrives = [
+            hardware.BlockDevice('/dev/sda', 'NWD-BLP4-1600', 1073741824,
+                                 False),
+            hardware.BlockDevice('/dev/sdb', 'NWD-BLP4-1600', 1073741824,
+                                 False)]
+        block_devices = [satadom] + warpdrives
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = block_devices
+
+        # Every device has to be erasing at the same time for any of them
+        # to finish.
+        all_started = threading.Event()
+        started = []
+
+        def _wait_for_all(block_device):
+            started.append(block_device)
+            if len(started) == len(block_devices):
+                all_started.set()
+            self.assertTrue(all_started.wait(5))
+
+        def _erase(block_device):
+            if block_device not in warpdrives:
+                return False
+            _wait_for_all(block_device)
+            return True
+
+        self.hardware._erase_lsi_warpdrive = mock.Mock(side_effect=_erase)
+        mocked_generic.side_effect = _wait_for_all
+
+        report = self.hardware.erase_devices({}, [])
+
+        self.assertEqual(
+            [('/dev/sdc', 'generic', 31016853504),
+             ('/dev/sda', 'warpdrive', 1073741824),
+             ('/dev/sdb', 'warpdrive', 1073741824)],
+            [(entry['device'], entry['method'], entry['bytes'])
+             for entry in report])
+        self.assertTrue(all(entry['success'] for entry in report))
+        self.assertTrue(all(entry['throughput'] > 0 for entry in report))
+        mocked_generic.assert_called_once_with(satadom)
+
+    @mock.patch('ironic_python_agent.hardware.GenericHardwareManager'
+                '.erase_block_device')
+    def test_erase_devices_generic_fails(self, mocked_generic):
+        disks = [
+            hardware.BlockDevice('/dev/sdc', '32G MLC SATADOM', 31016853504,
+                                 False),
+            hardware.BlockDevice('/dev/sdd', '32G MLC SATADOM', 31016853504,
+                                 False)]
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = disks
+
+        def _erase(block_device):
+            if block_device.name == '/dev/sdc':
+                raise errors.BlockDeviceEraseError('shred failed')
+        mocked_generic.side_effect = _erase
+
+        error = self.assertRaises(errors.BlockDeviceEraseError,
+                                  self.hardware.erase_devices, {}, [])
+        self.assertIn('Erasing 1 of 2 block devices failed: /dev/sdc',
+                      str(error))
+        # The second disk is still erased after the first one fails
+        mocked_generic.assert_has_calls(
+            [mock.call(disks[0]), mock.call(disks[1])], any_order=True)
+
+    @mock.patch('ironic_python_agent.hardware.GenericHardwareManager'
+                '.erase_block_device')
+    def test_erase_devices_one_card_fails(self, mocked_generic):
+        warpdrives = [
+            hardware.BlockDevice('/dev/sda', 'NWD-BLP4-1600', 1073741824,
+                                 False),
+            hardware.BlockDevice('/dev/sdb', 'NWD-BLP4-1600', 1073741824,
+                                 False)]
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = warpdrives
+
+        def _erase(block_device):
+            if block_device.name == '/dev/sda':
+                raise errors.BlockDeviceEraseError('format failed')
+            return True
+
+        self.hardware._erase_lsi_warpdrive = mock.Mock(side_effect=_erase)
+
+        self.assertRaises(errors.BlockDeviceEraseError,
+                          self.hardware.erase_devices, {}, [])
+        # The second card is still formatted after the first one fails
+        self.hardware._erase_lsi_warpdrive.assert_has_calls(
+            [mock.call(warpdrives[0]), mock.call(warpdrives[1])],
+            any_order=True)
+        self.assertEqual(0, mocked_generic.call_count)
+
+    def _flash_calls(self, mocked_execute, device_id):
+        return [call for call in mocked_execute.call_args_list
+                if call[0][2] == device_id]
+
     @mock.patch.object(utils, 'execute')
     def test_update_warpdrive_firmware_upgrade_both(self, mocked_execute):
+        mocked_execute.return_value = ('', '')
         self.FAKE_DEVICES[0]['version'] = '11.00.00.00'
         self.FAKE_DEVICES[1]['version'] = '11.00.00.00'
 
         self.hardware._list_lsi_devices = mock.Mock()
         self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
-        self.hardware.update_warpdrive_firmware({}, [])
-        mocked_execute.assert_has_calls([
+        report = self.hardware.update_warpdrive_firmware({}, [])
+
+        # Cards are flashed concurrently, so only the order of the flashes
+        # for each card is known
+        self.assertEqual(4, mocked_execute.call_count)
+        self.assertEqual([
             mock.call(
                 onmetal_hardware_manager.DDOEMCLI, '-c', '1', '-f',
                 os.path.join(onmetal_hardware_manager.LSI_WARPDRIVE_DIR,
@@ -469,6 +637,8 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
                 os.path.join(onmetal_hardware_manager.LSI_WARPDRIVE_DIR,
                              onmetal_hardware_manager.LSI_FIRMWARE_PACKAGE),
                 check_exit_code=[0]),
+        ], self._flash_calls(mocked_execute, '1'))
+        self.assertEqual([
             mock.call(
                 onmetal_hardware_manager.DDOEMCLI, '-c', '2', '-f',
                 os.path.join(onmetal_hardware_manager.LSI_WARPDRIVE_DIR,
@@ -479,15 +649,19 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
                 os.path.join(onmetal_hardware_manager.LSI_WARPDRIVE_DIR,
                              onmetal_hardware_manager.LSI_FIRMWARE_PACKAGE),
                 check_exit_code=[0]),
-        ])
+        ], self._flash_calls(mocked_execute, '2'))
+        self.assertEqual([True, True], [card['success'] for card in report])
+        self.assertEqual([['preflash', 'package'], ['preflash', 'package']],
+                         [card['flashes'] for card in report])
 
     @mock.patch.object(utils, 'execute')
     def test_update_warpdrive_firmware_upgrade_one(self, mocked_execute):
+        mocked_execute.return_value = ('', '')
         self.FAKE_DEVICES[1]['version'] = '11.00.00.00'
 
         self.hardware._list_lsi_devices = mock.Mock()
         self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
-        self.hardware.update_warpdrive_firmware({}, [])
+        report = self.hardware.update_warpdrive_firmware({}, [])
         mocked_execute.assert_has_calls([
             mock.call(
                 onmetal_hardware_manager.DDOEMCLI, '-c', '2', '-f',
@@ -500,6 +674,58 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
                              onmetal_hardware_manager.LSI_FIRMWARE_PACKAGE),
                 check_exit_code=[0])
         ])
+        self.assertEqual([
+            {'id': '1', 'version': '12.22.00.00', 'flashes': [],
+             'success': True, 'duration': 0, 'error': None},
+            {'id': '2', 'version': '11.00.00.00',
+             'flashes': ['preflash', 'package'], 'success': True,
+             'duration': mock.ANY, 'error': None},
+        ], report)
+
+    @mock.patch.object(onmetal_hardware_manager,
+                       'LSI_FIRMWARE_PREFLASH_VERSION', '12.00.00.00')
+    @mock.patch.object(utils, 'execute')
+    def test_update_warpdrive_firmware_skips_preflash(self, mocked_execute):
+        mocked_execute.return_value = ('', '')
+        self.FAKE_DEVICES[0]['version'] = '11.00.00.00'
+        self.FAKE_DEVICES[1]['version'] = '12.10.00.00'
+
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        report = self.hardware.update_warpdrive_firmware({}, [])
+
+        self.assertEqual(3, mocked_execute.call_count)
+        self.assertEqual([
+            mock.call(
+                onmetal_hardware_manager.DDOEMCLI, '-c', '2', '-updatepkg',
+                os.path.join(onmetal_hardware_manager.LSI_WARPDRIVE_DIR,
+                             onmetal_hardware_manager.LSI_FIRMWARE_PACKAGE),
+                check_exit_code=[0]),
+        ], self._flash_calls(mocked_execute, '2'))
+        self.assertEqual([['preflash', 'package'], ['package']],
+                         [card['flashes'] for card in report])
+
+    @mock.patch.object(utils, 'execute')
+    def test_update_warpdrive_firmware_one_card_fails(self, mocked_execute):
+        self.FAKE_DEVICES[0]['version'] = '11.00.00.00'
+        self.FAKE_DEVICES[1]['version'] = '11.00.00.00'
+
+        def fake_execute(*cmd, **kwargs):
+            if cmd[2] == '1' and cmd[3] == '-f':
+                raise errors.CleaningError('preflash failed')
+            return ('', '')
+        mocked_execute.side_effect = fake_execute
+
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+
+        error = self.assertRaises(errors.CleaningError,
+                                  self.hardware.update_warpdrive_firmware,
+                                  {}, [])
+        self.assertIn('Flashing 1 of 2 LSI cards failed', str(error))
+        # Card 1 stops at its failed preflash, card 2 is flashed anyway
+        self.assertEqual(1, len(self._flash_calls(mocked_execute, '1')))
+        self.assertEqual(2, len(self._flash_calls(mocked_execute, '2')))
 
     @mock.patch.object(utils, 'execute')
     def test_update_warpdrive_firmware_same_version(self, mocked_execute):
@@ -509,32 +735,637 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
         self.assertEqual(0, mocked_execute.call_count)
 
     @mock.patch.object(utils, 'execute')
-    def test_remove_bootloader(self, mocked_execute):
+    def test_update_warpdrive_firmware_newer_version(self, mocked_execute):
+        mocked_execute.return_value = ('', '')
+        self.FAKE_DEVICES[0]['version'] = '12.30.00.00'
+        self.FAKE_DEVICES[1]['version'] = '13.00.00.00'
+
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+        report = self.hardware.update_warpdrive_firmware({}, [])
+
+        self.assertEqual(0, mocked_execute.call_count)
+        self.assertEqual([[], []], [card['flashes'] for card in report])
+        self.assertFalse(self.hardware._warpdrive_firmware_needed())
+
+    @mock.patch.object(utils, 'execute')
+    def test_update_warpdrive_firmware_invalidates_inventory(self,
+                                                             mocked_execute):
+        mocked_execute.return_value = ('', '')
+        self.FAKE_DEVICES[0]['version'] = '11.00.00.00'
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+
+        self.hardware.update_warpdrive_firmware({}, [])
+        self.hardware._get_lsi_inventory()
+
+        # Listed once to plan the flash, then again after flashing
+        self.assertEqual(2, self.hardware._list_lsi_devices.call_count)
+
+    def _write_bios_version(self, version):
+        path = os.path.join(self.tempdir, 'bios_version')
+        with open(path, 'w') as f:
+            f.write(version + '\n')
+        patcher = mock.patch.object(onmetal_hardware_manager,
+                                    'DMI_BIOS_VERSION_PATH', path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_step(self, step):
+        for s in self.hardware.get_clean_steps({}, []):
+            if s['step'] == step:
+                return s
+
+    @mock.patch.object(utils, 'execute')
+    def test_upgrade_bios(self, mocked_execute):
+        mocked_execute.return_value = ('', '')
+        self.hardware._list_lsi_devices = mock.Mock(return_value=[])
+        self.hardware._get_bios_settings = mock.Mock(return_value=None)
+        self._write_bios_version('S2S_3A12')
+
+        self.assertIsNotNone(self._get_step('upgrade_bios'))
+        self.hardware.upgrade_bios({}, [])
+
+        mocked_execute.assert_called_once_with(
+            os.path.join(onmetal_hardware_manager.BIOS_DIR, 'flash_bios.sh'),
+            check_exit_code=[0])
+
+    @mock.patch.object(utils, 'execute')
+    def test_upgrade_bios_already_current(self, mocked_execute):
+        self._write_bios_version('S2S_3A14')
+
+        self.assertIsNone(self._get_step('upgrade_bios'))
+        self.hardware.upgrade_bios({}, [])
+
+        self.assertNotIn(
+            mock.call(os.path.join(onmetal_hardware_manager.BIOS_DIR,
+                                   'flash_bios.sh'), check_exit_code=[0]),
+            mocked_execute.call_args_list)
+
+    @mock.patch.object(onmetal_hardware_manager, 'DMI_BIOS_VERSION_PATH',
+                       '/nonexistent/bios_version')
+    @mock.patch.object(utils, 'execute')
+    def test_upgrade_bios_version_unknown(self, mocked_execute):
+        mocked_execute.return_value = ('', '')
+        self.hardware._list_lsi_devices = mock.Mock(return_value=[])
+        self.hardware._get_bios_settings = mock.Mock(return_value=None)
+        self.assertIsNotNone(self._get_step('upgrade_bios'))
+        self.hardware.upgrade_bios({}, [])
+
+        self.assertEqual(1, mocked_execute.call_count)
+
+    def _write_boot_id(self, boot_id):
+        path = os.path.join(self.tempdir, 'boot_id')
+        with open(path, 'w') as f:
+            f.write(boot_id + '\n')
+        patcher = mock.patch.object(onmetal_hardware_manager,
+                                    'BOOT_ID_PATH', path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _flashes(self, mocked_execute):
+        return [c for c in mocked_execute.call_args_list
+                if c[0][0].endswith('flash_bios.sh')]
+
+    @mock.patch.object(utils, 'execute')
+    def test_upgrade_bios_journal(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n')
+        self._write_bios_version('S2S_3A12')
+        with open(os.path.join(self.tempdir, 'flash_bios.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        self._write_boot_id('boot-1')
+        node = {'uuid': 'node-1'}
+
+        self.hardware.upgrade_bios(node, [])
+        # Retried before rebooting: DMI still shows the old version
+        self.hardware.upgrade_bios(node, [])
+        self.assertEqual(1, len(self._flashes(mocked_execute)))
+
+        # Rebooted, and the old version means the flash didn't take
+        self._write_boot_id('boot-2')
+        self.hardware.upgrade_bios(node, [])
+        self.assertEqual(2, len(self._flashes(mocked_execute)))
+
+        # Another node sharing the storage isn't affected
+        self.hardware.upgrade_bios({'uuid': 'node-2'}, [])
+        self.assertEqual(3, len(self._flashes(mocked_execute)))
+
+    @mock.patch.object(utils, 'execute')
+    def test_decom_bios_settings_journal_after_flash(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Disabled\n')
+        self._write_bios_version('S2S_3A12')
+        with open(os.path.join(self.tempdir, 'flash_bios.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        self._write_boot_id('boot-1')
+        node = {'uuid': 'node-1'}
+
+        self.hardware.decom_bios_settings(node, [])
+        # The settings can't be read yet, but the journal shows they were
+        # written
+        self.hardware.decom_bios_settings(node, [])
+        self.assertEqual(['write_bios_settings_decom.sh'],
+                         self._bios_writes(mocked_execute))
+
+        # Flashing the BIOS may have reset them
+        self._write_boot_id('boot-2')
+        self.hardware.upgrade_bios(node, [])
+        self.hardware.decom_bios_settings(node, [])
+        self.assertEqual(['write_bios_settings_decom.sh'] * 2,
+                         self._bios_writes(mocked_execute))
+
+    @mock.patch.object(utils, 'execute')
+    def test_decom_bios_settings_journal_before_reboot(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Disabled\n')
+        self._write_bios_version('S2S_3A12')
+        self._write_boot_id('boot-1')
+        node = {'uuid': 'node-1'}
+        self.hardware.decom_bios_settings(node, [])
+
+        # Rebooted into the new BIOS, whose settings can't be read
+        self._write_boot_id('boot-2')
+        self._write_bios_version('S2S_3A14')
+        self.hardware._invalidate_caches()
+
+        def fake_execute(*cmd, **kwargs):
+            if cmd[0].endswith('read_bios_settings.sh'):
+                raise OSError('read_bios_settings.sh failed')
+            return ('', '')
+        mocked_execute.side_effect = fake_execute
+
+        # What was written to the old BIOS doesn't count any more
+        self.assertIsNotNone(self._get_step('decom_bios_settings'))
+        self.hardware.decom_bios_settings(node, [])
+        self.assertEqual(['write_bios_settings_decom.sh'] * 2,
+                         self._bios_writes(mocked_execute))
+
+    @mock.patch.object(onmetal_hardware_manager, 'JOURNAL_PATH', None)
+    @mock.patch.object(utils, 'execute')
+    def test_decom_bios_settings_journal_disabled(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Disabled\n')
+        self._write_bios_version('S2S_3A12')
+
+        self.hardware.decom_bios_settings({'uuid': 'node-1'}, [])
+        self.hardware.decom_bios_settings({'uuid': 'node-1'}, [])
+
+        self.assertEqual(['write_bios_settings_decom.sh'] * 2,
+                         self._bios_writes(mocked_execute))
+
+    def _setup_bios_settings(self, mocked_execute, current, decom=None,
+                             customer=None):
+        """Put BIOS settings profiles and a BIOS version in a temp BIOS_DIR.
+
+        The BIOS is always current, and the read script prints current.
+        """
+        self._write_bios_version('S2S_3A14')
+        for name, settings in (('decom', decom), ('customer', customer)):
+            if settings is not None:
+                path = os.path.join(self.tempdir,
+                                    'bios_settings_{0}.txt'.format(name))
+                with open(path, 'w') as f:
+                    f.write(settings)
+        patcher = mock.patch.object(onmetal_hardware_manager, 'BIOS_DIR',
+                                    self.tempdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def fake_execute(*cmd, **kwargs):
+            if cmd[0].endswith('read_bios_settings.sh'):
+                return (current, '')
+            return ('', '')
+        mocked_execute.side_effect = fake_execute
+
+    def _bios_writes(self, mocked_execute):
+        return [os.path.basename(c[0][0])
+                for c in mocked_execute.call_args_list
+                if 'write_bios_settings' in c[0][0]]
+
+    def _journal_steps(self, node_uuid='node-1'):
+        """Return the journal's {step: digest} for a node."""
+        with open(onmetal_hardware_manager.JOURNAL_PATH, 'r') as f:
+            return dict((step, entry['digest']) for step, entry in
+                        six.iteritems(json.load(f).get(node_uuid, {})))
+
+    @mock.patch.object(utils, 'execute')
+    def test_decom_bios_settings(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute,
+                                  'Turbo = Enabled\nHT = Enabled\n',
+                                  decom='# decom\nTurbo = Disabled\n')
+
+        self.hardware.decom_bios_settings({'uuid': 'node-1'}, [])
+
+        self.assertEqual(['write_bios_settings_decom.sh'],
+                         self._bios_writes(mocked_execute))
+        self.assertEqual(['decom_bios_settings'], list(self._journal_steps()))
+
+    @mock.patch.object(utils, 'execute')
+    def test_decom_bios_settings_already_match(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute,
+                                  'Turbo = Disabled\nHT = Enabled\n',
+                                  decom='Turbo=Disabled\n')
+
+        self.hardware.decom_bios_settings({'uuid': 'node-1'}, [])
+
+        self.assertEqual([], self._bios_writes(mocked_execute))
+        self.assertEqual({'decom_bios_settings':
+                          onmetal_hardware_manager._bios_settings_digest(
+                              {'Turbo': 'Disabled'})},
+                         self._journal_steps())
+
+    @mock.patch.object(utils, 'execute')
+    def test_customer_bios_settings_forgets_decom(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Disabled\n',
+                                  customer='Turbo = Enabled\n')
+        node = {'uuid': 'node-1'}
+
+        self.hardware.decom_bios_settings(node, [])
+        self.hardware.customer_bios_settings(node, [])
+
+        # Only the profile the BIOS was last left with is journaled
+        self.assertEqual(['customer_bios_settings'],
+                         list(self._journal_steps()))
+
+    @mock.patch.object(utils, 'execute')
+    def test_customer_bios_settings_no_profile(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n')
+
+        self.hardware.customer_bios_settings({'uuid': 'node-1'}, [])
+
+        self.assertEqual(['write_bios_settings_customer.sh'],
+                         self._bios_writes(mocked_execute))
+        # Without a digest there's nothing to compare with next time
+        self.assertFalse(os.path.exists(
+            onmetal_hardware_manager.JOURNAL_PATH))
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_bios_settings_match(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute,
+                                  'Turbo = Enabled\nHT = Enabled\n',
+                                  decom='HT = Enabled\n',
+                                  customer='Turbo = Enabled\n')
+
+        self.assertIsNone(self._get_step('decom_bios_settings'))
+        self.assertIsNone(self._get_step('customer_bios_settings'))
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_bios_settings_decom_changes(self,
+                                                         mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Disabled\n',
+                                  customer='Turbo = Enabled\n')
+
+        # The customer settings match now, but won't once decom is written
+        self.assertTrue(
+            self._get_step('decom_bios_settings')['reboot_requested'])
+        self.assertTrue(
+            self._get_step('customer_bios_settings')['reboot_requested'])
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_bios_settings_after_flash(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Enabled\n',
+                                  customer='Turbo = Enabled\n')
+        self._write_bios_version('S2S_3A12')
+
+        # Flashing the BIOS may reset its settings
+        self.assertTrue(
+            self._get_step('decom_bios_settings')['reboot_requested'])
+        self.assertIsNone(self._get_step('customer_bios_settings'))
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_bios_settings_unreadable(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Disabled\n',
+                                  decom='Turbo = Disabled\n',
+                                  customer='Turbo = Enabled\n')
+        node = {'uuid': 'node-1'}
+        self.hardware.decom_bios_settings(node, [])
+        self.hardware._invalidate_caches()
+        mocked_execute.side_effect = OSError('no read_bios_settings.sh')
+
+        # The journal shows the BIOS was left with the decom settings
+        steps = self.hardware.get_clean_steps(node, [])
+        self.assertNotIn('decom_bios_settings',
+                         [step['step'] for step in steps])
+        self.assertIn('customer_bios_settings',
+                      [step['step'] for step in steps])
+
+        # Unless the BIOS is going to be flashed, which may reset them
+        self._write_bios_version('S2S_3A12')
+        self.hardware._invalidate_caches()
+        steps = self.hardware.get_clean_steps(node, [])
+        self.assertIn('decom_bios_settings',
+                      [step['step'] for step in steps])
+
+    @mock.patch.object(utils, 'execute')
+    def test_decom_bios_settings_after_flash(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Enabled\n')
+        self._write_bios_version('S2S_3A12')
+
+        self.hardware.decom_bios_settings({}, [])
+
+        # The settings can't be trusted until the new BIOS is booted
+        self.assertEqual(['write_bios_settings_decom.sh'],
+                         self._bios_writes(mocked_execute))
+
+    def _clean_steps(self):
+        return [(step['step'], step['reboot_requested'])
+                for step in self.hardware.get_clean_steps({}, [])]
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps(self, mocked_execute):
+        self._write_bios_version('S2S_3A12')
+        self.FAKE_DEVICES[0]['version'] = '11.00.00.00'
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+
+        # decom_bios_settings must run on the new BIOS, so upgrade_bios
+        # keeps its own reboot
+        self.assertEqual([
+            ('remove_bootloader', False),
+            ('upgrade_bios', True),
+            ('decom_bios_settings', True),
+            ('update_warpdrive_firmware', False),
+            ('erase_devices', False),
+            ('get_disk_metrics', False),
+            ('customer_bios_settings', True),
+            ('verify_ports', False),
+            ('verify_hardware', False),
+        ], self._clean_steps())
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_nothing_to_update(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Enabled\n',
+                                  customer='Turbo = Enabled\n')
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.return_value = self.FAKE_DEVICES
+
+        self.assertEqual([
+            ('remove_bootloader', False),
+            ('erase_devices', False),
+            ('get_disk_metrics', False),
+            ('verify_ports', False),
+            ('verify_hardware', False),
+        ], self._clean_steps())
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_lsi_devices_unknown(self, mocked_execute):
+        self._write_bios_version('S2S_3A14')
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.side_effect = OSError('no ddoemcli')
+
+        self.assertIsNotNone(self._get_step('update_warpdrive_firmware'))
+
+    @mock.patch.object(utils, 'execute')
+    def test_get_clean_steps_checks_once(self, mocked_execute):
+        self._setup_bios_settings(mocked_execute, 'Turbo = Enabled\n',
+                                  decom='Turbo = Enabled\n')
+        mocked_execute.side_effect = OSError('no read_bios_settings.sh')
+        self.hardware._list_lsi_devices = mock.Mock()
+        self.hardware._list_lsi_devices.side_effect = OSError('no ddoemcli')
+
+        first = self._clean_steps()
+        second = self._clean_steps()
+
+        # Steps whose checks failed are listed, without checking again
+        self.assertEqual(first, second)
+        self.assertIn(('update_warpdrive_firmware', False), second)
+        self.assertIn(('decom_bios_settings', True), second)
+        self.assertEqual(1, mocked_execute.call_count)
+        self.assertEqual(1, self.hardware._list_lsi_devices.call_count)
+
+        # Changing the hardware checks again
+        self.hardware._invalidate_caches()
+        self._clean_steps()
+        self.assertEqual(2, self.hardware._list_lsi_devices.call_count)
+
+    def test__coalesce_reboots(self):
+        steps = [
+            {'step': 'c', 'priority': 10, 'reboot_requested': True},
+            {'step': 'a', 'priority': 30, 'reboot_requested': True},
+            {'step': 'b', 'priority': 20, 'reboot_requested': True},
+            {'step': 'd', 'priority': 5, 'reboot_requested': False},
+            {'step': 'e', 'priority': 0, 'reboot_requested': True},
+        ]
+
+        self.assertEqual(
+            [('a', False), ('b', False), ('c', True), ('d', False),
+             ('e', True)],
+            [(step['step'], step['reboot_requested']) for step in
+             onmetal_hardware_manager._coalesce_reboots(steps)])
+        # The steps passed in are left alone
+        self.assertTrue(steps[1]['reboot_requested'])
+
+    def test__coalesce_reboots_keeps_firmware_reboot(self):
+        steps = [
+            {'step': 'upgrade_bios', 'priority': 90,
+             'reboot_requested': True},
+            {'step': 'decom_bios_settings', 'priority': 80,
+             'reboot_requested': True},
+            {'step': 'customer_bios_settings', 'priority': 70,
+             'reboot_requested': True},
+        ]
+
+        self.assertEqual(
+            [('upgrade_bios', True), ('decom_bios_settings', False),
+             ('customer_bios_settings', True)],
+            [(step['step'], step['reboot_requested']) for step in
+             onmetal_hardware_manager._coalesce_reboots(steps)])
+
+    @mock.patch.object(utils, 'execute')
+    @mock.patch.object(wipe, 'wipe_partition_tables')
+    def test_remove_bootloader(self, mocked_wipe, mocked_execute):
         self.hardware.get_os_install_device = mock.Mock()
         self.hardware.get_os_install_device.return_value = '/dev/hdz'
         self.hardware.remove_bootloader({}, [])
 
-        mocked_execute.assert_called_once_with(
-            'dd',
-            'if=/dev/zero',
-            'of=/dev/hdz',
-            'bs=1M',
-            'count=1',
-            check_exit_code=[0])
+        mocked_wipe.assert_called_once_with('/dev/hdz')
+        self.assertEqual(0, mocked_execute.call_count)
+
+    @mock.patch.object(onmetal_hardware_manager, 'PREFETCH_ON_LOAD', True)
+    def test_evaluate_hardware_support_starts_prefetch_once(self):
+        self.hardware._prefetch = mock.Mock()
+
+        self.assertEqual(hardware.HardwareSupport.SERVICE_PROVIDER,
+                         self.hardware.evaluate_hardware_support())
+        self.hardware.evaluate_hardware_support()
+        self.hardware._prefetch_thread.join(5)
+
+        self.hardware._prefetch.assert_called_once_with()
+
+    @mock.patch.object(onmetal_hardware_manager, 'PREFETCH_ON_LOAD', False)
+    def test_evaluate_hardware_support_prefetch_disabled(self):
+        self.hardware._prefetch = mock.Mock()
+
+        self.assertEqual(hardware.HardwareSupport.SERVICE_PROVIDER,
+                         self.hardware.evaluate_hardware_support())
+
+        self.assertIsNone(self.hardware._prefetch_thread)
+        self.assertFalse(self.hardware._prefetch.called)
+
+    def test__prefetch_step_waits_for_fetch_in_progress(self):
+        listing = threading.Event()
+        release = threading.Event()
+
+        def _list_block_devices():
+            listing.set()
+            release.wait(5)
+            return [self.block_device]
+
+        self.hardware.list_block_devices = mock.Mock(
+            side_effect=_list_block_devices)
+        self.hardware._get_lsi_inventory = mock.Mock()
+        self.hardware._get_block_device_topology = mock.Mock()
+        self.hardware._get_bios_version = mock.Mock()
+        snapshots = []
+        step = threading.Thread(target=lambda: snapshots.append(
+            self.hardware._get_hardware_snapshot()))
+
+        prefetch = self.hardware._start_prefetch()
+        self.assertTrue(listing.wait(5))
+        step.start()
+        step.join(0.1)
+        # The step is blocked until the prefetch has listed the devices
+        self.assertTrue(step.is_alive())
+        release.set()
+        step.join(5)
+        prefetch.join(5)
+
+        self.assertEqual(1, self.hardware.list_block_devices.call_count)
+        self.assertEqual([self.hardware._hardware_snapshot], snapshots)
+        self.hardware._get_lsi_inventory.assert_called_once_with()
+        self.hardware._get_block_device_topology.assert_called_once_with()
+        self.hardware._get_bios_version.assert_called_once_with()
+
+    def test__prefetch_continues_after_failure(self):
+        self.hardware.list_block_devices = mock.Mock(
+            return_value=[self.block_device])
+        self.hardware._list_lsi_devices = mock.Mock(
+            side_effect=errors.CleaningError('ddoemcli missing'))
+        self.hardware._get_block_device_topology = mock.Mock()
+        self.hardware._get_bios_version = mock.Mock()
+
+        self.hardware._prefetch()
+
+        self.assertIsNotNone(self.hardware._hardware_snapshot)
+        # Left empty, for the step that needs it to fetch again
+        self.assertIsNone(self.hardware._lsi_inventory)
+        self.hardware._get_block_device_topology.assert_called_once_with()
+        self.hardware._get_bios_version.assert_called_once_with()
+
+    def test_evaluate_hardware_support_other_vendor(self):
+        self.hardware._hardware_profile = inventory.HardwareProfile(
+            'Dell Inc.', 'PowerEdge R630', (), 1024 * 1024 * 32)
+        self.hardware._start_prefetch = mock.Mock()
+
+        self.assertEqual(hardware.HardwareSupport.NONE,
+                         self.hardware.evaluate_hardware_support())
+        self.assertFalse(self.hardware._start_prefetch.called)
+
+    @mock.patch.object(onmetal_hardware_manager, 'PREFETCH_ON_LOAD', False)
+    def test_evaluate_hardware_support_vendor_unknown(self):
+        self.hardware._hardware_profile = inventory.HardwareProfile(
+            None, None, (), 1024 * 1024 * 32)
+
+        self.assertEqual(hardware.HardwareSupport.SERVICE_PROVIDER,
+                         self.hardware.evaluate_hardware_support())
+
+    def test__get_hardware_profile(self):
+        self.hardware._hardware_profile = None
+        self.hardware.sys_path = self.tempdir
+        self.hardware.list_block_devices = mock.Mock()
+        with mock.patch.object(inventory, 'detect') as mocked_detect:
+            mocked_detect.return_value = inventory.HardwareProfile(
+                'Quanta', 'OnMetal', (), None)
+            self.assertIs(mocked_detect.return_value,
+                          self.hardware._get_hardware_profile())
+            self.hardware._invalidate_caches()
+            self.hardware._get_hardware_profile()
+
+        mocked_detect.assert_called_once_with(
+            self.tempdir, onmetal_hardware_manager.MEMINFO_PATH)
+
+    def test__get_detected_flavor(self):
+        # MemTotal is a little less than the memory installed
+        for memory_kb, flavor in [(32 * 1024 * 1024 - 300000,
+                                   'onmetal-compute1'),
+                                  (128 * 1024 * 1024 - 900000,
+                                   'onmetal-io1'),
+                                  (512 * 1024 * 1024 - 3000000,
+                                   'onmetal-memory1'),
+                                  (8 * 1024 * 1024, None),
+                                  (64 * 1024 * 1024, None),
+                                  (None, None)]:
+            self.hardware._hardware_profile = inventory.HardwareProfile(
+                'Quanta', 'OnMetal', (), memory_kb)
+            self.assertEqual(flavor, self.hardware._get_detected_flavor())
+
+    def test_verify_hardware_detected_flavor_mismatch(self):
+        self.hardware._hardware_profile = inventory.HardwareProfile(
+            'Quanta', 'OnMetal', (), 128 * 1024 * 1024 - 900000)
+        self.hardware.list_block_devices = mock.Mock(return_value=[
+            hardware.BlockDevice('/dev/sdc', '32G MLC SATADOM', 33554432,
+                                 False)])
+
+        error = self.assertRaises(
+            errors.CleaningError, self.hardware.verify_hardware,
+            {'properties': {'memory_mb': 1024 * 32}}, [])
+        self.assertIn('registered as onmetal-compute1, but has the memory '
+                      'of onmetal-io1', str(error))
+
+    def test__get_hardware_snapshot_shared_by_steps(self):
+        satadom = hardware.BlockDevice('/dev/sdb', '32G MLC SATADOM',
+                                       31016853504, False)
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [self.block_device,
+                                                         satadom]
+        self.hardware._collect_disk_metrics = mock.Mock(
+            side_effect=errors.CleaningError('no SMART'))
+        self.hardware.get_os_install_device = mock.Mock()
+        self.hardware.get_os_install_device.return_value = '/dev/sdb'
+
+        self.assertRaises(errors.CleaningError,
+                          self.hardware.get_disk_metrics, {}, [])
+        self.hardware.verify_hardware(
+            {'properties': {'memory_mb': 1024 * 32}}, [])
+        self.assertEqual('/dev/sdb', self.hardware._get_os_install_device())
+        self.assertEqual('/dev/sdb', self.hardware._get_os_install_device())
+
+        self.assertEqual(1, self.hardware.list_block_devices.call_count)
+        self.assertEqual(1, self.hardware.get_os_install_device.call_count)
+        # Steps see records of the devices listed
+        self.assertEqual(
+            [self.block_device, satadom],
+            [record.device for record in
+             self.hardware._get_hardware_snapshot().block_devices])
+
+        self.hardware._invalidate_caches()
+        self.hardware._get_hardware_snapshot()
+        self.hardware._get_os_install_device()
+        self.assertEqual(2, self.hardware.list_block_devices.call_count)
+        self.assertEqual(2, self.hardware.get_os_install_device.call_count)
 
     @mock.patch.object(utils, 'execute')
     def test__get_smartctl_attributes(self, mocked_execute):
         expected = SMARTCTL_ATTRIBUTES
 
-        mocked_execute.return_value = SMARTCTL_ATTRIBUTES_OUT
+        # smartctl older than 7.0 has no --json, so the text table is read
+        mocked_execute.side_effect = [
+            ('smartctl 6.2 2013-07-26 r3841 [x86_64-linux-4.4.0]\n', ''),
+            (SMARTCTL_ATTRIBUTES_OUT, '')]
         self.block_device = hardware.BlockDevice('/dev/sda', '32G MLC SATADOM',
                                                  31016853504, False)
         actual = self.hardware._get_smartctl_attributes(self.block_device)
 
-        mocked_execute.assert_called_once_with(
-            'smartctl',
-            '--attributes',
-            '/dev/sda')
+        mocked_execute.assert_has_calls([
+            mock.call('smartctl', '--version', on_execute=mock.ANY,
+                      on_completion=mock.ANY),
+            mock.call('smartctl', '--attributes', '/dev/sda',
+                      on_execute=mock.ANY, on_completion=mock.ANY)])
 
         self.assertEqual(expected, actual)
 
@@ -545,17 +1376,76 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
         self.hardware._get_warpdrive_card = mock.Mock()
         self.hardware._get_warpdrive_card.return_value = {'id': '1'}
 
-        mocked_execute.return_value = DDOEMCLI_HEALTH_OUT
+        mocked_execute.return_value = (DDOEMCLI_HEALTH_OUT, '')
         actual = self.hardware._get_warpdrive_attributes(self.block_device)
 
         mocked_execute.assert_called_once_with(
                 onmetal_hardware_manager.DDOEMCLI,
-                '-c', '1', '-health')
+                '-c', '1', '-health', on_execute=mock.ANY,
+                on_completion=mock.ANY)
 
         self.assertEqual(expected, actual)
 
+    def test__parse_warpdrive_health_many_slots(self):
+        # Repeat the SSD sections of the fixture as slots 10 through 73
+        header, rest = DDOEMCLI_HEALTH_OUT.split('SSD Drive SMART', 1)
+        sections, footer = ('SSD Drive SMART' + rest).split('\nWarranty')
+        sections = sections.split('SSD Drive SMART')[1:]
+        output = header
+        for slot in range(10, 74):
+            output += 'SSD Drive SMART' + re.sub(
+                r'Slot #: \d+:', 'Slot #: {0}:'.format(slot),
+                sections[slot % len(sections)], count=1)
+        output += '\nWarranty' + footer
+
+        lines = onmetal_hardware_manager._iter_lines(output)
+        attributes = {}
+        for drive, key, value in (
+                onmetal_hardware_manager._parse_warpdrive_health(lines)):
+            attributes.setdefault(drive, {})[key] = value
+
+        self.assertEqual(64, len(attributes))
+        for drive, stats in six.iteritems(attributes):
+            slot, serial = drive.split('_')
+            self.assertTrue(10 <= int(slot) < 74)
+            expected = [v for k, v in six.iteritems(WARPDRIVE_ATTRIBUTES)
+                        if k.endswith('_' + serial)][0]
+            self.assertEqual(expected, stats)
+
+    @mock.patch.object(onmetal_hardware_manager.metrics, 'getLogger')
+    def test__send_gauges(self, mocked_get_logger):
+        logger = mock.Mock(spec=['gauge'])
+        mocked_get_logger.return_value = logger
+
+        counts = self.hardware._send_gauges('smartdata_sda_NWD-BLP4-1600', {
+            '4_FL00AV2L.Power-OnHours': '957.6',
+            '4_FL00AV2L.Serial': 'FL00AV2L'})
+
+        self.assertEqual({'sent': 1, 'dropped': 1}, counts)
+        mocked_get_logger.assert_called_once_with(
+            'smartdata_sda_NWD-BLP4-1600')
+        logger.gauge.assert_called_once_with('4_FL00AV2L.Power-OnHours',
+                                             '957.6')
+
+    @mock.patch.object(onmetal_hardware_manager.metrics, 'getLogger')
+    def test__send_gauge_batch(self, mocked_get_logger):
+        logger = mock.Mock(spec=['gauge'])
+        mocked_get_logger.return_value = logger
+
+        counts = self.hardware._send_gauge_batch({
+            'smartdata_sda_NWD-BLP4-1600': {'4_FL00AV2L.Power-OnHours':
+                                            '957.6'},
+            'smartdata_sdb_32GMLCSATADOM': {'9-Power_On_Hours.VALUE': 100}})
+
+        self.assertEqual({'sent': 2, 'dropped': 0}, counts)
+        mocked_get_logger.assert_has_calls(
+            [mock.call('smartdata_sda_NWD-BLP4-1600'),
+             mock.call('smartdata_sdb_32GMLCSATADOM')], any_order=True)
+
     def test_get_disk_metrics(self):
-        self.hardware._send_gauges = mock.Mock()
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
         self.hardware.list_block_devices = mock.Mock()
         self.hardware.list_block_devices.return_value = [
                 hardware.BlockDevice(
@@ -576,25 +1466,26 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
         ports = mock.Mock()
         self.hardware.get_disk_metrics(node, ports)
 
-        self.hardware._send_gauges.assert_has_calls([
-            mock.call('smartdata_sdb_32GMLCSATADOM', {
-                '9-Power_On_Hours.VALUE': '100',
-                '9-Power_On_Hours.WORST': '100',
-                '9-Power_On_Hours.RAW_VALUE': '1673',
-                '12-Power_Cycle_Count.VALUE': '100',
-                '12-Power_Cycle_Count.WORST': '100',
-                '12-Power_Cycle_Count.RAW_VALUE': '68',
-                '169-Unknown_Attribute.VALUE': '100',
-                '169-Unknown_Attribute.WORST': '100',
-                '169-Unknown_Attribute.RAW_VALUE': '262144',
-                '173-Unknown_Attribute.VALUE': '199',
-                '173-Unknown_Attribute.WORST': '199',
-                '173-Unknown_Attribute.RAW_VALUE': '262146',
-                '194-Temperature_Celsius.VALUE': '100',
-                '194-Temperature_Celsius.WORST': '100',
-                '194-Temperature_Celsius.RAW_VALUE': '40',
-            }),
-            mock.call('smartdata_sda_NWD-BLP4-1600', {
+        # Every device is sent in one batch
+        self.hardware._send_gauge_batch.assert_called_once_with({
+            'smartdata_sdb_32GMLCSATADOM': {
+                '9-Power_On_Hours.VALUE': 100,
+                '9-Power_On_Hours.WORST': 100,
+                '9-Power_On_Hours.RAW_VALUE': 1673,
+                '12-Power_Cycle_Count.VALUE': 100,
+                '12-Power_Cycle_Count.WORST': 100,
+                '12-Power_Cycle_Count.RAW_VALUE': 68,
+                '169-Unknown_Attribute.VALUE': 100,
+                '169-Unknown_Attribute.WORST': 100,
+                '169-Unknown_Attribute.RAW_VALUE': 262144,
+                '173-Unknown_Attribute.VALUE': 199,
+                '173-Unknown_Attribute.WORST': 199,
+                '173-Unknown_Attribute.RAW_VALUE': 262146,
+                '194-Temperature_Celsius.VALUE': 100,
+                '194-Temperature_Celsius.WORST': 100,
+                '194-Temperature_Celsius.RAW_VALUE': 40,
+            },
+            'smartdata_sda_NWD-BLP4-1600': {
                 '6_FL00AVPL.Power-OnHours': '957.5',
                 '5_FL00AV3L.UncorrectableRAISEErrors': '0',
                 '4_FL00AV2L.TotalWritesFromHost': '7',
@@ -662,8 +1553,168 @@ class TestOnMetalHardwareManager(test_base.BaseTestCase):
                 '4_FL00AV2L.DevicePowerCycleCount': '49',
                 '4_FL00AV2L.TotalReadsToHost': '0',
                 '7_FL00ATTV.TotalReadsToHost': '1228',
-                '5_FL00AV3L.UnexpectedPowerLossCount': '52'})
-            ])
+                '5_FL00AV3L.UnexpectedPowerLossCount': '52'}
+        })
+
+    @mock.patch.object(utils, 'execute', new_callable=fakes.FakeCli)
+    def test_get_disk_metrics_sends_command_durations(self, fake_cli):
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [
+                hardware.BlockDevice(
+                    '/dev/sdb', '32G MLC SATADOM', 31016853504, False),
+                self.block_device]
+        self.hardware._get_warpdrive_card = mock.Mock()
+        self.hardware._get_warpdrive_card.return_value = {'id': '1'}
+
+        self.hardware.get_disk_metrics({}, [])
+
+        self.assertEqual([
+            (onmetal_hardware_manager.DDOEMCLI, '-c', '1', '-health'),
+            ('smartctl', '--json', '--attributes', '/dev/sdb'),
+            ('smartctl', '--version'),
+        ], sorted(fake_cli.calls))
+        sent = self.hardware._send_gauge_batch.call_args[0][0]
+        self.assertEqual(['smartdata_sdb_32GMLCSATADOM',
+                          'smartdata_sda_NWD-BLP4-1600',
+                          onmetal_hardware_manager.COMMAND_DURATIONS_PREFIX],
+                         list(sent))
+        durations = sent[onmetal_hardware_manager.COMMAND_DURATIONS_PREFIX]
+        self.assertEqual(2, durations['smartctl.count'])
+        self.assertEqual(1, durations['ddoemcli.count'])
+
+    @mock.patch('onmetal_ironic_hardware_manager.snapshot.time')
+    def test_get_disk_metrics_sends_changes(self, mocked_time):
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [
+                hardware.BlockDevice(
+                    '/dev/sdb', '32G MLC SATADOM', 31016853504, False)]
+        attributes = dict(SMARTCTL_ATTRIBUTES)
+        self.hardware._get_smartctl_attributes = mock.Mock()
+        self.hardware._get_smartctl_attributes.return_value = attributes
+        mocked_time.time.side_effect = [1000, 1000 + 2 * 60 * 60]
+
+        self.hardware.get_disk_metrics({}, [])
+        attributes['9-Power_On_Hours'] = smart.SmartAttribute(
+            9, 'Power_On_Hours', '0x0012', 100, 100, 0, 'Old_age', 'Always',
+            '-', '1675')
+        # A new manager reads what the first one sent from the snapshot
+        self.hardware._metric_snapshot = None
+        self.hardware.get_disk_metrics({}, [])
+
+        self.assertEqual(2, self.hardware._send_gauge_batch.call_count)
+        self.assertEqual(15, len(
+            self.hardware._send_gauge_batch.call_args_list[0][0][0][
+                'smartdata_sdb_32GMLCSATADOM']))
+        self.hardware._send_gauge_batch.assert_called_with({
+            'smartdata_sdb_32GMLCSATADOM': {
+                '9-Power_On_Hours.RAW_VALUE': 1675,
+                '9-Power_On_Hours.RAW_VALUE.PER_HOUR': 1.0,
+                '12-Power_Cycle_Count.RAW_VALUE.PER_HOUR': 0.0}})
+
+    def test_get_disk_metrics_prunes_removed_disks(self):
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
+        satadom = hardware.BlockDevice(
+            '/dev/sdb', '32G MLC SATADOM', 31016853504, False)
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [
+            hardware.BlockDevice('/dev/sdc', '32G MLC SATADOM', 31016853504,
+                                 False), satadom]
+        self.hardware._get_smartctl_attributes = mock.Mock()
+        self.hardware._get_smartctl_attributes.return_value = (
+                SMARTCTL_ATTRIBUTES)
+
+        self.hardware.get_disk_metrics({}, [])
+        self.hardware._invalidate_caches()
+        self.hardware.list_block_devices.return_value = [satadom]
+        self.hardware.get_disk_metrics({}, [])
+
+        with open(onmetal_hardware_manager.SMART_SNAPSHOT_PATH) as f:
+            self.assertEqual(['smartdata_sdb_32GMLCSATADOM'],
+                             list(json.load(f)))
+
+    @mock.patch.object(onmetal_hardware_manager, 'SMART_SNAPSHOT_PATH', None)
+    def test_get_disk_metrics_snapshot_disabled(self):
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [
+                hardware.BlockDevice(
+                    '/dev/sdb', '32G MLC SATADOM', 31016853504, False)]
+        self.hardware._get_smartctl_attributes = mock.Mock()
+        self.hardware._get_smartctl_attributes.return_value = (
+                SMARTCTL_ATTRIBUTES)
+
+        self.hardware.get_disk_metrics({}, [])
+        self.hardware.get_disk_metrics({}, [])
+
+        first, second = self.hardware._send_gauge_batch.call_args_list
+        self.assertEqual(first, second)
+        self.assertEqual(15, len(second[0][0]['smartdata_sdb_32GMLCSATADOM']))
+        self.assertFalse(os.listdir(self.tempdir))
+
+    def test_get_disk_metrics_device_fails(self):
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [
+                hardware.BlockDevice(
+                    '/dev/sdb', '32G MLC SATADOM', 31016853504, False),
+                self.block_device]
+
+        self.hardware._get_warpdrive_attributes = mock.Mock()
+        self.hardware._get_warpdrive_attributes.side_effect = (
+                errors.CleaningError('ddoemcli exploded'))
+
+        self.hardware._get_smartctl_attributes = mock.Mock()
+        self.hardware._get_smartctl_attributes.return_value = (
+                SMARTCTL_ATTRIBUTES)
+
+        exc = self.assertRaises(errors.CleaningError,
+                                self.hardware.get_disk_metrics, {}, [])
+
+        self.assertIn('from 1 of 2 block devices failed: /dev/sda: '
+                      'ddoemcli exploded', str(exc))
+        # The healthy device's gauges are still sent
+        self.hardware._send_gauge_batch.assert_called_once_with(
+            {'smartdata_sdb_32GMLCSATADOM': mock.ANY})
+
+    @mock.patch.object(onmetal_hardware_manager, 'DISK_METRICS_TIMEOUT', 0.1)
+    def test_get_disk_metrics_device_hangs(self):
+        self.hardware._send_gauge_batch = mock.Mock()
+        self.hardware._send_gauge_batch.return_value = {'sent': 0,
+                                                        'dropped': 0}
+        self.hardware.list_block_devices = mock.Mock()
+        self.hardware.list_block_devices.return_value = [
+                hardware.BlockDevice(
+                    '/dev/sdb', '32G MLC SATADOM', 31016853504, False),
+                self.block_device]
+
+        hung = threading.Event()
+        self.addCleanup(hung.set)
+        self.hardware._get_warpdrive_attributes = mock.Mock()
+        self.hardware._get_warpdrive_attributes.side_effect = (
+                lambda block_device: hung.wait(10))
+
+        self.hardware._get_smartctl_attributes = mock.Mock()
+        self.hardware._get_smartctl_attributes.return_value = (
+                SMARTCTL_ATTRIBUTES)
+
+        exc = self.assertRaises(errors.CleaningError,
+                                self.hardware.get_disk_metrics, {}, [])
+
+        self.assertIn('/dev/sda: Timed out after 0.1 seconds', str(exc))
+        self.hardware._send_gauge_batch.assert_called_once_with(
+            {'smartdata_sdb_32GMLCSATADOM': mock.ANY})
 
     def test_verify_blockdevice_count_io_pass(self):
         self.hardware._get_flavor_from_node = mock.Mock()
@@ -732,7 +1783,7 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
         self.interfaces = [
             hardware.NetworkInterface('eth0', 'aa:bb:cc:dd:ee:ff'),
             hardware.NetworkInterface('eth1', 'ff:ee:dd:cc:bb:aa')]
-        self.lldp_info = {
+        lldp_tlvs = {
             'eth0': [
                 # Chassis ID
                 (1, 'switch1'),
@@ -753,6 +1804,9 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
                 (5, 'switch2'),
             ]
         }
+        self.lldp_info = dict(
+            (name, lldp.parse_frame(fakes.lldp_frame(tlvs)))
+            for name, tlvs in lldp_tlvs.items())
 
         self.node = {
             'extra': {
@@ -802,7 +1856,7 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
                 '_get_node_switchports')
     @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
                 '_get_port_from_lldp')
-    @mock.patch('ironic_python_agent.netutils.get_lldp_info')
+    @mock.patch.object(lldp, 'capture')
     @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
                 'list_network_interfaces')
     def test_verify_ports(self, list_mock, lldp_mock,
@@ -825,7 +1879,7 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
                 '_get_node_switchports')
     @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
                 '_get_port_from_lldp')
-    @mock.patch('ironic_python_agent.netutils.get_lldp_info')
+    @mock.patch.object(lldp, 'capture')
     @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
                 'list_network_interfaces')
     def test_verify_ports_mismatch(self, list_mock, lldp_mock,
@@ -851,7 +1905,7 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
                 '_get_node_switchports')
     @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
                 '_get_port_from_lldp')
-    @mock.patch('ironic_python_agent.netutils.get_lldp_info')
+    @mock.patch.object(lldp, 'capture')
     @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
                 'list_network_interfaces')
     def test_verify_ports_unmatched(self, list_mock, lldp_mock,
@@ -872,13 +1926,68 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
                           self.node,
                           self.ports)
 
-    def test__get_tlv_malformed(self):
-        self.lldp_info['eth0'][0] = ('bad tlv',)
+    @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
+                '_get_node_switchports')
+    @mock.patch.object(lldp, 'capture')
+    @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
+                'list_network_interfaces')
+    @mock.patch.object(onmetal_hardware_manager, 'LOG')
+    def test_verify_ports_unknown_port(self, mocked_log, list_mock,
+                                       lldp_mock, node_ports_mock):
+        list_mock.return_value = self.interfaces
+        node_ports_mock.return_value = self.port_tuples
+        # An interface the node has no port for was heard from before
+        # capturing stopped
+        lldp_mock.return_value = {
+            'eth0': self.lldp_info['eth0'],
+            'eth1': self.lldp_info['eth1'],
+            'eth2': lldp.parse_frame(fakes.lldp_frame(
+                [(2, '\x05Ethernet3/1'), (5, 'switch3')]))
+        }
+
+        self.hardware.verify_ports(self.node, self.ports)
+        mocked_log.warning.assert_called_once_with(
+            'LLDP ports not known to the node: %s',
+            set([('switch3', 'eth3/1')]))
+        self.assertFalse(mocked_log.error.called)
+
+    @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
+                '_get_node_switchports')
+    @mock.patch.object(lldp, 'capture')
+    @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
+                'list_network_interfaces')
+    def test_verify_ports_stops_once_all_seen(self, list_mock, capture_mock,
+                                              node_ports_mock):
+        list_mock.return_value = self.interfaces
+        node_ports_mock.return_value = self.port_tuples
+        finished = []
+
+        def _capture(interface_names, timeout, done):
+            self.assertEqual(['eth0', 'eth1'], interface_names)
+            self.assertEqual(onmetal_hardware_manager.LLDP_TIMEOUT, timeout)
+            lldp_info = {'eth1': self.lldp_info['eth1']}
+            finished.append(done(lldp_info))
+            lldp_info['eth0'] = self.lldp_info['eth0']
+            finished.append(done(lldp_info))
+            return lldp_info
+        capture_mock.side_effect = _capture
+
+        self.hardware.verify_ports(self.node, self.ports)
+        self.assertEqual([False, True], finished)
+
+    def test__get_port_from_lldp_repeated_port(self):
+        self.lldp_info['eth0'].add(2, b'\x05Ethernet1/2')
         self.assertRaises(errors.CleaningError,
-                          self.hardware._get_tlv,
-                          1,
+                          self.hardware._get_port_from_lldp,
                           self.lldp_info['eth0'])
 
+    def test__get_port_from_lldp_no_port_number(self):
+        lldp_info = lldp.parse_frame(fakes.lldp_frame(
+            [(2, '\x05mgmt0'), (5, 'switch1')]))
+        self.assertRaises(errors.CleaningError,
+                          self.hardware._get_port_from_lldp,
+                          lldp_info)
+
     def test__get_port_from_lldp(self):
         expected_ports = ('switch1', 'eth1/1')
         ports = self.hardware._get_port_from_lldp(self.lldp_info['eth0'])
@@ -888,3 +1997,62 @@ class TestOnMetalVerifyPorts(test_base.BaseTestCase):
         expected_ports = set([('switch2', 'eth2/1'), ('switch1', 'eth1/1')])
         ports = self.hardware._get_node_switchports(self.node, self.ports)
         self.assertEqual(expected_ports, ports)
+
+    def _add_uplinks(self):
+        """Give the node two more uplinks, as newer chassis have."""
+        for index in (2, 3):
+            self.node['extra'].update({
+                'hardware/interfaces/%d/name' % index: 'eth%d' % index,
+                'hardware/interfaces/%d/switch_chassis_id' % index:
+                    'switch%d' % (index + 1),
+                'hardware/interfaces/%d/switch_port_id' % index:
+                    'Eth%d/1' % (index + 1)})
+            self.lldp_info['eth%d' % index] = lldp.parse_frame(
+                fakes.lldp_frame([(2, '\x05Ethernet%d/1' % (index + 1)),
+                                  (5, 'switch%d' % (index + 1))]))
+
+    def test__get_node_switchports_four_interfaces(self):
+        self._add_uplinks()
+
+        self.assertEqual(
+            set([('switch1', 'eth1/1'), ('switch2', 'eth2/1'),
+                 ('switch3', 'eth3/1'), ('switch4', 'eth4/1')]),
+            self.hardware._get_node_switchports(self.node, self.ports))
+
+    def test__get_node_switchports_skips_unswitched_interfaces(self):
+        self.node['extra']['hardware/interfaces/2/name'] = 'eth2'
+
+        self.assertEqual(
+            self.port_tuples,
+            self.hardware._get_node_switchports(self.node, self.ports))
+
+    def test__get_node_switchports_malformed(self):
+        del self.node['extra']['hardware/interfaces/1/switch_port_id']
+
+        self.assertRaises(errors.CleaningError,
+                          self.hardware._get_node_switchports,
+                          self.node, self.ports)
+
+    @mock.patch.object(lldp, 'capture')
+    @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
+                'list_network_interfaces')
+    def test_verify_ports_four_interfaces(self, list_mock, capture_mock):
+        self._add_uplinks()
+        list_mock.return_value = self.interfaces
+        capture_mock.return_value = self.lldp_info
+
+        self.hardware.verify_ports(self.node, self.ports)
+
+    @mock.patch.object(lldp, 'capture')
+    @mock.patch('onmetal_ironic_hardware_manager.OnMetalHardwareManager.'
+                'list_network_interfaces')
+    def test_verify_ports_swapped_interfaces(self, list_mock, capture_mock):
+        list_mock.return_value = self.interfaces
+        # The right switch ports, cabled to each other's interfaces
+        capture_mock.return_value = {'eth0': self.lldp_info['eth1'],
+                                     'eth1': self.lldp_info['eth0']}
+
+        error = self.assertRaises(errors.CleaningError,
+                                  self.hardware.verify_ports,
+                                  self.node, self.ports)
+        self.assertIn('Detected interface mismatches', str(error))
@@ -0,0 +1,251 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+import struct
+
+import mock
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import smart
+from onmetal_ironic_hardware_manager.tests import fakes
+
+SMARTCTL_ATTRIBUTES_OUT = fakes.read_fixture('smartctl_attributes_out.txt')
+SMARTCTL_ATTRIBUTES_JSON_OUT = fakes.read_fixture(
+    'smartctl_attributes_out.json')
+# smartctl from before --json was added
+OLD_SMARTCTL_RESPONSES = {
+    ('smartctl', '--version'): (
+        fakes.SMARTCTL_VERSION_OUT.replace('smartctl 7.1', 'smartctl 6.2'),
+        ''),
+}
+
+
+class TestParseSmartctlAttributes(test_base.BaseTestCase):
+    def test_parse(self):
+        attributes = smart.parse_smartctl_attributes(SMARTCTL_ATTRIBUTES_OUT)
+
+        self.assertEqual(19, len(attributes))
+        self.assertEqual(
+            smart.SmartAttribute(9, 'Power_On_Hours', '0x0012', 100, 100, 0,
+                                 'Old_age', 'Always', '-', '1673'),
+            attributes['9-Power_On_Hours'])
+        self.assertEqual(1673, attributes['9-Power_On_Hours'].raw)
+
+    def test_parse_raw_value_with_spaces(self):
+        attributes = smart.parse_smartctl_attributes(SMARTCTL_ATTRIBUTES_OUT)
+
+        temperature = attributes['194-Temperature_Celsius']
+        self.assertEqual('40 (Min/Max 30/60)', temperature.raw_value)
+        self.assertEqual(40, temperature.raw)
+        self.assertEqual(30, temperature.thresh)
+        self.assertEqual('-', temperature.when_failed)
+
+    def test_parse_non_integer_raw_value(self):
+        output = SMARTCTL_ATTRIBUTES_OUT.replace(
+            '      1673', '      n/a ', 1)
+
+        attributes = smart.parse_smartctl_attributes(output)
+
+        self.assertEqual('n/a', attributes['9-Power_On_Hours'].raw_value)
+        self.assertIsNone(attributes['9-Power_On_Hours'].raw)
+
+    def test_parse_no_threshold(self):
+        output = SMARTCTL_ATTRIBUTES_OUT.replace(
+            '100   100   000    Old_age   Always       -       1673',
+            '100   100   ---    Old_age   Always       -       1673', 1)
+
+        attributes = smart.parse_smartctl_attributes(output)
+
+        self.assertEqual(19, len(attributes))
+        self.assertIsNone(attributes['9-Power_On_Hours'].thresh)
+        self.assertEqual(100, attributes['9-Power_On_Hours'].value)
+
+    def test_parse_skips_malformed_rows(self):
+        output = SMARTCTL_ATTRIBUTES_OUT + 'Some trailing garbage\n'
+
+        attributes = smart.parse_smartctl_attributes(output)
+
+        self.assertEqual(19, len(attributes))
+
+    def test_parse_no_header(self):
+        self.assertEqual({}, smart.parse_smartctl_attributes(
+            'Smartctl open device: /dev/sda failed: No such device\n'))
+
+    def test_parse_unexpected_header(self):
+        output = SMARTCTL_ATTRIBUTES_OUT.replace('THRESH', 'THRSH')
+
+        self.assertRaises(ValueError, smart.parse_smartctl_attributes, output)
+
+
+def _ata_smart_data(attributes):
+    """Pack attributes into SMART READ DATA and READ THRESHOLDS sectors."""
+    values = bytearray(smart.ATA_SECTOR_SIZE)
+    thresholds = bytearray(smart.ATA_SECTOR_SIZE)
+    for idx, attribute in enumerate(sorted(attributes.values(),
+                                           key=lambda a: a.id)):
+        raw = attribute.raw
+        if attribute.id in smart.ATA_TEMPERATURE_IDS:
+            # '40 (Min/Max 30/60)' packs into bytes 0, 2 and 4
+            temperatures = [int(t) for t in re.findall(r'\d+',
+                                                       attribute.raw_value)]
+            raw = temperatures[0] | temperatures[1] << 16 | \
+                temperatures[2] << 32
+        smart.ATA_SMART_ENTRY.pack_into(
+            values, 2 + idx * smart.ATA_SMART_ENTRY.size, attribute.id,
+            int(attribute.flag, 16), attribute.value, attribute.worst,
+            struct.pack('<Q', raw)[:6], 0)
+        smart.ATA_SMART_THRESHOLD_ENTRY.pack_into(
+            thresholds, 2 + idx * smart.ATA_SMART_THRESHOLD_ENTRY.size,
+            attribute.id, attribute.thresh)
+    return bytes(values), bytes(thresholds)
+
+
+class TestSmartBackends(test_base.BaseTestCase):
+    """Every backend is checked against the same smartctl fixture."""
+
+    def setUp(self):
+        super(TestSmartBackends, self).setUp()
+        self.expected = smart.parse_smartctl_attributes(
+            SMARTCTL_ATTRIBUTES_OUT)
+        self.execute = fakes.FakeCli()
+
+    def test_json(self):
+        backend = smart.SmartctlJsonBackend(self.execute)
+
+        self.assertTrue(backend.is_supported())
+        self.assertEqual(self.expected, backend.get_attributes('/dev/sda'))
+        self.assertEqual(('smartctl', '--json', '--attributes', '/dev/sda'),
+                         self.execute.calls[-1])
+
+    def test_json_unsupported(self):
+        self.execute.responses.update(OLD_SMARTCTL_RESPONSES)
+        backend = smart.SmartctlJsonBackend(self.execute)
+
+        self.assertFalse(backend.is_supported())
+
+    def test_json_when_failed(self):
+        output = SMARTCTL_ATTRIBUTES_JSON_OUT.replace(
+            '"when_failed": ""', '"when_failed": "now"', 1)
+
+        attributes = smart.parse_smartctl_json(output)
+
+        self.assertEqual('FAILING_NOW',
+                         attributes['1-Raw_Read_Error_Rate'].when_failed)
+
+    def test_no_threshold(self):
+        # smartctl leaves thresh out of its JSON where the text has ---
+        output = json.loads(SMARTCTL_ATTRIBUTES_JSON_OUT)
+        for entry in output['ata_smart_attributes']['table']:
+            if entry['id'] == 9:
+                del entry['thresh']
+        text_output = SMARTCTL_ATTRIBUTES_OUT.replace(
+            '100   100   000    Old_age   Always       -       1673',
+            '100   100   ---    Old_age   Always       -       1673', 1)
+
+        attributes = smart.parse_smartctl_json(json.dumps(output))
+
+        self.assertIsNone(attributes['9-Power_On_Hours'].thresh)
+        self.assertEqual(smart.parse_smartctl_attributes(text_output),
+                         attributes)
+
+    def test_text(self):
+        backend = smart.SmartctlTextBackend(self.execute)
+
+        self.assertTrue(backend.is_supported())
+        self.assertEqual(self.expected, backend.get_attributes('/dev/sda'))
+        self.assertEqual(('smartctl', '--attributes', '/dev/sda'),
+                         self.execute.calls[-1])
+
+    def test_ata_ioctl(self):
+        read_smart_data = mock.Mock()
+        read_smart_data.return_value = _ata_smart_data(self.expected)
+        backend = smart.AtaIoctlBackend(self.execute,
+                                        read_smart_data=read_smart_data)
+
+        attributes = dict((attribute.id, attribute) for attribute in
+                          backend.get_attributes('/dev/sda').values())
+
+        read_smart_data.assert_called_once_with('/dev/sda')
+        self.assertEqual([], self.execute.calls)
+        self.assertEqual(len(self.expected), len(attributes))
+        for expected in self.expected.values():
+            actual = attributes[expected.id]
+            # Without smartctl's drive database, names come from the
+            # generic table rather than the vendor specific one
+            self.assertEqual(smart.ATA_ATTRIBUTE_NAMES.get(
+                expected.id, 'Unknown_Attribute'), actual.name)
+            actual.name = expected.name
+            self.assertEqual(expected, actual)
+
+    def test_parse_ata_smart_data_failing(self):
+        failing = smart.SmartAttribute(5, 'Reallocated_Sector_Ct', '0x0033',
+                                       9, 9, 10, 'Pre-fail', 'Always',
+                                       'FAILING_NOW', '3000')
+
+        attributes = smart.parse_ata_smart_data(
+            *_ata_smart_data({failing.key: failing}))
+
+        self.assertEqual({failing.key: failing}, attributes)
+
+
+class TestSmartReader(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestSmartReader, self).setUp()
+        self.expected = smart.parse_smartctl_attributes(
+            SMARTCTL_ATTRIBUTES_OUT)
+        self.execute = fakes.FakeCli()
+
+    def test_prefers_json(self):
+        reader = smart.SmartReader(self.execute)
+
+        self.assertEqual(self.expected, reader.get_attributes('/dev/sda'))
+        reader.get_attributes('/dev/sdb')
+        self.assertEqual([
+            ('smartctl', '--version'),
+            ('smartctl', '--json', '--attributes', '/dev/sda'),
+            ('smartctl', '--json', '--attributes', '/dev/sdb'),
+        ], self.execute.calls)
+
+    def test_falls_back_to_text_on_old_smartctl(self):
+        self.execute.responses.update(OLD_SMARTCTL_RESPONSES)
+        reader = smart.SmartReader(self.execute)
+
+        self.assertEqual(self.expected, reader.get_attributes('/dev/sda'))
+        self.assertEqual([
+            ('smartctl', '--version'),
+            ('smartctl', '--attributes', '/dev/sda'),
+        ], self.execute.calls)
+
+    def test_falls_back_to_text_on_failure(self):
+        reader = smart.SmartReader(self.execute)
+        reader.supported_backends()[0].get_attributes = mock.Mock(
+            side_effect=ValueError('bad json'))
+
+        self.assertEqual(self.expected, reader.get_attributes('/dev/sda'))
+        self.assertEqual(('smartctl', '--attributes', '/dev/sda'),
+                         self.execute.calls[-1])
+
+    def test_last_backend_failure_raises(self):
+        reader = smart.SmartReader(self.execute, backends=('text',))
+        reader.supported_backends()[0].get_attributes = mock.Mock(
+            side_effect=OSError('smartctl: not found'))
+
+        self.assertRaises(OSError, reader.get_attributes, '/dev/sda')
+
+    def test_no_backends(self):
+        reader = smart.SmartReader(self.execute, backends=())
+
+        self.assertRaises(ValueError, reader.get_attributes, '/dev/sda')
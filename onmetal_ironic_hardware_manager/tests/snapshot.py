@@ -0,0 +1,169 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import snapshot
+
+DAY = 24 * 60 * 60
+
+
+class TestMetricSnapshot(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestMetricSnapshot, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'state', 'smart.json')
+        self.snapshot = self._snapshot()
+        self.metrics = {'9-Power_On_Hours.VALUE': 100,
+                        '9-Power_On_Hours.RAW_VALUE': 1673,
+                        '194-Temperature_Celsius.RAW_VALUE': 40}
+
+    def _snapshot(self):
+        return snapshot.MetricSnapshot(self.path, DAY,
+                                       ['-Power_On_Hours.RAW_VALUE'])
+
+    def test_changes_new_disk(self):
+        self.assertEqual(self.metrics, self.snapshot.changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=1000))
+
+    def test_changes_unchanged(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+
+        # Rates are new the second time a disk is seen
+        self.assertEqual({'9-Power_On_Hours.RAW_VALUE.PER_HOUR': 0.0},
+                         self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                               self.metrics, now=2000))
+        self.assertEqual({}, self.snapshot.changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=3000))
+
+    def test_changes_only_changed(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+        self.metrics['194-Temperature_Celsius.RAW_VALUE'] = 42
+
+        self.assertEqual({'194-Temperature_Celsius.RAW_VALUE': 42,
+                          '9-Power_On_Hours.RAW_VALUE.PER_HOUR': 0.0},
+                         self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                               self.metrics, now=2000))
+        self.metrics['194-Temperature_Celsius.RAW_VALUE'] = 41
+        self.assertEqual({'194-Temperature_Celsius.RAW_VALUE': 41},
+                         self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                               self.metrics, now=3000))
+
+    def test_changes_rates(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+        self.metrics['9-Power_On_Hours.RAW_VALUE'] = 1675
+
+        # Two hours on in two hours
+        self.assertEqual({'9-Power_On_Hours.RAW_VALUE': 1675,
+                          '9-Power_On_Hours.RAW_VALUE.PER_HOUR': 1.0},
+                         self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                               self.metrics, now=8200))
+        # An unchanged rate isn't sent again
+        self.metrics['9-Power_On_Hours.RAW_VALUE'] = 1676
+        self.assertEqual({'9-Power_On_Hours.RAW_VALUE': 1676},
+                         self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                               self.metrics, now=11800))
+
+    def test_changes_counter_reset(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+        self.metrics['9-Power_On_Hours.RAW_VALUE'] = 3
+
+        self.assertEqual({'9-Power_On_Hours.RAW_VALUE': 3},
+                         self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                               self.metrics, now=8200))
+
+    def test_changes_full_refresh(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000 + DAY - 1)
+
+        changes = self.snapshot.changes('SERIAL1', 'smartdata_sda',
+                                        self.metrics, now=1000 + DAY)
+
+        self.assertEqual(set(self.metrics) |
+                         set(['9-Power_On_Hours.RAW_VALUE.PER_HOUR']),
+                         set(changes))
+        self.assertEqual({}, self.snapshot.changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=2000 + DAY))
+
+    def test_changes_clock_went_backwards(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+
+        self.assertEqual(self.metrics, self.snapshot.changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=500))
+
+    def test_changes_new_prefix(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+
+        self.assertEqual(set(self.metrics) |
+                         set(['9-Power_On_Hours.RAW_VALUE.PER_HOUR']),
+                         set(self.snapshot.changes('SERIAL1', 'smartdata_sdb',
+                                                   self.metrics, now=2000)))
+
+    def test_prune(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+        self.snapshot.changes('SERIAL2', 'smartdata_sdb', self.metrics,
+                              now=1000)
+
+        self.snapshot.prune(['SERIAL2', 'SERIAL3'])
+        self.snapshot.save()
+
+        snapshot = self._snapshot()
+        self.assertEqual(self.metrics, snapshot.changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=2000))
+        self.assertNotIn('9-Power_On_Hours.VALUE', snapshot.changes(
+            'SERIAL2', 'smartdata_sdb', self.metrics, now=2000))
+
+    def test_save_and_load(self):
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=2000)
+        self.snapshot.save()
+
+        self.assertEqual({}, self._snapshot().changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=3000))
+        self.assertEqual([], [f for f in os.listdir(os.path.dirname(
+            self.path)) if f != 'smart.json'])
+
+    def test_load_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"SERIAL1": ')
+
+        self.assertEqual(self.metrics, self._snapshot().changes(
+            'SERIAL1', 'smartdata_sda', self.metrics, now=2000))
+
+    def test_save_fails(self):
+        # The snapshot directory's parent is a file, so it can't be created
+        open(os.path.join(self.tempdir, 'state'), 'w').close()
+        self.snapshot.changes('SERIAL1', 'smartdata_sda', self.metrics,
+                              now=1000)
+
+        self.snapshot.save()
+
+        self.assertFalse(os.path.exists(self.path))
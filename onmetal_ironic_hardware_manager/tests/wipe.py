@@ -0,0 +1,91 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+from oslotest import base as test_base
+
+from onmetal_ironic_hardware_manager import wipe
+
+MIB = 1024 * 1024
+
+
+class TestWipePartitionTables(test_base.BaseTestCase):
+    def setUp(self):
+        super(TestWipePartitionTables, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'disk.img')
+
+    def _make_disk(self, size):
+        """Make a sparse disk image, with data where partition tables go."""
+        with open(self.path, 'wb') as f:
+            f.truncate(size)
+            for offset in (0, 510, MIB - 512, size // 2, size - 512):
+                f.seek(offset)
+                f.write(b'\xaa' * 512)
+
+    def _read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def test_wipe(self):
+        size = 64 * MIB
+        self._make_disk(size)
+
+        start = time.time()
+        regions = wipe.wipe_partition_tables(self.path)
+        duration = time.time() - start
+
+        self.assertEqual([(0, MIB), (size - MIB, MIB)], regions)
+        self.assertEqual(b'\0' * MIB, self._read(0, MIB))
+        self.assertEqual(b'\0' * MIB, self._read(size - MIB, MIB))
+        # Everything in between is left alone
+        self.assertEqual(b'\xaa' * 512, self._read(size // 2, 512))
+        self.assertEqual(size, os.path.getsize(self.path))
+        self.assertTrue(duration < 5)
+
+    def test_wipe_small_disk(self):
+        self._make_disk(MIB + 4096)
+
+        regions = wipe.wipe_partition_tables(self.path)
+
+        self.assertEqual([(0, MIB + 4096)], regions)
+        self.assertEqual(b'\0' * (MIB + 4096), self._read(0, MIB + 4096))
+
+    def test_wipe_size(self):
+        self._make_disk(64 * MIB)
+
+        regions = wipe.wipe_partition_tables(self.path, size=1000)
+
+        # Rounded down to whole sectors
+        self.assertEqual([(0, 512), (64 * MIB - 512, 512)], regions)
+        self.assertEqual(b'\xaa' * 512, self._read(MIB - 512, 512))
+
+    @mock.patch('fcntl.ioctl')
+    def test_wipe_file_skips_ioctls(self, mocked_ioctl):
+        self._make_disk(64 * MIB)
+
+        wipe.wipe_partition_tables(self.path)
+
+        self.assertEqual(0, mocked_ioctl.call_count)
+
+    def test_wipe_missing_device(self):
+        self.assertRaises(OSError, wipe.wipe_partition_tables,
+                          os.path.join(self.tempdir, 'missing'))
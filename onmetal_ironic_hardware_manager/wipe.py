@@ -0,0 +1,105 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+
+from oslo_log import log
+
+LOG = log.getLogger()
+
+# Zeroed at each end of the device. The MBR and primary GPT live in the
+# first 34 sectors and the backup GPT in the last 33, so 1MiB covers them
+# for any sector size, along with most bootloaders.
+WIPE_SIZE = 1024 * 1024
+# Sector size assumed for anything that isn't a block device
+DEFAULT_SECTOR_SIZE = 512
+
+# From linux/fs.h
+BLKSSZGET = 0x1268
+BLKRRPART = 0x125f
+# Not every platform's os module has O_DIRECT
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+
+def wipe_partition_tables(path, size=WIPE_SIZE):
+    """Zero the start and end of a device, where partition tables live.
+
+    Zeroes are written with O_DIRECT from a page aligned buffer, bypassing
+    the page cache, and synced before returning. For block devices, the
+    kernel is then asked to reread the now empty partition table.
+
+    :param path: the block device, or a file for testing
+    :param size: the bytes to zero at each end
+    :raises: OSError if the device can't be opened or written
+    :return: a list of the (offset, length) regions zeroed
+    """
+    fd = _open_direct(path)
+    try:
+        mode = os.fstat(fd).st_mode
+        is_block_device = stat.S_ISBLK(mode)
+        sector_size = DEFAULT_SECTOR_SIZE
+        if is_block_device:
+            sector_size = struct.unpack(
+                'i', fcntl.ioctl(fd, BLKSSZGET, struct.pack('i', 0)))[0]
+        # Also the size of a block device, which fstat doesn't give
+        device_size = os.lseek(fd, 0, os.SEEK_END)
+        size -= size % sector_size
+
+        if device_size <= 2 * size:
+            regions = [(0, device_size)]
+        else:
+            regions = [(0, size), (device_size - size, size)]
+
+        for offset, length in regions:
+            os.lseek(fd, offset, os.SEEK_SET)
+            _write_zeroes(fd, length)
+        os.fsync(fd)
+
+        if is_block_device:
+            try:
+                fcntl.ioctl(fd, BLKRRPART)
+            except (IOError, OSError) as e:
+                # Partitions still in use keep the kernel from dropping them
+                LOG.warning('Unable to reread the partition table of '
+                            '%(path)s: %(error)s', {'path': path, 'error': e})
+        return regions
+    finally:
+        os.close(fd)
+
+
+def _open_direct(path):
+    try:
+        return os.open(path, os.O_WRONLY | O_DIRECT)
+    except OSError as e:
+        # Some filesystems, such as tmpfs, don't support O_DIRECT
+        if e.errno != errno.EINVAL or not O_DIRECT:
+            raise
+        LOG.debug('%s does not support O_DIRECT, wiping it through the '
+                  'page cache', path)
+        return os.open(path, os.O_WRONLY)
+
+
+def _write_zeroes(fd, length):
+    while length > 0:
+        # Anonymous maps are zeroed and page aligned, as O_DIRECT needs
+        zeroes = mmap.mmap(-1, length)
+        try:
+            length -= os.write(fd, zeroes)
+        finally:
+            zeroes.close()
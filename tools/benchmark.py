@@ -0,0 +1,349 @@
+# Copyright 2015 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure what the parsers and get_disk_metrics cost.
+
+The tests/data fixtures are scaled up to many cards, slots and devices, and
+replayed through the hardware manager with utils.execute replaced by
+tests.fakes.FakeCli, so no vendor utility is needed. Each benchmark reports
+operations per second, the time of an operation, and the most memory an
+operation allocates (only on Pythons with tracemalloc).
+
+Compare against a stored baseline to catch regressions before a ramdisk is
+built; it exits non-zero if any benchmark got slower, or allocates more,
+by more than the tolerances:
+
+    python tools/benchmark.py --baseline tools/benchmark_baseline.json
+
+Timings depend on the machine, so save a baseline on the machine it will be
+compared on:
+
+    python tools/benchmark.py --save tools/benchmark_baseline.json
+"""
+
+import argparse
+import gc
+import json
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from ironic_python_agent import hardware
+from ironic_python_agent import utils
+
+import onmetal_ironic_hardware_manager as onmetal_hardware_manager
+from onmetal_ironic_hardware_manager.tests import fakes
+
+# How far each fixture is scaled up
+LSI_CARDS = 64
+WARPDRIVE_SLOTS = 64
+SMARTCTL_DEVICES = 32
+# get_disk_metrics reads this many WarpDrive cards, each with the four
+# slots of the fixture, and this many SATA devices
+DISK_METRICS_CARDS = 8
+DISK_METRICS_DEVICES = 32
+
+# The most precise clock, where there is one
+timer = getattr(time, 'perf_counter', time.time)
+
+SLOT_PREFIX = onmetal_hardware_manager.WARPDRIVE_SLOT_PREFIX
+FOOTER_PREFIX = onmetal_hardware_manager.WARPDRIVE_FOOTER_PREFIX
+SLOT_NUMBER_RE = re.compile(r'(Slot #:\s*)\d+(:.*\s)(\S+)$')
+
+
+def scale_listall(cards):
+    """Return ddoemcli -listall output listing the given number of cards."""
+    lines = fakes.read_fixture('ddoemcli_listall_out.txt').split('\n')
+    rows = [idx for idx, line in enumerate(lines)
+            if onmetal_hardware_manager.LSI_MODEL in line]
+    template = lines[rows[0]].split()
+    scaled = ['{0:<6}{1:<19}{2:<19}00:{3:02x}:00:00'.format(
+        card, template[1], template[2], card) for card in range(1, cards + 1)]
+    return '\n'.join(lines[:rows[0]] + scaled + lines[rows[-1] + 1:])
+
+
+def scale_health(slots):
+    """Return ddoemcli -health output with the given number of slots.
+
+    The slots of the fixture are repeated, renumbered and given unique
+    serial numbers.
+    """
+    lines = fakes.read_fixture('ddoemcli_health_out.txt').split('\n')
+    starts = [idx for idx, line in enumerate(lines)
+              if line.startswith(SLOT_PREFIX)]
+    footer = [idx for idx, line in enumerate(lines)
+              if line.startswith(FOOTER_PREFIX)][0]
+    sections = [lines[start:end] for start, end in
+                zip(starts, starts[1:] + [footer])]
+    scaled = []
+    for slot in range(slots):
+        section = list(sections[slot % len(sections)])
+        section[0] = SLOT_NUMBER_RE.sub(
+            lambda match: '{0}{1}{2}FL{3:06d}'.format(
+                match.group(1), slot, match.group(2), slot), section[0])
+        scaled.extend(section)
+    return '\n'.join(lines[:starts[0]] + scaled + lines[footer:])
+
+
+def fake_cli(slots=WARPDRIVE_SLOTS):
+    return fakes.FakeCli(responses={
+        ('ddoemcli', '-listall'): (scale_listall(LSI_CARDS), ''),
+        ('ddoemcli', '-health'): (scale_health(slots), ''),
+        ('smartctl', '--json'): (
+            fakes.read_fixture('smartctl_attributes_out.json'), ''),
+        ('smartctl', '--attributes'): (
+            fakes.read_fixture('smartctl_attributes_out.txt'), ''),
+    })
+
+
+def sata_devices(count):
+    return [hardware.BlockDevice('/dev/sd{0}'.format(idx),
+                                 onmetal_hardware_manager.SATADOM_MODEL,
+                                 31016853504, False)
+            for idx in range(count)]
+
+
+def bench_list_lsi_devices(manager):
+    return manager._list_lsi_devices
+
+
+def bench_warpdrive_attributes(manager):
+    manager._get_warpdrive_card = lambda block_device: {'id': '1'}
+    card = hardware.BlockDevice('/dev/sda',
+                                onmetal_hardware_manager.LSI_MODEL,
+                                1600321314816, False)
+    return lambda: manager._get_warpdrive_attributes(card)
+
+
+def bench_smartctl_attributes(manager):
+    devices = sata_devices(SMARTCTL_DEVICES)
+
+    def _op():
+        for device in devices:
+            manager._get_smartctl_attributes(device)
+    return _op
+
+
+def bench_get_disk_metrics(manager):
+    cards = [hardware.BlockDevice('/dev/nvd{0}'.format(idx),
+                                  onmetal_hardware_manager.LSI_MODEL,
+                                  1600321314816, False)
+             for idx in range(DISK_METRICS_CARDS)]
+    manager.list_block_devices = lambda: (
+        cards + sata_devices(DISK_METRICS_DEVICES))
+    manager._get_warpdrive_card = lambda block_device: {
+        'id': block_device.name[-1]}
+    # Sending is up to the agent's metrics backend, which isn't measured
+    manager._send_gauge_batch = lambda gauges_by_prefix: {
+        'sent': sum(len(gauges) for gauges in gauges_by_prefix.values()),
+        'dropped': 0}
+    return lambda: manager.get_disk_metrics({}, [])
+
+
+# (name, setup, WarpDrive slots per -health, SMART backends). A setup takes
+# a manager and returns the operation to measure.
+BENCHMARKS = [
+    ('list_lsi_devices', bench_list_lsi_devices, WARPDRIVE_SLOTS,
+     ('json', 'text')),
+    ('warpdrive_attributes', bench_warpdrive_attributes, WARPDRIVE_SLOTS,
+     ('json', 'text')),
+    ('smartctl_attributes_json', bench_smartctl_attributes,
+     WARPDRIVE_SLOTS, ('json',)),
+    ('smartctl_attributes_text', bench_smartctl_attributes,
+     WARPDRIVE_SLOTS, ('text',)),
+    ('get_disk_metrics', bench_get_disk_metrics, 4, ('json', 'text')),
+]
+
+
+def measure(op, min_time, min_runs=3):
+    """Time op, and measure what a single call of it allocates.
+
+    :param op: a callable taking no arguments
+    :param min_time: the least seconds to spend timing op
+    :param min_runs: the least number of calls to time, and of calls whose
+                     allocations are traced
+    :return: a dict of {'ops_per_sec', 'mean_ms', 'min_ms', 'runs',
+                        'peak_alloc_bytes': the least, over the traced
+                                            calls, of the most memory
+                                            allocated at once during a call,
+                                            or None without tracemalloc}
+    """
+    # The first call fills caches, such as the SMART backends supported
+    op()
+    timings = []
+    # As timeit does, so a collection doesn't land in a random call
+    gc.collect()
+    gc.disable()
+    try:
+        start = timer()
+        while len(timings) < min_runs or timer() - start < min_time:
+            op_start = timer()
+            op()
+            timings.append(timer() - op_start)
+    finally:
+        gc.enable()
+
+    peak = None
+    if tracemalloc is not None:
+        peaks = []
+        for _ in range(min_runs):
+            tracemalloc.start()
+            try:
+                op()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        peak = min(peaks)
+
+    total = sum(timings)
+    return {'ops_per_sec': round(len(timings) / total, 2),
+            'mean_ms': round(total / len(timings) * 1000, 3),
+            'min_ms': round(min(timings) * 1000, 3),
+            'runs': len(timings),
+            'peak_alloc_bytes': peak}
+
+
+def run(names, min_time):
+    """Run benchmarks.
+
+    :param names: the benchmarks to run, or None for all of them
+    :param min_time: the least seconds to spend timing each
+    :return: a dict of {benchmark name: result of measure, along with
+                        'commands': {command name: mean ms per call}}
+    """
+    results = {}
+    tempdir = tempfile.mkdtemp()
+    try:
+        for name, setup, slots, backends in BENCHMARKS:
+            if names and name not in names:
+                continue
+            cli = fake_cli(slots)
+            with mock.patch.object(utils, 'execute', cli), \
+                    mock.patch.object(onmetal_hardware_manager,
+                                      'SMART_SNAPSHOT_PATH',
+                                      '{0}/{1}.json'.format(tempdir, name)), \
+                    mock.patch.object(onmetal_hardware_manager,
+                                      'SMART_BACKENDS', backends):
+                manager = onmetal_hardware_manager.OnMetalHardwareManager()
+                result = measure(setup(manager), min_time)
+                histogram = manager._get_executor().histogram.snapshot()
+            result['commands'] = dict(
+                (command, round(entry['sum'] / entry['count'] * 1000, 3))
+                for command, entry in histogram.items())
+            results[name] = result
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+
+def compare(results, baseline, tolerance, alloc_tolerance):
+    """Find the benchmarks that regressed against a baseline.
+
+    :param results: the results of run
+    :param baseline: results of run saved earlier
+    :param tolerance: the fraction a benchmark may get slower before it
+                      counts as a regression. The fastest call is compared,
+                      as it varies least between runs.
+    :param alloc_tolerance: the fraction a benchmark may allocate more by
+                            before it counts as a regression
+    :return: a list of messages, one per regression
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result['min_ms'] > expected['min_ms'] * (1 + tolerance):
+            regressions.append(
+                '{0}: fastest call took {1} ms, baseline {2} ms'.format(
+                    name, result['min_ms'], expected['min_ms']))
+        if (result['peak_alloc_bytes'] is not None and
+                expected.get('peak_alloc_bytes') is not None and
+                result['peak_alloc_bytes'] >
+                expected['peak_alloc_bytes'] * (1 + alloc_tolerance)):
+            regressions.append(
+                '{0}: {1} bytes allocated, baseline {2}'.format(
+                    name, result['peak_alloc_bytes'],
+                    expected['peak_alloc_bytes']))
+    return regressions
+
+
+def report(results, baseline=None):
+    print('{0:<26} {1:>12} {2:>10} {3:>10} {4:>12}  {5}'.format(
+        'benchmark', 'ops/sec', 'mean ms', 'min ms', 'peak alloc',
+        'min vs baseline'))
+    for name, result in sorted(results.items()):
+        change = ''
+        expected = (baseline or {}).get(name)
+        if expected:
+            change = '{0:+.1%}'.format(
+                result['min_ms'] / expected['min_ms'] - 1)
+        print('{0:<26} {1:>12} {2:>10} {3:>10} {4:>12}  {5}'.format(
+            name, result['ops_per_sec'], result['mean_ms'], result['min_ms'],
+            result['peak_alloc_bytes'], change))
+        for command, mean_ms in sorted(result['commands'].items()):
+            print('    {0:<22} {1:>10} ms per call'.format(command, mean_ms))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run, defaults to all of them')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='least seconds to time each benchmark for')
+    parser.add_argument('--baseline',
+                        help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction a benchmark may get slower by before '
+                             'failing, default %(default)s')
+    parser.add_argument('--alloc-tolerance', type=float, default=0.25,
+                        help='fraction a benchmark may allocate more by '
+                             'before failing, default %(default)s')
+    parser.add_argument('--save', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = run(args.benchmarks, args.min_time)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance,
+                              args.alloc_tolerance)
+        if regressions:
+            print('\nRegressions against {0}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())